@@ -0,0 +1,511 @@
+"""
+Benchmarks guarding the speed of the fitting code.
+
+bench_imports guards the start-up cost of the fitting workers. Each fit
+module is imported in a fresh interpreter, so nothing is shared with this
+process. A module fails if its import takes longer than the allowed time
+or if it pulls in a plotting package.
+
+bench_grid_posterior compares the grid posteriors of grid_posterior with
+the emcee fits of model_rv_fbump on synthetic pixels, for speed and for
+agreement of the percentiles.
+
+bench_suite times the forward models, the likelihoods, the HDF5 output and
+whole run_emcee fits (see CASES) on synthetic spectra and filter curves
+made here, so no case reads the PHAT data or runs FSPS. The cases still
+need the packages their modules import: sedpy for the forward models, and
+astrogrid and astropy for the modules that import compile_data (the model
+and ensemble cases, and bursty_sfh for the SFH one). A case whose packages
+are missing is skipped. Each case runs in a fresh interpreter and reports
+its throughput and its peak memory, which are compared with the baselines
+saved by --save_baselines.
+
+Run from the top of the repo:
+
+    python benchmarks.py [--max_import_time 2.0] [--grid_posterior]
+                         [--suite [--cases ...] [--save_baselines]]
+
+The exit status is non-zero if anything fails.
+"""
+import atexit
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+_TOP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# module name and the directory it lives in
+WORKER_MODULES = [('model_rv_fbump', _TOP_DIR),
+                  ('model_rv_condor_gooddust', _TOP_DIR),
+                  ('model_ensemble', _TOP_DIR),
+                  ('model_ensemble_simult', _TOP_DIR),
+                  ('model_rv_condor', os.path.join(_TOP_DIR, 'test_model_rv_fbump_condor'))]
+
+# packages a fit worker should never need
+PLOTTING_MODULES = ['matplotlib', 'seaborn', 'corner']
+
+# packages a suite case may be skipped for; any other import error fails it
+OPTIONAL_MODULES = ['fsps', 'sedpy', 'astrogrid', 'astropy', 'bursty_sfh']
+
+BASELINE_FILE = os.path.join(_TOP_DIR, 'benchmark_baselines.json')
+
+_IMPORT_SCRIPT = """
+import sys, time
+t0 = time.time()
+import {module}
+t1 = time.time()
+loaded = [m for m in {plotting!r} if m in sys.modules]
+print('%f %s' % (t1 - t0, ','.join(loaded)))
+"""
+
+
+def time_import(module, path, repeat=3):
+    """
+    Import `module` in a new interpreter `repeat` times.
+
+    Returns
+    -------
+    best : float ; fastest import time in seconds
+    loaded : list ; plotting packages that ended up in sys.modules
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([path, _TOP_DIR, env.get('PYTHONPATH', '')])
+    # make sure nothing tries to open a display
+    env['MPLBACKEND'] = 'Agg'
+    script = _IMPORT_SCRIPT.format(module=module, plotting=PLOTTING_MODULES)
+
+    times, loaded = [], []
+    for i in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', script], env=env,
+                                      cwd=path)
+        fields = out.decode('utf-8').strip().split('\n')[-1].split()
+        times.append(float(fields[0]))
+        loaded = fields[1].split(',') if len(fields) > 1 else []
+    return min(times), loaded
+
+
+def bench_imports(max_import_time=2.0, repeat=3):
+    """
+    Time the import of every worker module and check that none loads a
+    plotting package. Returns the number of failures.
+    """
+    failures = 0
+    print('%-28s %10s  %s' % ('module', 'import (s)', 'status'))
+    for module, path in WORKER_MODULES:
+        try:
+            best, loaded = time_import(module, path, repeat=repeat)
+        except subprocess.CalledProcessError:
+            print('%-28s %10s  %s' % (module, '-', 'FAIL (import error)'))
+            failures += 1
+            continue
+        status = 'ok'
+        if loaded:
+            status = 'FAIL (loads ' + ', '.join(loaded) + ')'
+        elif best > max_import_time:
+            status = 'FAIL (> %.2f s)' % max_import_time
+        failures += status != 'ok'
+        print('%-28s %10.3f  %s' % (module, best, status))
+    return failures
+
+
+def synthetic_pixels(npix, random_state, att=None, **kwargs):
+    """
+    Data for npix pixels of model_rv_fbump drawn from known (R_V, f_bump,
+    A_V), with 5% scatter and the 30% errors the fits assume.
+
+    Returns
+    -------
+    data, sigma : (npix, 2) arrays ; FUV and NUV flux ratios and errors
+    av : (npix,) array
+    """
+    import numpy as np
+    import sed_model
+    rv = random_state.uniform(2., 5., npix)
+    fb = random_state.uniform(0.2, 1.2, npix)
+    av = random_state.uniform(0.2, 1.5, npix)
+    if att is not None:
+        kwargs['att'] = att
+    truth = sed_model.flux_ratios(rv, av, 0., fb, **kwargs)
+    data = truth * (1. + 0.05 * random_state.randn(npix, truth.shape[1]))
+    return data, 0.3 * data, av
+
+
+def bench_grid_posterior(npix=500, nmcmc=3, max_dev=0.25, seed=1,
+                         run_steps=1000, restart_steps=500, n_restarts=8):
+    """
+    Time the grid posteriors of npix synthetic pixels and the emcee fits
+    (with run_model's schedule) of the first nmcmc of them, and compare
+    their percentiles. Fails if any grid percentile is more than max_dev
+    posterior widths ((p84 - p16) / 2 of the emcee fit) from emcee's; the
+    emcee percentiles themselves scatter by ~0.1 widths from run to run.
+    Returns the number of failures.
+    """
+    import numpy as np
+    import emcee
+    import grid_posterior
+    import model_rv_fbump
+    from sampling import initialize, run_emcee
+
+    random_state = np.random.RandomState(seed)
+    data, sigma, av = synthetic_pixels(npix, random_state, att=model_rv_fbump.ATT)
+
+    t0 = time.time()
+    post = grid_posterior.fit_pixels(data, sigma, av, att=model_rv_fbump.ATT)
+    grid_perc = post.percentiles()
+    t_grid = (time.time() - t0) / npix
+
+    ndim, nwalkers = 2, 32
+    mcmc_perc = np.empty((nmcmc, ndim, 3))
+    t0 = time.time()
+    for i in range(nmcmc):
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, model_rv_fbump.lnprob,
+                                        args=(data[i, 0], data[i, 1],
+                                              sigma[i, 0], sigma[i, 1], av[i]))
+        pos = initialize([2.5, 0.9], ndim, nwalkers)
+        sampler, pos = run_emcee(sampler, run_steps, restart_steps, pos, ndim,
+                                 nwalkers, n_restarts=n_restarts)
+        for d in range(ndim):
+            mcmc_perc[i, d] = np.percentile(sampler.flatchain[:, d], [16, 50, 84])
+    t_mcmc = (time.time() - t0) / max(nmcmc, 1)
+
+    width = 0.5 * (mcmc_perc[:, :, 2] - mcmc_perc[:, :, 0])
+    dev = np.max(np.abs(grid_perc[:nmcmc] - mcmc_perc) / width[:, :, None])
+    status = 'ok' if dev <= max_dev else 'FAIL (> %.2f)' % max_dev
+
+    print('%-8s %8s %14s %10s' % ('engine', 'pixels', 'time/pixel (s)', 'speedup'))
+    print('%-8s %8d %14.2e %10.0f' % ('grid', npix, t_grid, t_mcmc / t_grid))
+    print('%-8s %8d %14.2e %10s' % ('emcee', nmcmc, t_mcmc, '1'))
+    print('max |grid - emcee| percentile: %.3f posterior widths  %s' % (dev, status))
+    return int(status != 'ok')
+
+
+def synthetic_spectrum(nwave=3000, age=1e9):
+    """
+    Smooth stand-in for an FSPS spectrum (L_sun/AA), bluer when younger,
+    with a few absorption features.
+
+    Returns
+    -------
+    wave, spec : (nwave,) arrays
+    """
+    import numpy as np
+    wave = np.logspace(np.log10(900.), np.log10(3e4), nwave)
+    slope = -3. + 0.6 * (np.log10(age) - 6.)
+    spec = (wave / 5500.) ** slope
+    for center in (1550., 2800., 3933., 4861., 6563.):
+        spec *= 1. - 0.3 * np.exp(-0.5 * ((wave - center) / 15.) ** 2)
+    return wave, spec
+
+
+class SyntheticFilter(object):
+    """ Filter curve with sedpy's wavelength and transmission attributes. """
+    def __init__(self, lo, hi, npts=200):
+        import numpy as np
+        self.wavelength = np.linspace(lo, hi, npts)
+        self.transmission = np.sin(np.linspace(0., np.pi, npts)) ** 2
+
+
+# rough GALEX FUV and NUV coverage, in AA
+SYNTHETIC_BANDS = {'galex_fuv': (1340., 1810.), 'galex_nuv': (1690., 3000.)}
+
+
+def use_synthetic_sed():
+    """
+    Put the synthetic spectrum and filters in sed_model's memos, where the
+    FSPS spectrum and sedpy filters of the per-region models would go.
+    """
+    import sed_model
+    sed_model._SPECTRA[(1.0, 4, 1.0, 2)] = synthetic_spectrum()
+    sed_model._FILTERS[tuple(sed_model.BANDS)] = [SyntheticFilter(*SYNTHETIC_BANDS[b])
+                                                  for b in sed_model.BANDS]
+
+
+def _sfh_spec_data(mod, random_state, nssp=60, nwave=3000):
+    # spec_data of the SFH model (see its spectrum()) for a random SFH in
+    # the PHAT age bins, with synthetic SSPs
+    import numpy as np
+    edges = np.append(0., 10 ** np.arange(6.6, 10.2, 0.1))
+    sfr = random_state.uniform(0., 1e-3, len(edges) - 1)
+    names = [name.encode('utf-8') for name in ['t1', 't2', 'sfr']]
+    sfh = np.array(list(zip(edges[:-1], edges[1:], sfr)), list(zip(names, [float] * 3)))
+    lt, sfr = mod.bursty_sfh.burst_sfh(f_burst=0, sfh=sfh, bin_res=20.0)[:2]
+    ssp_ages = np.logspace(5.5, 10.15, nssp)
+    spec = np.array([synthetic_spectrum(nwave, age)[1] for age in ssp_ages])
+    wave = synthetic_spectrum(nwave)[0]
+    mass = np.ones(nssp)
+    return wave, spec, mass, [0.0001], ssp_ages, lt, sfr, 0
+
+
+def _dust_params(random_state, n):
+    # R_V, f_bump, A_V, dA_V of n typical regions
+    return (random_state.uniform(2., 5., n), random_state.uniform(0.2, 1.2, n),
+            random_state.uniform(0.2, 1.5, n), random_state.uniform(0., 1., n))
+
+
+def _case_ext_func(random_state, batch=1):
+    import model_rv_fbump
+    use_synthetic_sed()
+    rv, fb, av, dav = _dust_params(random_state, batch)
+    if batch == 1:
+        return lambda: model_rv_fbump.ext_func(rv[0], av[0], fb[0], att=model_rv_fbump.ATT), 1
+    return lambda: model_rv_fbump.ext_func(rv, av, fb, att=model_rv_fbump.ATT), batch
+
+
+def _case_ext_func_sfh(random_state):
+    sys.path.insert(0, os.path.join(_TOP_DIR, 'test_model_rv_fbump_condor'))
+    import model_rv_condor
+    spec_data = _sfh_spec_data(model_rv_condor, random_state)
+    intrinsic_data = model_rv_condor.no_dust(spec_data, None, None)
+    rv, fb, av, dav = _dust_params(random_state, 1)
+    def run():
+        model_rv_condor.ext_func(spec_data, intrinsic_data, rv[0], av[0], dav[0],
+                                 f_bump=fb[0], att=model_rv_condor.ATT)
+    return run, 1
+
+
+def _case_redden(random_state, nsplit=30):
+    import model_rv_condor_gooddust
+    wave, spec = synthetic_spectrum()
+    rv, fb, av, dav = _dust_params(random_state, 1)
+    def run():
+        model_rv_condor_gooddust.redden(wave, spec, av=av[0], dav=dav[0], rv=rv[0],
+                                        fbump=fb[0], nsplit=nsplit,
+                                        dust_curve=model_rv_condor_gooddust.ATT)
+    return run, 1
+
+
+def _case_flux_ratios(random_state, nsplit=30, batch=1000):
+    import sed_model
+    use_synthetic_sed()
+    rv, fb, av, dav = _dust_params(random_state, batch)
+    return lambda: sed_model.flux_ratios(rv, av, dav, fb, nsplit=nsplit), batch
+
+
+def _case_ensemble_lnlike(random_state, nregions=7000, nsamples=50):
+    import model_ensemble
+    grid = random_state.normal(3.1, 0.8, (nregions, nsamples))
+    theta = [3.1, 0.5]
+    return lambda: model_ensemble.lnlike(theta, grid), 1
+
+
+def _case_ensemble_simult_lnlike(random_state, nregions=7000, nsamples=50):
+    import numpy as np
+    import model_ensemble_simult
+    grid = np.dstack([random_state.normal(3.1, 0.8, (nregions, nsamples)),
+                      random_state.normal(0.7, 0.3, (nregions, nsamples))])
+    theta = [3.1, 0.7, -0.3, -1., 0.05]
+    return lambda: model_ensemble_simult.lnlike(theta, grid), 1
+
+
+class _Chains(object):
+    # the parts of a finished sampler that chain_io.write_region reads
+    def __init__(self, random_state, nwalkers=32, nsteps=1000, ndim=2):
+        self.chain = random_state.normal(size=(nwalkers, nsteps, ndim))
+        self.flatchain = self.chain.reshape(-1, ndim)
+        self.lnprobability = random_state.normal(size=(nwalkers, nsteps))
+
+
+def _case_write_region(random_state, thinned=False):
+    import h5py
+    import chain_io
+    import sampling
+    chains = _Chains(random_state)
+    if thinned:
+        nwalkers, nsteps, ndim = chains.chain.shape
+        summary = sampling.ChainSummary.from_burnin(chains.chain, nsteps)
+        for k in range(nsteps):
+            summary.add(chains.chain[:, k], chains.lnprobability[:, k])
+        chains = summary
+    fd, filename = tempfile.mkstemp(suffix='.h5')
+    os.close(fd)
+    hf = h5py.File(filename, 'w')
+    def cleanup():
+        hf.close()
+        os.remove(filename)
+    atexit.register(cleanup)
+    names = ('region_%06d' % i for i in range(10 ** 6))
+    def run():
+        chain_io.write_region(hf, next(names), chains, ['R_V', 'f_bump'], 1.)
+        hf.flush()
+    return run, 1
+
+
+def _gaussian_lnprob(theta):
+    # a cheap posterior, so the run_emcee cases time the schedule itself
+    return -0.5 * (theta ** 2).sum()
+
+
+def _case_run_emcee(random_state, thinned=False, nwalkers=32, ndim=2, nsteps=200):
+    # a whole fit: burn-in, final burn-in and production, no restarts
+    import emcee
+    import sampling
+    def run():
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, _gaussian_lnprob)
+        pos = sampling.initialize(random_state.normal(size=ndim), ndim, nwalkers,
+                                  random_state)
+        sampling.run_emcee(sampler, nsteps, nsteps, pos, ndim, nwalkers, n_restarts=0,
+                           thinned=thinned, random_state=random_state)
+    return run, 3 * nwalkers * nsteps
+
+
+# name, setup(random_state) returning (function to time, evaluations per call)
+CASES = [('ext_func', _case_ext_func),
+         ('ext_func_batch1000', lambda rs: _case_ext_func(rs, batch=1000)),
+         ('ext_func_sfh', _case_ext_func_sfh)]
+CASES += [('redden_nsplit%d' % n, lambda rs, n=n: _case_redden(rs, nsplit=n))
+          for n in (0, 9, 30, 100)]
+CASES += [('flux_ratios_nsplit%d' % n, lambda rs, n=n: _case_flux_ratios(rs, nsplit=n))
+          for n in (0, 9, 30, 100)]
+CASES += [('model_ensemble.lnlike', _case_ensemble_lnlike),
+          ('model_ensemble_simult.lnlike', _case_ensemble_simult_lnlike),
+          ('write_region', _case_write_region),
+          ('write_region_thinned', lambda rs: _case_write_region(rs, thinned=True)),
+          ('run_emcee', _case_run_emcee),
+          ('run_emcee_thinned', lambda rs: _case_run_emcee(rs, thinned=True))]
+
+
+def _peak_memory_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kB elsewhere
+    return peak / 2. ** 20 if sys.platform == 'darwin' else peak / 2. ** 10
+
+
+def _missing_module(e):
+    # top-level package an ImportError couldn't load (python 2's only says
+    # it in the message)
+    name = getattr(e, 'name', None) or str(e).split()[-1]
+    return name.split('.')[0]
+
+
+def run_case(name, min_time=1.0, seed=1):
+    """
+    Time one case of CASES in this process.
+
+    Returns
+    -------
+    result : dict ; 'rate' in evaluations per second and 'memory', the
+        peak resident memory of the process in MB (so run it in a fresh
+        interpreter, as bench_suite does), or 'skipped' with the reason if
+        one of OPTIONAL_MODULES is missing. Other import errors are raised,
+        since they're in the code being timed
+    """
+    import numpy as np
+    setup = dict(CASES)[name]
+    try:
+        run, nevals = setup(np.random.RandomState(seed))
+    except ImportError as e:
+        if _missing_module(e) not in OPTIONAL_MODULES:
+            raise
+        return {'skipped': str(e)}
+    # the first call builds the memoized parts
+    run()
+    ncalls, t0 = 0, time.time()
+    while ncalls < 3 or time.time() - t0 < min_time:
+        run()
+        ncalls += 1
+    rate = ncalls * nevals / (time.time() - t0)
+    return {'rate': rate, 'memory': _peak_memory_mb()}
+
+
+def _run_case_subprocess(name, min_time):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([_TOP_DIR, env.get('PYTHONPATH', '')])
+    env['MPLBACKEND'] = 'Agg'
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                   '--case', name, '--min_time', str(min_time)],
+                                  env=env, cwd=_TOP_DIR)
+    return json.loads(out.decode('utf-8').strip().split('\n')[-1])
+
+
+def load_baselines(filename=BASELINE_FILE):
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def bench_suite(cases=None, min_time=1.0, tolerance=0.25, save_baselines=False,
+                baseline_file=BASELINE_FILE):
+    """
+    Run the cases (default: all of CASES), each in a fresh interpreter, and
+    compare them with the baselines. A case fails if it errors, if its rate
+    is more than tolerance below its baseline, or if its memory is more than
+    tolerance (and 1 MB) above it. With save_baselines the results become
+    the new baselines. Returns the number of failures.
+    """
+    names = cases or [name for name, setup in CASES]
+    baselines = load_baselines(baseline_file)
+    results, failures = {}, 0
+    print('%-30s %12s %10s %12s  %s' % ('case', 'evals/s', 'MB', 'vs baseline', 'status'))
+    for name in names:
+        try:
+            result = _run_case_subprocess(name, min_time)
+        except subprocess.CalledProcessError:
+            print('%-30s %12s %10s %12s  %s' % (name, '-', '-', '-', 'FAIL (error)'))
+            failures += 1
+            continue
+        if 'skipped' in result:
+            print('%-30s %12s %10s %12s  %s' % (name, '-', '-', '-',
+                                                'skipped (' + result['skipped'] + ')'))
+            continue
+        results[name] = result
+        base = baselines.get(name)
+        status, ratio = 'ok', '-'
+        if base is None:
+            status = 'ok (no baseline)'
+        else:
+            ratio = '%.2fx' % (result['rate'] / base['rate'])
+            if result['rate'] < (1. - tolerance) * base['rate']:
+                status = 'FAIL (slower)'
+            elif result['memory'] > (1. + tolerance) * base['memory'] + 1.:
+                status = 'FAIL (memory %.1f MB)' % base['memory']
+        failures += status.startswith('FAIL')
+        print('%-30s %12.4g %10.1f %12s  %s' % (name, result['rate'], result['memory'],
+                                                 ratio, status))
+    if save_baselines:
+        baselines.update(results)
+        with open(baseline_file, 'w') as f:
+            json.dump(baselines, f, indent=1, sort_keys=True)
+        print('baselines saved to ' + baseline_file)
+    return failures
+
+
+def get_args():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--max_import_time', type=float, default=2.0, help='allowed import time of a worker module, in seconds')
+    parser.add_argument('--repeat', type=int, default=3, help='number of imports to take the best time from')
+    parser.add_argument('--grid_posterior', action='store_true', help='also compare the grid posteriors with emcee')
+    parser.add_argument('--npix', type=int, default=500, help='number of synthetic pixels for the grid posteriors')
+    parser.add_argument('--nmcmc', type=int, default=3, help='number of those also fit with emcee')
+    parser.add_argument('--suite', action='store_true', help='also run the benchmark suite of the forward models, likelihoods and output')
+    parser.add_argument('--cases', nargs='+', help='run only these cases of the suite')
+    parser.add_argument('--min_time', type=float, default=1.0, help='seconds to time each case for')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed fractional slowdown or memory growth against the baselines')
+    parser.add_argument('--save_baselines', action='store_true', help='save the results of the suite as the new baselines')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.case:
+        # one case of the suite, run by bench_suite in a fresh interpreter
+        print(json.dumps(run_case(args.case, min_time=args.min_time)))
+        sys.exit(0)
+    failures = bench_imports(max_import_time=args.max_import_time,
+                             repeat=args.repeat)
+    if args.grid_posterior:
+        print('')
+        failures += bench_grid_posterior(npix=args.npix, nmcmc=args.nmcmc)
+    if args.suite:
+        print('')
+        failures += bench_suite(cases=args.cases, min_time=args.min_time,
+                                tolerance=args.tolerance,
+                                save_baselines=args.save_baselines)
+    sys.exit(1 if failures else 0)
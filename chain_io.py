@@ -0,0 +1,213 @@
+"""
+Reading and writing the per-region emcee results.
+
+Every fit writes one HDF5 group per region ('region_00001', ...) holding
+the chain, the flattened chain, ln(prob), the [16, 50, 84] percentiles of
+each parameter and the run time. The chains are stored with the precision
+set in compile_data (compile_data.set_precision), while the percentiles are
+always computed from the float64 samples the sampler holds in memory.
+A thinned run (sampling.run_emcee with thinned=True) or a grid posterior
+is written by write_summary instead, at a fraction of the size.
+
+A region only gets its group once its fit has finished, so a results file
+never holds a partial region. While a fit runs, its sampler state is kept
+in a Checkpoint in a separate file next to the results (see
+checkpoint_file), and a rerun skips the finished regions and resumes the
+others from their last checkpoint. The interrupted region is resumed
+exactly. The regions after it only get the same chains as in an
+uninterrupted run when the fit is seeded (--seed), since without a seed
+each region starts from the walkers and global random state the previous
+ones left, and a skipped region leaves neither.
+"""
+import os
+import sys
+import numpy as np
+
+
+PERCENTILES = [16, 50, 84]
+
+CHECKPOINT_SUFFIX = '.ckpt'
+
+
+def _precision():
+    # compile_data.FLOAT, without importing compile_data (and the map
+    # packages it needs) here: if no fit has loaded it, set_precision was
+    # never called and the chains are float64
+    compile_data = sys.modules.get('compile_data')
+    return compile_data.FLOAT if compile_data is not None else np.float64
+
+
+def region_name(i, z):
+    """ Group name of region number i, zero-padded to z digits. """
+    return 'region_' + str(i).zfill(z)
+
+
+def write_region(hf, region, sampler, labs, run_time, attrs=None):
+    """
+    Write the results of one region to an open HDF5 file.
+
+    Parameters
+    ----------
+    hf : h5py.File or h5py.Group
+    region : str ; name of the group to create
+    sampler : emcee.EnsembleSampler, or a summary of the posterior
+        (sampling.ChainSummary, grid_posterior.PixelPosterior) ; after the
+        production run
+    labs : list ; names of the parameters, one per dimension
+    run_time : float ; seconds taken by the fit
+    attrs : dict, optional ; kept as attributes of the group, e.g. the
+        schedule and timings of the run (see sampling.run_emcee's record)
+
+    Returns
+    -------
+    g : h5py.Group ; the new group
+    """
+    if hasattr(sampler, 'percentiles'):
+        return write_summary(hf, region, sampler, labs, run_time, attrs)
+    dtype = _precision()
+    flatchain = sampler.flatchain
+    g = hf.create_group(region)
+    g.create_dataset('sampler_chain', data=np.asarray(sampler.chain, dtype=dtype))
+    g.create_dataset('sampler_flatchain', data=np.asarray(flatchain, dtype=dtype))
+    g.create_dataset('sampler_lnprob', data=np.asarray(sampler.lnprobability, dtype=dtype))
+    for d, lab in enumerate(labs):
+        g.create_dataset(lab, data=np.percentile(flatchain[:,d], PERCENTILES))
+    g.create_dataset('run_time', data=np.around(run_time, 2))
+    for key, val in (attrs or {}).items():
+        g.attrs[key] = val
+    return g
+
+
+def write_summary(hf, region, summary, labs, run_time, attrs=None):
+    """
+    Write a summary of the posterior of one region: a thinned production
+    run (sampling.ChainSummary) or a grid posterior
+    (grid_posterior.PixelPosterior).
+
+    The group has the same sampler_chain, sampler_flatchain,
+    sampler_lnprob, percentile and run_time datasets as write_region's, so
+    the scripts reading the results work on either, but the chains and
+    ln(prob) hold a subset of the samples and the percentiles come from all
+    of them. summary.attrs (e.g. the thinning) and attrs are kept as
+    attributes of the group.
+    """
+    dtype = _precision()
+    g = hf.create_group(region)
+    g.create_dataset('sampler_chain', data=np.asarray(summary.chain, dtype=dtype))
+    g.create_dataset('sampler_flatchain', data=np.asarray(summary.flatchain, dtype=dtype))
+    g.create_dataset('sampler_lnprob', data=np.asarray(summary.lnprobability, dtype=dtype))
+    for d, lab in enumerate(labs):
+        g.create_dataset(lab, data=summary.percentiles(d, PERCENTILES))
+    g.create_dataset('run_time', data=np.around(run_time, 2))
+    for key, val in list(summary.attrs.items()) + list((attrs or {}).items()):
+        g.attrs[key] = val
+    return g
+
+
+def read_chain(g):
+    """
+    The (nwalkers, nsteps, ndim) chain of a region's group, as written by
+    either write_region or write_summary. Results written before
+    write_summary kept sampler_chain only have the flatchain, which is
+    reshaped.
+    """
+    if 'sampler_chain' in g:
+        return g['sampler_chain'][...]
+    nwalkers = g['sampler_lnprob'].shape[0]
+    flatchain = g['sampler_flatchain'][...]
+    return flatchain.reshape(nwalkers, -1, flatchain.shape[-1])
+
+
+def checkpoint_file(filename):
+    """ File holding the checkpoints of the fits written to filename. """
+    return filename + CHECKPOINT_SUFFIX
+
+
+def has_region(filename, region):
+    """ True if filename exists and holds the finished results of region. """
+    import h5py
+    if not os.path.exists(filename):
+        return False
+    with h5py.File(filename, 'r') as hf:
+        return region in hf
+
+
+def _write_random_state(g, name, state):
+    # numpy RandomState.get_state() tuple: (name, keys, pos, has_gauss, cached)
+    d = g.create_dataset(name, data=state[1])
+    d.attrs['bit_generator'] = state[0]
+    d.attrs['pos'] = state[2]
+    d.attrs['has_gauss'] = state[3]
+    d.attrs['cached_gaussian'] = state[4]
+
+
+def _read_random_state(g, name):
+    d = g[name]
+    return (str(d.attrs['bit_generator']), d[...], int(d.attrs['pos']),
+            int(d.attrs['has_gauss']), float(d.attrs['cached_gaussian']))
+
+
+class Checkpoint(object):
+    """
+    Sampler state of one region between the phases of sampling.run_emcee:
+    the index of the next phase, the walker positions it starts from, the
+    states of the sampler's random generator and of the one that draws the
+    restart positions (numpy's global one, unless run_emcee is given its
+    own) and a dict of small arrays the next phase needs (info). Resuming
+    from it gives the region the same chain as an uninterrupted run.
+
+    The file is opened and closed on every save, so that what's on disk is
+    complete whenever the job is killed.
+
+    Parameters
+    ----------
+    filename : str ; checkpoint file, see checkpoint_file
+    region : str ; name of the region's group
+    """
+    def __init__(self, filename, region):
+        self.filename = filename
+        self.region = region
+
+    def load(self):
+        """
+        The saved (phase, pos, sampler_state, restart_state, info), or None
+        if there isn't one.
+        """
+        import h5py
+        if not os.path.exists(self.filename):
+            return None
+        with h5py.File(self.filename, 'r') as hf:
+            if self.region not in hf:
+                return None
+            g = hf[self.region]
+            info = dict((key, d[()]) for key, d in g['info'].items())
+            return (int(g.attrs['phase']), g['pos'][...],
+                    _read_random_state(g, 'sampler_state'),
+                    _read_random_state(g, 'restart_state'), info)
+
+    def save(self, phase, pos, sampler_state, restart_state, info=None):
+        import h5py
+        with h5py.File(self.filename, 'a') as hf:
+            if self.region in hf:
+                del hf[self.region]
+            g = hf.create_group(self.region)
+            g.attrs['phase'] = phase
+            g.create_dataset('pos', data=np.asarray(pos, dtype=float))
+            _write_random_state(g, 'sampler_state', sampler_state)
+            _write_random_state(g, 'restart_state', restart_state)
+            # anything else the next phase needs, e.g. how to thin
+            gi = g.create_group('info')
+            for key, val in (info or {}).items():
+                gi.create_dataset(key, data=val)
+
+    def clear(self):
+        """ Drop the checkpoint, once the region's results are written. """
+        import h5py
+        if not os.path.exists(self.filename):
+            return
+        with h5py.File(self.filename, 'a') as hf:
+            if self.region in hf:
+                del hf[self.region]
+            empty = len(hf) == 0
+        if empty:
+            os.remove(self.filename)
@@ -1,10 +1,17 @@
 import os, sys
+import json
 import astrogrid
 import astropy.io.fits as pyfits
 import numpy as np
 import astropy.units as u
 import astropy.constants as const
 import scipy.ndimage as sp
+import photometry
+from functools import partial
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 
 from pdb import set_trace
 
@@ -18,6 +25,63 @@ MJYSR2JYARCSEC = 2.350443e-5
 ALPHA_FUV = 8.0e-4
 ALPHA_24MICRON = 0.1
 
+# type the maps are loaded and cached as; see set_precision
+FLOAT = np.float64
+
+# foreground-corrected observed maps from gather_map_data_agelim, by
+# (res, correct_obs, factor)
+CORRECTED_OBS = {}
+
+# map cubes written by build_map_cube
+CUBE_FILE = 'map_cube.h5'
+AGELIM_CUBE_FILE = 'map_cube_agelim.h5'
+
+
+def set_precision(precision='float64'):
+    """
+    Set the floating point type of the maps (and, in chain_io, of the stored
+    chains): 'float64' or 'float32'. float32 halves the memory and I/O; the
+    per-region data handed to the likelihoods are still float64.
+    """
+    global FLOAT
+    FLOAT = np.dtype(precision).type
+    if FLOAT not in (np.float32, np.float64):
+        raise ValueError('precision must be float32 or float64, not ' + str(precision))
+    CORRECTED_OBS.clear()
+
+
+def nan_box_mean(data, size=3, mode='reflect'):
+    """
+    Mean over a size x size box around every pixel, ignoring NaNs.
+
+    Same result as generic_filter(data, np.nanmean, size=size), but done as
+    two uniform_filter passes (the sum of the finite values and the number of
+    finite values) instead of a Python call per pixel. Pixels whose box has
+    no finite values come back as NaN.
+
+    Parameters
+    ----------
+    data : array ; map to smooth
+    size : int, optional ; width of the box in pixels
+    mode : str, optional ; how the edges are handled, as in scipy.ndimage
+
+    Returns
+    -------
+    mean : array ; smoothed map, same shape as data
+    """
+    data = np.asarray(data, dtype=float)
+    good = ~np.isnan(data)
+    # both passes are box means, so the box size divides out
+    total = sp.uniform_filter(np.where(good, data, 0.), size=size, mode=mode)
+    count = sp.uniform_filter(good.astype(float), size=size, mode=mode)
+    # count is a multiple of 1/size**ndim, up to rounding
+    empty = count < 0.5 / size**data.ndim
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+    mean[empty] = np.nan
+    return mean
+
+
 def define_dir_structure(res):
     if os.environ['PATH'][1:6] == 'astro':
         _TOP_DIR = '/astro/store/phat/arlewis/'
@@ -33,111 +97,410 @@ def define_dir_structure(res):
     return _DATA_DIR, _WORK_DIR, _MOD_DIR
 
 
-def gather_map_data(res='90', dust_curve='cardelli', sfh='full_sfh'):
-
-    _DATA_DIR, _WORK_DIR, _MOD_DIR = define_dir_structure(res)
-
-    obsfiles = ['galex_fuv_final.fits', 'galex_nuv_final.fits']
-
-    modfiles = ['mod_fuv_red.fits', 'mod_fuv_int.fits',
-                'mod_nuv_red.fits', 'mod_nuv_int.fits',
-                'mod_fuv_red_uncs_lower.fits', 'mod_fuv_red_uncs_upper.fits',
-                'mod_fuv_int_uncs_lower.fits', 'mod_fuv_int_uncs_upper.fits',
-                'mod_nuv_red_uncs_lower.fits', 'mod_nuv_red_uncs_upper.fits',
-                'mod_nuv_int_uncs_lower.fits', 'mod_nuv_int_uncs_upper.fits']
-
-    otherfiles = ['sfr100.fits', 'dust.fits', 'dust_av.fits','dust_dav.fits',
-                  'irac1_mass.fits', 'mips_24_MJysr.fits']
-
-    uvdustfiles = ['A_nuv.fits', 'A_fuv.fits']
-
-
-    weightfile = os.path.join(_DATA_DIR, 'weights_orig.fits')
-    w, h = pyfits.getdata(weightfile, header=True)
+class LazyMaps(MutableMapping):
+    """
+    Dictionary of maps that are only read (or computed) when first asked for.
+
+    Each key has a loader, a function of no arguments that returns the map.
+    The loader is called on the first lookup and its result is kept, so later
+    lookups are free. Setting a key stores the value directly.
+    """
+    def __init__(self, loaders=None):
+        self._loaders = dict(loaders or {})
+        self._maps = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._maps[key]
+        except KeyError:
+            pass
+        data = self._loaders[key]()
+        self._maps[key] = data
+        return data
+
+    def __setitem__(self, key, value):
+        self._maps[key] = value
+        self._loaders.setdefault(key, None)
+
+    def __delitem__(self, key):
+        del self._loaders[key]
+        self._maps.pop(key, None)
+
+    def __iter__(self):
+        return iter(self._loaders)
+
+    def __len__(self):
+        return len(self._loaders)
+
+    def add(self, key, loader):
+        """ Register a loader for `key`, dropping any value already read. """
+        self._loaders[key] = loader
+        self._maps.pop(key, None)
+
+    def loaded(self):
+        """ Keys that have been read so far. """
+        return list(self._maps)
+
+
+def read_map(filename, w, sel):
+    """
+    Read a map (memory-mapped), apply the weights and blank the pixels
+    outside the weight mask.
+    """
+    data = np.array(pyfits.getdata(filename, memmap=True), dtype=FLOAT)
+    data *= w
+    data[sel] = np.nan
+    return data
+
+
+def stack_maps(files, w, sel):
+    """
+    Read a set of maps into one preallocated (nmaps, ny, nx) array, then
+    weight and mask all of them at once.
+
+    Each FITS file is copied straight from its memory map into its layer,
+    so the only full-size array made is the stack itself.
+
+    Parameters
+    ----------
+    files : dict ; layer name -> FITS file
+    w, sel : weights and zero-weight mask, as from read_weights
+
+    Returns
+    -------
+    stack : (nmaps, ny, nx) array
+    maps : dict ; layer name -> view of its layer in the stack
+    """
+    layers = sorted(files)
+    stack = np.empty((len(layers),) + w.shape, dtype=FLOAT)
+    for i, key in enumerate(layers):
+        stack[i] = pyfits.getdata(files[key], memmap=True)
+    stack *= w
+    stack[:, sel] = np.nan
+    return stack, dict(zip(layers, stack))
+
+
+def read_weights(data_dir):
+    """
+    Weight map and header. Pixels with partial coverage (w < 0.95) get zero
+    weight. Returns w, h, and the mask of zero-weight pixels.
+    """
+    w, h = pyfits.getdata(os.path.join(data_dir, 'weights_orig.fits'), header=True)
     w[(w > 0) & (w < 0.95)] = 0
-    sel = (w == 0)
-
-    fuvfluxobs, nuvfluxobs = [pyfits.getdata(os.path.join(_DATA_DIR, x)) * w for x in obsfiles[0:2]]
-
-    fuvfluxmodred, fuvfluxmodint = [pyfits.getdata(os.path.join(_DATA_DIR,
-        dust_curve, sfh, x)) * w for x in modfiles[0:2]]
-
-    nuvfluxmodred, nuvfluxmodint = [pyfits.getdata(os.path.join(_DATA_DIR,
-        dust_curve, sfh, x)) * w for x in modfiles[2:4]]
-
-    fuvfluxmodred_lower, fuvfluxmodred_upper = [pyfits.getdata(os.path.join(_DATA_DIR, dust_curve, sfh, x)) * w for x in modfiles[4:6]]
-
-    fuvfluxmodint_lower, fuvfluxmodint_upper = [pyfits.getdata(os.path.join(_DATA_DIR, dust_curve, sfh, x)) * w for x in modfiles[6:8]]
-
-    nuvfluxmodred_lower, nuvfluxmodred_upper = [pyfits.getdata(os.path.join(_DATA_DIR, dust_curve, sfh, x)) * w for x in modfiles[8:10]]
-
-    nuvfluxmodint_lower, nuvfluxmodint_upper = [pyfits.getdata(os.path.join(_DATA_DIR, dust_curve, sfh, x)) * w for x in modfiles[10:12]]
-
-    sfr100, avdav, av, dav, irac1mass, mips24 = [pyfits.getdata(os.path.join(_DATA_DIR, x)) * w for x in otherfiles]
-
-    anuv, afuv = [pyfits.getdata(os.path.join(_WORK_DIR, x)) * w
-                  for x in uvdustfiles]
-
-    for data in [fuvfluxobs, nuvfluxobs, fuvfluxobs_bg, nuvfluxobs_bg,
-                 fuvfluxobs_nobg, nuvfluxobs_nobg, fuvfluxmodint,
-                 nuvfluxmodint, fuvfluxmodred, nuvfluxmodred,
-                 fuvfluxmodred_lower, fuvfluxmodred_upper,
-                 fuvfluxmodint_lower, fuvfluxmodint_upper,
-                 nuvfluxmodred_lower, nuvfluxmodred_upper,
-                 nuvfluxmodint_lower, nuvfluxmodint_upper,
-                 sfr100, avdav, av, dav,  irac1mass, mips24, anuv, afuv]:
-        data[sel] = np.nan
-
-    sSFR = sfr100/irac1mass
+    return w, h, (w == 0)
+
+
+def _file_loaders(files, w, sel):
+    # key -> filename, to key -> loader
+    return dict((key, partial(read_map, f, w, sel)) for key, f in files.items())
+
+
+def _cube_is_current(cubefile, files):
+    """
+    True if the cube exists, was built from exactly these files, none of
+    which has been modified since, and holds the maps in the current
+    precision (FLOAT).
+    """
+    import h5py
+    if not os.path.exists(cubefile):
+        return False
+    with h5py.File(cubefile, 'r') as hf:
+        mtimes = json.loads(hf.attrs['mtimes'])
+        dtype = hf.attrs.get('dtype')
+    # a float32 cube would round the maps of a float64 run
+    if dtype != np.dtype(FLOAT).name:
+        return False
+    if sorted(mtimes) != sorted(files):
+        return False
+    return all(mtimes[key] == os.path.getmtime(f) for key, f in files.items())
+
+
+def _temp_file(path):
+    # unique to this process, so builders running at once (e.g. the workers
+    # of a pool) never write into each other's file before the rename
+    return '%s.%d.tmp' % (path, os.getpid())
+
+
+def build_map_cube(cubefile, files, data_dir, force=False):
+    """
+    Pack a set of maps into one HDF5 cube so they can be loaded with a single
+    read.
+
+    Every map is weighted and masked as in stack_maps and stored as one layer
+    of the 'maps' dataset, one chunk per layer. The weight map, the FITS
+    header and the modification time of every source file go in with them.
+    The cube is only rebuilt if a source file has changed, the set of files
+    is different (files that don't exist are left out) or the precision
+    (set_precision) isn't the one it was built in.
+
+    Parameters
+    ----------
+    cubefile : str ; path of the HDF5 cube
+    files : dict ; layer name -> FITS file
+    data_dir : str ; directory holding weights_orig.fits
+    force : bool, optional ; rebuild even if the cube is up to date
+
+    Returns
+    -------
+    cubefile : str
+    """
+    import h5py
+    weightfile = os.path.join(data_dir, 'weights_orig.fits')
+    files = dict((k, f) for k, f in files.items() if os.path.exists(f))
+    sources = dict(files, weights=weightfile)
+    if not force and _cube_is_current(cubefile, sources):
+        return cubefile
+
+    w, h, sel = read_weights(data_dir)
+    stack, maps = stack_maps(files, w, sel)
+    tmpfile = _temp_file(cubefile)
+    with h5py.File(tmpfile, 'w') as hf:
+        hf.create_dataset('maps', data=stack, chunks=(1,) + w.shape)
+        hf.create_dataset('weights', data=w)
+        hf.attrs['layers'] = json.dumps(sorted(maps))
+        hf.attrs['header'] = h.tostring()
+        hf.attrs['mtimes'] = json.dumps(dict((k, os.path.getmtime(f)) for k, f in sources.items()))
+        hf.attrs['dtype'] = np.dtype(FLOAT).name
+    os.rename(tmpfile, cubefile)
+    return cubefile
+
+
+def load_map_cube(cubefile):
+    """
+    Read every layer of a cube made by build_map_cube in one go.
+
+    Returns
+    -------
+    maps : dict ; layer name -> map
+    w, h, sel : weights, FITS header and zero-weight mask, as in read_weights
+    """
+    import h5py
+    with h5py.File(cubefile, 'r') as hf:
+        layers = json.loads(hf.attrs['layers'])
+        # converted to FLOAT as it's read, whatever the cube was written as
+        cube = np.empty(hf['maps'].shape, dtype=FLOAT)
+        hf['maps'].read_direct(cube)
+        w = hf['weights'][...]
+        h = pyfits.Header.fromstring(hf.attrs['header'])
+    maps = dict(zip(layers, cube))
+    return maps, w, h, (w == 0)
+
+
+def block_sum(data, factor):
+    """
+    Sum over factor x factor blocks of pixels in the last two axes. Rows and
+    columns past the last whole block are dropped. A block with any NaN
+    pixel is NaN.
+    """
+    ny, nx = [(n // factor) * factor for n in data.shape[-2:]]
+    data = data[..., :ny, :nx]
+    shape = data.shape[:-2] + (ny // factor, factor, nx // factor, factor)
+    return data.reshape(shape).sum(axis=-1).sum(axis=-2)
+
+
+def coarsen_header(h, factor):
+    """
+    Copy of a FITS header for a map binned by block_sum: the pixel scale
+    grows by factor and the reference pixel moves to match.
+    """
+    h = h.copy()
+    for i in [1, 2]:
+        key = 'CRPIX%d' % i
+        if key in h:
+            h[key] = (h[key] - 0.5) / factor + 0.5
+        key = 'CDELT%d' % i
+        if key in h:
+            h[key] = h[key] * factor
+        for j in [1, 2]:
+            key = 'CD%d_%d' % (i, j)
+            if key in h:
+                h[key] = h[key] * factor
+        key = 'NAXIS%d' % i
+        if key in h:
+            h[key] = h[key] // factor
+    return h
+
+
+# per-pixel totals besides the fluxes (layers named flux*), summed when
+# the maps are binned
+EXTENSIVE = set(['irac1mass'])
+
+
+def _is_extensive(layer):
+    # fluxes and masses add up over a block; everything else (SFR, dust,
+    # surface brightness) is an average over the pixel
+    name = layer.split('/')[-1]
+    return name.startswith('flux') or name in EXTENSIVE
+
+
+def build_coarse_cube(cubefile, factor, force=False):
+    """
+    One level of the resolution pyramid: the maps in a cube made by
+    build_map_cube, binned into factor x factor blocks of pixels.
+
+    Fluxes (layers named flux*) and the other extensive maps (EXTENSIVE,
+    e.g. the stellar mass) are summed over each block. All other maps
+    are averaged with the weight map as the weights. The fine maps were
+    already multiplied by the weights, so the average is just the block sum
+    divided by the summed weights. Blocks that contain a masked pixel are
+    masked. The coarse cube is written next to the fine one, as
+    <name>_x<factor>.h5, and is rebuilt whenever the fine cube changes or
+    the precision does.
+
+    Returns
+    -------
+    coarsefile : str ; path of the coarse cube
+    """
+    import h5py
+    coarsefile = cubefile.replace('.h5', '_x%d.h5' % factor)
+    if not force and _cube_is_current(coarsefile, {'cube': cubefile}):
+        return coarsefile
+
+    maps, w, h, sel = load_map_cube(cubefile)
+    layers = sorted(maps)
+    # summed in double precision whatever the maps are stored as
+    stack = block_sum(np.asarray([maps[key] for key in layers], dtype=float), factor)
+    wsum = block_sum(w, factor)
+    for i, key in enumerate(layers):
+        if not _is_extensive(key):
+            stack[i] /= wsum
+    wcoarse = wsum / factor**2
+    wcoarse[block_sum(sel.astype(float), factor) > 0] = 0
+
+    tmpfile = _temp_file(coarsefile)
+    with h5py.File(tmpfile, 'w') as hf:
+        hf.create_dataset('maps', data=stack.astype(FLOAT), chunks=(1,) + wcoarse.shape)
+        hf.create_dataset('weights', data=wcoarse)
+        hf.attrs['layers'] = json.dumps(layers)
+        hf.attrs['header'] = coarsen_header(h, factor).tostring()
+        hf.attrs['mtimes'] = json.dumps({'cube': os.path.getmtime(cubefile)})
+        hf.attrs['factor'] = factor
+        hf.attrs['dtype'] = np.dtype(FLOAT).name
+    os.rename(tmpfile, coarsefile)
+    return coarsefile
+
+
+def build_pyramid(res='90', dust_curve='cardelli', sfh='full_sfh', factors=[2, 4, 8]):
+    """
+    Make (or bring up to date) the map cube for gather_map_data at the given
+    resolution and a coarser cube for each block factor. Returns the paths
+    of the cubes, finest first.
+    """
+    _DATA_DIR, _WORK_DIR, _MOD_DIR = define_dir_structure(res)
+    gather_map_data(res, dust_curve, sfh, use_cache=True)
+    cubefile = os.path.join(_DATA_DIR, dust_curve, sfh, CUBE_FILE)
+    return [cubefile] + [build_coarse_cube(cubefile, f) for f in factors]
+
+
+def _map_loaders(groups, data_dir, cubefile=None, preload=False, factor=1):
+    """
+    Loaders for several groups of maps ({group: {key: filename}}). Each map
+    is read from its FITS file on first use, unless cubefile is given (all
+    maps come from the cube) or preload is set (all maps are read now into
+    one stack, see stack_maps). If factor > 1 the maps come from the
+    matching coarse level of the cube (see build_coarse_cube).
+
+    Returns
+    -------
+    loaders : dict ; group -> {key: loader}
+    w, h, sel : as in read_weights
+    """
+    if cubefile is None and not preload:
+        w, h, sel = read_weights(data_dir)
+        return dict((g, _file_loaders(files, w, sel)) for g, files in groups.items()), w, h, sel
+
+    flat = {}
+    for g, files in groups.items():
+        for key, f in files.items():
+            flat[g + '/' + key] = f
+    if cubefile is None:
+        w, h, sel = read_weights(data_dir)
+        flat = dict((k, f) for k, f in flat.items() if os.path.exists(f))
+        stack, maps = stack_maps(flat, w, sel)
+    else:
+        cubefile = build_map_cube(cubefile, flat, data_dir)
+        if factor > 1:
+            cubefile = build_coarse_cube(cubefile, factor)
+        maps, w, h, sel = load_map_cube(cubefile)
+    loaders = {}
+    for g, files in groups.items():
+        loaders[g] = dict((key, partial(maps.__getitem__, g + '/' + key))
+                          for key in files if g + '/' + key in maps)
+    return loaders, w, h, sel
+
+
+def gather_map_data(res='90', dust_curve='cardelli', sfh='full_sfh', use_cache=False,
+                    preload=False, factor=1):
+    """
+    FUV, NUV and ancillary maps at a given resolution.
+
+    The three returned dictionaries are LazyMaps: each map is read from its
+    FITS file (memory-mapped, weighted and masked) the first time it is used,
+    and magnitudes and sSFR are computed when first asked for.
+
+    If use_cache, all of the maps are instead read at once from an HDF5 cube
+    in the <dust_curve>/<sfh> directory, which is (re)built from the FITS
+    files whenever one of them changes. See build_map_cube. If preload, all
+    of the FITS files are read now into one stack (see stack_maps), which is
+    faster than reading them one at a time when most of them will be used.
+
+    factor > 1 gives the maps binned into factor x factor blocks of pixels,
+    from a cached level of the resolution pyramid (see build_coarse_cube);
+    this implies use_cache.
+    """
+    _DATA_DIR, _WORK_DIR, _MOD_DIR = define_dir_structure(res)
+    _SFH_DIR = os.path.join(_DATA_DIR, dust_curve, sfh)
+
+    fuvfiles = {'fluxobs': os.path.join(_DATA_DIR, 'galex_fuv_final.fits'),
+                'fluxobs_bg': os.path.join(_DATA_DIR, 'galex_fuv0.fits'),
+                'fluxobs_nobg': os.path.join(_DATA_DIR, 'galex_fuv_nobgsub.fits'),
+                'ext': os.path.join(_WORK_DIR, 'A_fuv.fits')}
+    nuvfiles = {'fluxobs': os.path.join(_DATA_DIR, 'galex_nuv_final.fits'),
+                'fluxobs_bg': os.path.join(_DATA_DIR, 'galex_nuv0.fits'),
+                'fluxobs_nobg': os.path.join(_DATA_DIR, 'galex_nuv_nobgsub.fits'),
+                'ext': os.path.join(_WORK_DIR, 'A_nuv.fits')}
+    for band, files in [('fuv', fuvfiles), ('nuv', nuvfiles)]:
+        for mod in ['red', 'int']:
+            files['fluxmod' + mod] = os.path.join(_SFH_DIR, 'mod_%s_%s.fits' % (band, mod))
+            for lim in ['lower', 'upper']:
+                files['fluxmod%s_%s' % (mod, lim)] = os.path.join(_SFH_DIR, 'mod_%s_%s_uncs_%s.fits' % (band, mod, lim))
+
+    otherfiles = {'sfr100': 'sfr100.fits', 'avdav': 'dust.fits',
+                  'av': 'dust_av.fits', 'dav': 'dust_dav.fits',
+                  'irac1mass': 'irac1_mass.fits',
+                  'mips24_MJysr': 'mips_24_MJysr.fits'}
+    otherfiles = dict((k, os.path.join(_DATA_DIR, f)) for k, f in otherfiles.items())
+
+    cubefile = os.path.join(_SFH_DIR, CUBE_FILE) if use_cache or factor > 1 else None
+    loaders, w, h, sel = _map_loaders({'fuv': fuvfiles, 'nuv': nuvfiles,
+                                       'other': otherfiles}, _DATA_DIR,
+                                      cubefile, preload=preload, factor=factor)
+    fuvdata = LazyMaps(loaders['fuv'])
+    nuvdata = LazyMaps(loaders['nuv'])
+    otherdata = LazyMaps(loaders['other'])
+
+    for data, band in [(fuvdata, 'galex_fuv'), (nuvdata, 'galex_nuv')]:
+        for kind in ['obs', 'modint', 'modred']:
+            data.add('mag' + kind, partial(_flux2mag, data, 'flux' + kind, band))
+
+    def mips24():
+        #convert 24 micron from MJy/sr to Jy/arcsec**2, then to Jy/pix
+        dx, dy = astrogrid.wcs.calc_pixscale(h, ref='crpix').arcsec
+        pixel_area = dx * dy
+        # mips24 map is in Jy --> convert to erg s-1 cm-2 A-1
+        # nu f_nu = lambda f_lambda so f_lambda = c/lambda^2 f_nu
+        mips24 = otherdata['mips24_MJysr'].copy()
+        mips24 *= MJYSR2JYARCSEC * pixel_area * 1e-23 * C / MIPS24_LAMBDA**2
+        return mips24
 
+    otherdata.add('mips24', mips24)
+    otherdata.add('sSFR', lambda: otherdata['sfr100'] / otherdata['irac1mass'])
 
-    #convert 24 micron from MJy/sr to Jy/arcsec**2
-    mips24 *= 2.350443e-5
-    dx, dy = astrogrid.wcs.calc_pixscale(h, ref='crpix').arcsec
-    pixel_area = dx * dy
-    ## convert to Jy/pix
-    mips24 *= pixel_area
-    # mips24 map is in Jy --> convert to erg s-1 cm-2 A-1
-    # nu f_nu = lambda f_lambda so f_lambda = c/lambda^2 f_nu
-
-    mips24 *= 1e-23 #convert to erg s-1 cm-2 Hz-1
-    c = const.c.to('angstrom/s').value
-    l = (24 * u.micron).to(u.angstrom).value
-    mips24 = c / l**2 * mips24
-
-
-    fuvmagobs = astrogrid.flux.galex_flux2mag(fuvfluxobs, 'galex_fuv')
-    fuvmagmodint = astrogrid.flux.galex_flux2mag(fuvfluxmodint, 'galex_fuv')
-    fuvmagmodred = astrogrid.flux.galex_flux2mag(fuvfluxmodred, 'galex_fuv')
-    nuvmagobs = astrogrid.flux.galex_flux2mag(nuvfluxobs, 'galex_nuv')
-    nuvmagmodint = astrogrid.flux.galex_flux2mag(nuvfluxmodint, 'galex_nuv')
-    nuvmagmodred = astrogrid.flux.galex_flux2mag(nuvfluxmodred, 'galex_nuv')
-
-
-    fuvdata = {'fluxobs':fuvfluxobs, 'fluxobs_nobg':fuvfluxobs_nobg,
-               'fluxobs_bg':fuvfluxobs_bg, 'fluxmodint':fuvfluxmodint,
-               'fluxmodred':fuvfluxmodred,
-               'fluxmodred_lower': fuvfluxmodred_lower,
-               'fluxmodred_upper': fuvfluxmodred_upper,
-               'fluxmodint_lower': fuvfluxmodint_lower,
-               'fluxmodint_upper': fuvfluxmodint_upper,
-               'magobs':fuvmagobs, 'magmodint':fuvmagmodint,
-               'magmodred':fuvmagmodred, 'ext':afuv}
-    nuvdata = {'fluxobs':nuvfluxobs, 'fluxobs_nobg':nuvfluxobs_nobg,
-               'fluxobs_bg':nuvfluxobs_bg, 'fluxmodint':nuvfluxmodint,
-               'fluxmodred':nuvfluxmodred,
-               'fluxmodred_lower': nuvfluxmodred_lower,
-               'fluxmodred_upper': nuvfluxmodred_upper,
-               'fluxmodint_lower': nuvfluxmodint_lower,
-               'fluxmodint_upper': nuvfluxmodint_upper,
-               'magobs':nuvmagobs,
-               'magmodint':nuvmagmodint, 'magmodred':nuvmagmodred, 'ext':anuv}
-
-    otherdata = {'sfr100':sfr100, 'avdav':avdav, 'av':av, 'dav':dav,
-                 'irac1mass':irac1mass, 'sSFR':sSFR, 'mips24':mips24}
+    return fuvdata, nuvdata, otherdata
 
 
-    return fuvdata, nuvdata, otherdata
+def _flux2mag(data, key, band):
+    return photometry.galex_flux2mag(data[key], band, dtype=FLOAT)
 
 
 def gather_sfh(res, sfhcube='sfr_evo_cube.fits', metalcube=None):
@@ -159,192 +522,130 @@ def gather_sfh(res, sfhcube='sfr_evo_cube.fits', metalcube=None):
     return sfhcube, sfhcube_upper, sfhcube_lower, sfhhdr
 
 
-def gather_map_data_agelim(res='90', dust_curve='cardelli', sfh='full_sfh', correct_obs=False):
+def gather_map_data_agelim(res='90', dust_curve='cardelli', sfh='full_sfh', correct_obs=False, use_cache=False, preload=False, factor=1):
+    """
+    FUV and NUV maps with the model fluxes from stars younger than a set of
+    age limits (e.g. 'fluxmodred500' for < 500 Myr). The observed maps have
+    foreground stars replaced by the local mean and, if correct_obs, the
+    emission from old stars removed.
+
+    The returned dictionaries are LazyMaps, as in gather_map_data. The
+    observed fluxes and the 24 micron map are corrected together the first
+    time any of them is used.
 
+    use_cache, preload and factor are as in gather_map_data; the cube is
+    kept in the res_<res>pc directory.
+    """
     _DATA_DIR, _WORK_DIR, _MOD_DIR = define_dir_structure(res)
 
-    obsfiles = ['galex_fuv_test.fits', 'galex_nuv_test.fits']
-
-    fuvmodfiles = ['mod_fuv_red.fits', 'mod_fuv_int.fits',
-                   'mod_fuv_red_8000.fits', 'mod_fuv_red_5000.fits',
-                   'mod_fuv_red_4000.fits', 'mod_fuv_red_2000.fits',
-                   'mod_fuv_red_1000.fits', 'mod_fuv_int_1000.fits',
-                   'mod_fuv_red_750.fits', 'mod_fuv_int_750.fits',
-                   'mod_fuv_red_500.fits', 'mod_fuv_int_500.fits',
-                   'mod_fuv_red_400.fits', 'mod_fuv_int_400.fits',
-                   'mod_fuv_red_300.fits', 'mod_fuv_int_300.fits',
-                   'mod_fuv_red_200.fits', 'mod_fuv_int_200.fits',
-                   'mod_fuv_red_100.fits', 'mod_fuv_int_100.fits']
-
-    nuvmodfiles = ['mod_nuv_red.fits', 'mod_nuv_int.fits',
-                   'mod_nuv_red_8000.fits', 'mod_nuv_red_5000.fits',
-                   'mod_nuv_red_4000.fits', 'mod_nuv_red_2000.fits',
-                   'mod_nuv_red_1000.fits', 'mod_nuv_int_1000.fits',
-                   'mod_nuv_red_750.fits', 'mod_nuv_int_750.fits',
-                   'mod_nuv_red_500.fits', 'mod_nuv_int_500.fits',
-                   'mod_nuv_red_400.fits', 'mod_nuv_int_400.fits',
-                   'mod_nuv_red_300.fits', 'mod_nuv_int_300.fits',
-                   'mod_nuv_red_200.fits', 'mod_nuv_int_200.fits',
-                   'mod_nuv_red_100.fits', 'mod_nuv_int_100.fits']
-
-    otherfiles = ['sfr100.fits', 'mips_24_MJysr.fits', 'irac_1_MJysr.fits']
-
-
-    weightfile = os.path.join(_DATA_DIR, 'weights_orig.fits')
-    w, h = pyfits.getdata(weightfile, header=True)
-    w[(w > 0) & (w < 0.95)] = 0
-    sel = (w == 0)
+    # mod_fuv_red_500.fits -> fluxmodred500
+    agelims = ['8000', '5000', '4000', '2000', '1000', '750', '500', '400',
+               '300', '200', '100']
+    fuvfiles, nuvfiles = {}, {}
+    for band, files in [('fuv', fuvfiles), ('nuv', nuvfiles)]:
+        for mod in ['red', 'int']:
+            files['fluxmod' + mod] = os.path.join(_MOD_DIR, 'mod_%s_%s.fits' % (band, mod))
+        for agelim in agelims:
+            mods = ['red'] if int(agelim) > 1000 else ['red', 'int']
+            for mod in mods:
+                files['fluxmod' + mod + agelim] = os.path.join(_MOD_DIR, 'mod_%s_%s_%s.fits' % (band, mod, agelim))
+
+    obsfiles = {'fluxfuv': 'galex_fuv_test.fits', 'fluxnuv': 'galex_nuv_test.fits',
+                'mips24': 'mips_24_MJysr.fits', 'irac1': 'irac_1_MJysr.fits'}
+    obsfiles = dict((k, os.path.join(_DATA_DIR, f)) for k, f in obsfiles.items())
+    otherfiles = {'sfr100': os.path.join(_DATA_DIR, 'sfr100.fits')}
+
+    cubefile = os.path.join(_DATA_DIR, AGELIM_CUBE_FILE) if use_cache or factor > 1 else None
+    loaders, w, h, sel = _map_loaders({'fuv': fuvfiles, 'nuv': nuvfiles,
+                                       'obs': obsfiles, 'other': otherfiles},
+                                      _DATA_DIR, cubefile, preload=preload,
+                                      factor=factor)
 
     ## pixel size
     dx, dy = astrogrid.wcs.calc_pixscale(h, ref='crpix').arcsec
     pixel_area = dx * dy
 
-    fuvfluxobs, nuvfluxobs = [pyfits.getdata(os.path.join(_DATA_DIR, x)) * w for x in obsfiles]
+    fuvdata = LazyMaps(loaders['fuv'])
+    nuvdata = LazyMaps(loaders['nuv'])
+    otherdata = LazyMaps(loaders['other'])
+
+    key = (res, correct_obs, factor)
+    def observed():
+        if key not in CORRECTED_OBS:
+            fuvfluxobs, nuvfluxobs, mips24, irac1 = [loaders['obs'][x]() for x in ['fluxfuv', 'fluxnuv', 'mips24', 'irac1']]
+            maps = correct_foreground(fuvfluxobs, nuvfluxobs, mips24, irac1, pixel_area, correct_obs=correct_obs)
+            # shared by every later call, so don't let anyone change them
+            for data in maps:
+                data.setflags(write=False)
+            CORRECTED_OBS[key] = maps
+        return CORRECTED_OBS[key]
+
+    fuvdata.add('fluxobs', lambda: observed()[0])
+    nuvdata.add('fluxobs', lambda: observed()[1])
+    otherdata.add('mips24', lambda: observed()[2])
+
+    for data, band in [(fuvdata, 'galex_fuv'), (nuvdata, 'galex_nuv')]:
+        for kind in ['obs', 'modint', 'modred']:
+            data.add('mag' + kind, partial(_flux2mag, data, 'flux' + kind, band))
 
-    fuvfluxmodred, fuvfluxmodint, fuvfluxmodred8000, fuvfluxmodred5000, fuvfluxmodred4000, fuvfluxmodred2000,  fuvfluxmodred1000, fuvfluxmodint1000, fuvfluxmodred750, fuvfluxmodint750, fuvfluxmodred500, fuvfluxmodint500, fuvfluxmodred400, fuvfluxmodint400, fuvfluxmodred300, fuvfluxmodint300, fuvfluxmodred200, fuvfluxmodint200, fuvfluxmodred100, fuvfluxmodint100 = [pyfits.getdata(os.path.join(_MOD_DIR, x)) * w for x in fuvmodfiles]
-
-    nuvfluxmodred, nuvfluxmodint,nuvfluxmodred8000, nuvfluxmodred5000, nuvfluxmodred4000, nuvfluxmodred2000,  nuvfluxmodred1000, nuvfluxmodint1000, nuvfluxmodred750, nuvfluxmodint750, nuvfluxmodred500, nuvfluxmodint500, nuvfluxmodred400, nuvfluxmodint400, nuvfluxmodred300, nuvfluxmodint300, nuvfluxmodred200, nuvfluxmodint200, nuvfluxmodred100, nuvfluxmodint100 = [pyfits.getdata(os.path.join(_MOD_DIR, x)) * w for x in nuvmodfiles]
-
-    sfr100, mips24, irac1 = [pyfits.getdata(os.path.join(_DATA_DIR, x)) * w for x in otherfiles]
-
-
-    for data in [fuvfluxobs, nuvfluxobs, fuvfluxmodint, nuvfluxmodint,
-                 fuvfluxmodred, nuvfluxmodred,
-                 fuvfluxmodred8000, nuvfluxmodred8000,
-                 fuvfluxmodred5000, nuvfluxmodred5000,
-                 fuvfluxmodred4000, nuvfluxmodred4000,
-                 fuvfluxmodred2000, nuvfluxmodred2000,
-                 fuvfluxmodint1000, nuvfluxmodint1000,
-                 fuvfluxmodred1000, nuvfluxmodred1000,
-                 fuvfluxmodint750, nuvfluxmodint750, fuvfluxmodred750,
-                 nuvfluxmodred750, fuvfluxmodint500, nuvfluxmodint500,
-                 fuvfluxmodred500, nuvfluxmodred500, fuvfluxmodint400,
-                 nuvfluxmodint400, fuvfluxmodred400, nuvfluxmodred400,
-                 fuvfluxmodint300, nuvfluxmodint300, fuvfluxmodred300,
-                 nuvfluxmodred300, fuvfluxmodint200, nuvfluxmodint200,
-                 fuvfluxmodred200, nuvfluxmodred200, fuvfluxmodint100,
-                 nuvfluxmodint100, fuvfluxmodred100, nuvfluxmodred100,
-                 sfr100, mips24, irac1]:
-        data[sel] = np.nan
-
-    def local_mean(A):
-        return np.nanmean(A)
+    return fuvdata, nuvdata, otherdata
 
-    def filter(data):
-        mean_filter = sp.filters.generic_filter(data, local_mean, size=3)
-        return mean_filter
 
+def mjysr_factors(pixel_area):
+    """
+    Factors that turn FUV, NUV and 24 micron surface brightnesses in MJy/sr
+    into fluxes per pixel in erg s-1 cm-2 A-1 (f_lambda = c / lambda^2 f_nu).
+    """
+    jy = MJYSR2JYARCSEC * pixel_area * 1e-23 * C
+    return jy / FUV_LAMBDA**2, jy / NUV_LAMBDA**2, jy / MIPS24_LAMBDA**2
+
+
+def foreground_mask(fuv, nuv, nsigma=5.):
+    """
+    Pixels taken to be foreground stars: NUV/FUV > 15 and NUV more than
+    nsigma standard deviations above the mean, or NUV more than nsigma below
+    the mean.
+    """
+    mean, sig = np.nanmean(nuv), nsigma * np.nanstd(nuv)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return ((nuv / fuv > 15) & (nuv > mean + sig)) | (nuv < mean - sig)
+
+
+def correct_foreground(fuvfluxobs, nuvfluxobs, mips24, irac1, pixel_area, correct_obs=False):
+    """
+    Replace foreground stars in the observed FUV, NUV and 24 micron maps with
+    the local (3x3, NaN-aware) mean. If correct_obs, the stars are found in
+    MJy/sr and the old-star emission, ALPHA_FUV and ALPHA_24MICRON times the
+    3.6 micron map, is removed from FUV and 24 micron.
+
+    The inputs are not changed.
+
+    Parameters
+    ----------
+    fuvfluxobs, nuvfluxobs : arrays ; observed fluxes in erg s-1 cm-2 A-1
+    mips24, irac1 : arrays ; 24 and 3.6 micron maps in MJy/sr
+    pixel_area : float ; pixel area in arcsec^2
+    correct_obs : bool, optional ; also remove the old-star emission
+
+    Returns
+    -------
+    fuv, nuv, mips24 : arrays ; corrected maps in erg s-1 cm-2 A-1
+    """
+    fuv_k, nuv_k, mips24_k = mjysr_factors(pixel_area)
     if correct_obs:
-        ## correct for foreground stars
-        ##    NUV/FUV > 15 (MJy/sr) and NUV detection 5 sigma
-        ## (1) Convert FUV and NUV to MJy/sr
-        fuv_mjysr = fuvfluxobs / MJYSR2JYARCSEC / pixel_area / 1e-23 / C * FUV_LAMBDA**2
-        nuv_mjysr = nuvfluxobs / MJYSR2JYARCSEC / pixel_area / 1e-23 / C * NUV_LAMBDA**2
-
-        fuv_filter = filter(fuv_mjysr)
-        nuv_filter = filter(nuv_mjysr)
-        mips24_filter = filter(mips24)
-
-        nuv_std = np.nanstd(nuv_mjysr)
-        sig = 5 * nuv_std
-        fg_sel = np.where((nuv_mjysr/fuv_mjysr > 15) & ((nuv_mjysr > np.nanmean(nuv_mjysr) + sig)) | (nuv_mjysr < np.nanmean(nuv_mjysr) - sig))
-
-        fuv_mjysr[fg_sel] = fuv_filter[fg_sel]
-        nuv_mjysr[fg_sel] = nuv_filter[fg_sel]
-        mips24[fg_sel] = mips24_filter[fg_sel]
-
-        ## correct for old stars
-        ##   fuvdata (MJy/sr) -= ALPHA_FUV * 3.6 micron (MJy/sr)
-        ##   24 micron (MJy/sr) -= ALPHA_24MICRON * 3.6 micron (MJy/sr)
-        fuv_mjysr -= ALPHA_FUV * irac1
-        mips24 -= ALPHA_24MICRON * irac1
-
-        #convert 24 micron from MJy/sr to Jy/arcsec**2
-        mips24 *= MJYSR2JYARCSEC
-        newfuvobs = fuv_mjysr * MJYSR2JYARCSEC
-        newnuvobs = nuv_mjysr * MJYSR2JYARCSEC
-
-        ## convert to Jy/pix
-        mips24 *= pixel_area
-        newfuvobs *= pixel_area
-        newnuvobs *= pixel_area
-
-        # mips24 map is in Jy --> convert to erg s-1 cm-2 A-1
-        # nu f_nu = lambda f_lambda so f_lambda = c/lambda^2 f_nu
-        mips24 *= 1e-23 #convert to erg s-1 cm-2 Hz-1
-        newfuvobs *= 1e-23
-        newnuvobs *= 1e-23
-        mips24 = C / MIPS24_LAMBDA**2 * mips24
-        newfuvobs = C / FUV_LAMBDA**2 * newfuvobs
-        newnuvobs = C / NUV_LAMBDA**2 * newnuvobs
+        fuv, nuv = fuvfluxobs / fuv_k, nuvfluxobs / nuv_k
     else:
-        fuv_filter = filter(fuvfluxobs)
-        nuv_filter = filter(nuvfluxobs)
-        mips24_filter = filter(mips24)
-
-        nuv_std = np.nanstd(nuvfluxobs)
-        sig = 5 * nuv_std
-        fg_sel = np.where((nuvfluxobs/fuvfluxobs > 15) & ((nuvfluxobs > np.nanmean(nuvfluxobs) + sig)) | (nuvfluxobs < np.nanmean(nuvfluxobs) - sig))
+        fuv, nuv = fuvfluxobs, nuvfluxobs
 
-        fuvfluxobs[fg_sel] = fuv_filter[fg_sel]
-        nuvfluxobs[fg_sel] = nuv_filter[fg_sel]
-        mips24[fg_sel] = mips24_filter[fg_sel]
-
-        mips24 *= MJYSR2JYARCSEC * pixel_area * 1e-23 * C / MIPS24_LAMBDA**2
-        newfuvobs = fuvfluxobs
-        newnuvobs = nuvfluxobs
-
-    fuvmagobs = astrogrid.flux.galex_flux2mag(newfuvobs, 'galex_fuv')
-    nuvmagobs = astrogrid.flux.galex_flux2mag(newnuvobs, 'galex_nuv')
-    fuvmagmodint = astrogrid.flux.galex_flux2mag(fuvfluxmodint, 'galex_fuv')
-    fuvmagmodred = astrogrid.flux.galex_flux2mag(fuvfluxmodred, 'galex_fuv')
-    nuvmagmodint = astrogrid.flux.galex_flux2mag(nuvfluxmodint, 'galex_nuv')
-    nuvmagmodred = astrogrid.flux.galex_flux2mag(nuvfluxmodred, 'galex_nuv')
-
-    fuvdata = {'fluxobs':newfuvobs, 'magobs':fuvmagobs,
-               'magmodred': fuvmagmodred, 'magmodint': fuvmagmodint,
-               'fluxmodint':fuvfluxmodint, 'fluxmodred':fuvfluxmodred,
-               'fluxmodred8000':fuvfluxmodred8000,
-               'fluxmodred5000':fuvfluxmodred5000,
-               'fluxmodred4000':fuvfluxmodred4000,
-               'fluxmodred2000':fuvfluxmodred2000,
-               'fluxmodint1000':fuvfluxmodint1000,
-               'fluxmodred1000':fuvfluxmodred1000,
-               'fluxmodint750':fuvfluxmodint750,
-               'fluxmodred750':fuvfluxmodred750,
-               'fluxmodint500':fuvfluxmodint500,
-               'fluxmodred500':fuvfluxmodred500,
-               'fluxmodint400':fuvfluxmodint400,
-               'fluxmodred400':fuvfluxmodred400,
-               'fluxmodint300':fuvfluxmodint300,
-               'fluxmodred300':fuvfluxmodred300,
-               'fluxmodint200':fuvfluxmodint200,
-               'fluxmodred200':fuvfluxmodred200,
-               'fluxmodint100':fuvfluxmodint100,
-               'fluxmodred100':fuvfluxmodred100}
-    nuvdata = {'fluxobs':newnuvobs, 'magobs': nuvmagobs,
-               'magmodred': nuvmagmodred, 'magmodint': nuvmagmodint,
-               'fluxmodint':nuvfluxmodint, 'fluxmodred':nuvfluxmodred,
-               'fluxmodred8000':nuvfluxmodred8000,
-               'fluxmodred5000':nuvfluxmodred5000,
-               'fluxmodred4000':nuvfluxmodred4000,
-               'fluxmodred2000':nuvfluxmodred2000,
-               'fluxmodint1000':nuvfluxmodint1000,
-               'fluxmodred1000':nuvfluxmodred1000,
-               'fluxmodint750':nuvfluxmodint750,
-               'fluxmodred750':nuvfluxmodred750,
-               'fluxmodint500':nuvfluxmodint500,
-               'fluxmodred500':nuvfluxmodred500,
-               'fluxmodint400':nuvfluxmodint400,
-               'fluxmodred400':nuvfluxmodred400,
-               'fluxmodint300':nuvfluxmodint300,
-               'fluxmodred300':nuvfluxmodred300,
-               'fluxmodint200':nuvfluxmodint200,
-               'fluxmodred200':nuvfluxmodred200,
-               'fluxmodint100':nuvfluxmodint100,
-               'fluxmodred100':nuvfluxmodred100}
-
-    otherdata = {'sfr100':sfr100, 'mips24':mips24}
-
-    return fuvdata, nuvdata, otherdata
+    fg = foreground_mask(fuv, nuv)
+    fuv = np.where(fg, nan_box_mean(fuv), fuv)
+    nuv = np.where(fg, nan_box_mean(nuv), nuv)
+    mips24 = np.where(fg, nan_box_mean(mips24), mips24)
 
+    if correct_obs:
+        fuv -= ALPHA_FUV * irac1
+        mips24 -= ALPHA_24MICRON * irac1
+        fuv *= fuv_k
+        nuv *= nuv_k
+    mips24 *= mips24_k
+    return [x.astype(fuvfluxobs.dtype, copy=False) for x in (fuv, nuv, mips24)]
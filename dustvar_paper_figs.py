@@ -1,6 +1,8 @@
 import numpy as np
 import os, sys
 import compile_data
+import regions
+import photometry
 import astrogrid
 import match_utils
 import fsps
@@ -188,8 +190,8 @@ def make_extfunc(wave, s, laws, lawnames, Rvs, bumps, filters, ftype='color', ba
                     mags_red = [mags_red]
                     mags = [mags]
                 #f_nu(Jy) = 3631 * 10^(-0.4 * (mag+dm)
-                fluxes_red = [3631 * 10**(-0.4 * (mag + M31_DM)) for mag in mags_red]
-                fluxes = [3631 * 10**(-0.4 * (mag + M31_DM)) for mag in mags]
+                fluxes_red = photometry.ab_mag2jy(mags_red, dmod=M31_DM)
+                fluxes = photometry.ab_mag2jy(mags, dmod=M31_DM)
                 #fluxes_red = [astrogrid.flux.galex_mag2flux(mags_red[i],filters[i].nick) for i in range(len(filters))]
                 #fluxes = [astrogrid.flux.galex_mag2flux(mags[i],filters[i].nick) for i in range(len(filters))]
                 if ftype == 'color':
@@ -605,9 +607,10 @@ def fig_region_triangles(otherdata, regs=[3,2630,1087], **kwargs):
     xloc2, yloc2 = 0.03, 0.60#0[.05, 0.05, 0.6], [0.75, 0.75, 0.75]
     xloc3, yloc3 = 0.22, 0.45
 
+    index = regions.get_region_index(res)
     for i, r in enumerate(regs):
-        av = otherdata['avdav'][np.isfinite(otherdata['avdav'])][regs[i]-1]
-        sfr = otherdata['sfr100'][np.isfinite(otherdata['sfr100'])][regs[i]-1]
+        av = index.gather(otherdata['avdav'])[regs[i]-1]
+        sfr = index.gather(otherdata['sfr100'])[regs[i]-1]
         avtext = r'$\widetilde{A_V}$ = ' + str(np.around(av, 2))
         sfrlabel = r'$\log$ SFR [M$_\odot$ yr$^{-1}$]'
         sfrnum = ' = ' + str(np.around(np.log10(sfr),2))
@@ -668,32 +671,12 @@ def fig_sigma_param_distributions(otherdata, first=False, **kwargs):
     else:
         grid = np.loadtxt(gridfile)
 
-    sfr100 = otherdata['sfr100']
-    shape = sfr100.shape
-    sfr100flat = sfr100.flatten()
-    sel = np.isfinite(sfr100flat)
-    sel2 = np.isfinite(sfr100)
+    index = regions.get_region_index(res)
+    sel2 = index.mask
     avdav = otherdata['avdav']
     avdavflat = avdav.flatten()
 
-    rv_array = np.zeros(shape).flatten()
-    sig_rv_array = np.zeros(shape).flatten()
-    fb_array = np.zeros(shape).flatten()
-    sig_fb_array = np.zeros(shape).flatten()
-
-    rv_array[sel] = grid[:,0]
-    sig_rv_array[sel] = grid[:,1]
-    fb_array[sel] = grid[:,2]
-    sig_fb_array[sel] = grid[:,3]
-    rv_array[~sel] = np.nan
-    fb_array[~sel] = np.nan
-    sig_rv_array[~sel] = np.nan
-    sig_fb_array[~sel] = np.nan
-
-    rv = rv_array.reshape(shape)
-    fb = fb_array.reshape(shape)
-    sig_rv = sig_rv_array.reshape(shape)
-    sig_fb = sig_fb_array.reshape(shape)
+    rv, sig_rv, fb, sig_fb = np.rollaxis(index.scatter(grid[:,:4]), -1)
 
     x1 = sig_rv / rv
     x2 = sig_fb / fb
@@ -1200,22 +1183,9 @@ def fig_rv_fbump_maps(otherdata, cut=False, **kwargs):
     #sel = np.where(grid[:,1] < 0.8)[0]
     #sel = np.where(grid[:,1] / grid[:,0] < 0.2)
 
-    sfr100 = otherdata['sfr100']
-    # save the shape for future use
-    shape = sfr100.shape
-    # flatten the data
-    sfr100flat = sfr100.flatten()
-    # get the location of the finite values
-    goodsel = np.isfinite(sfr100flat)
-
-    rv_array, fb_array = np.zeros(shape).flatten(), np.zeros(shape).flatten()
-    sigrv_array, sigfb_array = np.zeros(shape).flatten(), np.zeros(shape).flatten()
-    rv_array[goodsel], fb_array[goodsel]  = grid[:,0], grid[:,2]
-    rv_array[~goodsel], fb_array[~goodsel] = np.nan, np.nan
-    sigrv_array[goodsel], sigfb_array[goodsel]  = grid[:,1], grid[:,3]
-    sigrv_array[~goodsel], sigfb_array[~goodsel] = np.nan, np.nan
-    rv, fb = rv_array.reshape(shape), fb_array.reshape(shape)
-    sigrv, sigfb = sigrv_array.reshape(shape), sigfb_array.reshape(shape)
+    # put the per-region values back on the map
+    index = regions.get_region_index(res)
+    rv, sigrv, fb, sigfb = np.rollaxis(index.scatter(grid[:,:4]), -1)
 
 
 
@@ -1,6 +1,7 @@
 import numpy as np
 import os
 import compile_data
+import photometry
 import astrogrid
 import match_utils
 import seaborn as sns
@@ -290,7 +291,7 @@ class SFR(object):
 
     def correct_for_dust(self, m_fuv, m_dust):
         m_corr = m_fuv - m_dust
-        flux_corr = astrogrid.flux.galex_mag2flux(m_corr, 'galex_fuv')
+        flux_corr = photometry.galex_mag2flux(m_corr, 'galex_fuv')
         return flux_corr
 
     def kennicutt(self, flux, is_corrected=False, ben=False, hao=False, color=False, modeled=False):
@@ -311,7 +312,7 @@ class SFR(object):
             if color: m_dust = self.afuv_color
             if modeled: m_dust = self.afuv_sfh_modeled
 
-            m_fuv = astrogrid.flux.galex_flux2mag(flux, 'galex_fuv')
+            m_fuv = photometry.galex_flux2mag(flux, 'galex_fuv')
             flux = self.correct_for_dust(m_fuv, m_dust)
 
         total_flux = flux * self.lambda_fuv #erg s-1 cm-2
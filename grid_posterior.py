@@ -0,0 +1,415 @@
+"""
+Exact posteriors of the per-pixel (R_V, f_bump) fits on a grid, for many
+pixels at once.
+
+model_rv_fbump fits two parameters in a box (0 < R_V < 10, 0 < f_bump <
+1.5) with a flat prior, so the posterior can simply be evaluated on a grid
+instead of sampled. This is done in two passes:
+
+1. a coarse grid over the whole box, from a ModelTable of flux ratios
+   tabulated once in (A_V, R_V, f_bump) and interpolated in A_V;
+2. for each pixel, a fine grid over the part of the box where the coarse
+   posterior isn't negligible, with the model evaluated exactly.
+
+The result for each pixel has the same percentiles and a chain of draws
+from the posterior (as one walker), so it is written with the same datasets
+as the emcee fits (see chain_io.write_summary) and the scripts reading
+those read it unchanged.
+
+fit_map does the whole map on one grid shared by every pixel instead: the
+ln(likelihood) of a chunk of pixels on the grid is a single broadcast over
+(npix, nR_V, nf_bump) of the tabulated models, and the results are written
+as per-region arrays and maps rather than one group per region.
+"""
+import time
+import numpy as np
+from sedpy import attenuation
+
+import sed_model
+import chain_io
+
+
+RV_LIMITS = (0., 10.)
+FBUMP_LIMITS = (0., 1.5)
+LABS = ['R_V', 'f_bump']
+
+
+def cell_centers(limits, n):
+    """ Centers of n equal cells spanning limits = (lo, hi). """
+    lo, hi = limits
+    return lo + (np.arange(n) + 0.5) * (hi - lo) / n
+
+
+def lnlike_grid(model, data, sigma):
+    """
+    Gaussian ln(likelihood) of every model on a grid.
+
+    Parameters
+    ----------
+    model : (npix, ..., nbands) array ; model flux ratios on a grid
+    data, sigma : (npix, nbands) arrays ; measured ratios and their errors
+
+    Returns
+    -------
+    lnlike : (npix, ...) array
+    """
+    shape = data.shape[:1] + (1,) * (model.ndim - 2) + data.shape[1:]
+    chi = (model - data.reshape(shape)) / sigma.reshape(shape)
+    return -0.5 * np.sum(chi**2, axis=-1)
+
+
+class ModelTable(object):
+    """
+    Model flux ratios on a regular grid of cell centers in (R_V, f_bump),
+    tabulated at a set of A_V values. Calling it with per-pixel A_V values
+    interpolates linearly in A_V.
+
+    Parameters
+    ----------
+    av : array_like ; A_V values to tabulate at, increasing
+    nrv, nfb : int, optional ; number of R_V and f_bump cells over the box
+    att : sedpy.attenuation function, optional ; attenuation curve
+    kwargs : passed on to sed_model.flux_ratios (e.g. wave, spec, bands)
+    """
+    def __init__(self, av, nrv=50, nfb=30, att=attenuation.conroy, **kwargs):
+        self.av = np.asarray(av, dtype=float)
+        self.rv = cell_centers(RV_LIMITS, nrv)
+        self.fb = cell_centers(FBUMP_LIMITS, nfb)
+        avs, rvs, fbs = np.meshgrid(self.av, self.rv, self.fb, indexing='ij')
+        ratios = sed_model.flux_ratios(rvs, avs, 0., fbs, att=att, **kwargs)
+        self.ratios = ratios.reshape(avs.shape + (-1,))
+
+    def __call__(self, av):
+        """ (npix, nrv, nfb, nbands) model ratios at each pixel's A_V. """
+        av = np.clip(np.asarray(av, dtype=float), self.av[0], self.av[-1])
+        i = np.clip(np.searchsorted(self.av, av) - 1, 0, len(self.av) - 2)
+        w = ((av - self.av[i]) / (self.av[i + 1] - self.av[i]))[:, None, None, None]
+        return (1. - w) * self.ratios[i] + w * self.ratios[i + 1]
+
+
+def _window(keep, centers, limits):
+    # per-pixel range of the cells in keep (npix, ncells), padded by a cell
+    # on each side and clipped to the box
+    step = centers[1] - centers[0]
+    ncells = keep.shape[1]
+    first = np.argmax(keep, axis=1)
+    last = ncells - 1 - np.argmax(keep[:, ::-1], axis=1)
+    lo = np.maximum(centers[first] - 1.5 * step, limits[0])
+    hi = np.minimum(centers[last] + 1.5 * step, limits[1])
+    return lo, hi
+
+
+class GridPosterior(object):
+    """
+    Posteriors of a batch of pixels, each on its own grid of equal cells.
+
+    Parameters
+    ----------
+    rv, fb : (npix, nrv), (npix, nfb) arrays ; cell centers of each pixel's
+        grid
+    lnpost : (npix, nrv, nfb) array ; ln(posterior), up to a constant
+    """
+    def __init__(self, rv, fb, lnpost):
+        self.rv = rv
+        self.fb = fb
+        self.lnpost = lnpost
+        p = np.exp(lnpost - np.max(lnpost, axis=(1, 2))[:, None, None])
+        self.prob = p / np.sum(p, axis=(1, 2))[:, None, None]
+
+    def __len__(self):
+        return len(self.rv)
+
+    def _axes(self):
+        return [(self.rv, self.prob.sum(axis=2)), (self.fb, self.prob.sum(axis=1))]
+
+    def percentiles(self, q=chain_io.PERCENTILES):
+        """
+        Percentiles of the marginal posteriors, from their cumulative
+        distributions at the cell edges.
+
+        Returns
+        -------
+        perc : (npix, 2, nq) array
+        """
+        q = np.asarray(q, dtype=float) / 100.
+        out = np.empty((len(self), 2, len(q)))
+        for d, (centers, marg) in enumerate(self._axes()):
+            step = centers[:, 1:2] - centers[:, :1]
+            edges = np.hstack([centers - 0.5 * step, centers[:, -1:] + 0.5 * step])
+            cdf = np.hstack([np.zeros((len(self), 1)), np.cumsum(marg, axis=1)])
+            # the cell each percentile falls in, and how far into it
+            k = np.clip(np.sum(cdf[:, :, None] < q, axis=1) - 1, 0, marg.shape[1] - 1)
+            rows = np.arange(len(self))[:, None]
+            frac = (q - cdf[rows, k]) / np.maximum(marg[rows, k], 1e-300)
+            out[:, d] = edges[rows, k] + np.clip(frac, 0., 1.) * step
+        return out
+
+    def draws(self, ndraw, random_state=np.random):
+        """
+        Draws from each pixel's posterior: a cell picked with its
+        probability, then a uniform point in the cell.
+
+        Returns
+        -------
+        samples : (npix, ndraw, 2) array
+        lnpost : (npix, ndraw) array ; ln(posterior) of the cell drawn
+        """
+        npix, nfb = self.fb.shape
+        ncells = self.rv.shape[1] * nfb
+        cdf = np.cumsum(self.prob.reshape(npix, -1), axis=1)
+        cdf /= cdf[:, -1:]
+        # one searchsorted for all pixels, offsetting pixel i by i
+        offsets = np.arange(npix)[:, None]
+        u = random_state.uniform(size=(npix, ndraw))
+        cell = np.searchsorted((cdf + offsets).ravel(), (u + offsets).ravel())
+        cell = cell.reshape(npix, ndraw) - offsets * ncells
+        cell = np.clip(cell, 0, ncells - 1)
+        irv, ifb = cell // nfb, cell % nfb
+        rows = np.arange(npix)[:, None]
+        jitter = random_state.uniform(-0.5, 0.5, size=(npix, ndraw, 2))
+        samples = np.empty((npix, ndraw, 2))
+        for d, centers in enumerate([self.rv, self.fb]):
+            step = centers[:, 1:2] - centers[:, :1]
+            samples[:, :, d] = centers[rows, irv if d == 0 else ifb] + jitter[:, :, d] * step
+        return samples, self.lnpost[rows, irv, ifb]
+
+    def moments(self):
+        """ Posterior means and standard deviations, each (npix, 2). """
+        mean = np.empty((len(self), 2))
+        std = np.empty((len(self), 2))
+        for d, (centers, marg) in enumerate(self._axes()):
+            mean[:, d] = np.sum(marg * centers, axis=1)
+            var = np.sum(marg * centers**2, axis=1) - mean[:, d]**2
+            std[:, d] = np.sqrt(np.maximum(var, 0.))
+        return mean, std
+
+    def best(self):
+        """ (R_V, f_bump) of each pixel's highest posterior cell, (npix, 2). """
+        npix, nfb = self.fb.shape
+        cell = np.argmax(self.lnpost.reshape(npix, -1), axis=1)
+        rows = np.arange(npix)
+        return np.column_stack([self.rv[rows, cell // nfb], self.fb[rows, cell % nfb]])
+
+    def pixels(self, ndraw=1000, random_state=np.random):
+        """ A PixelPosterior for each pixel, with ndraw draws each. """
+        perc = self.percentiles()
+        samples, lnpost = self.draws(ndraw, random_state)
+        return [PixelPosterior(samples[i], lnpost[i], perc[i], self.rv.shape[1])
+                for i in range(len(self))]
+
+
+class PixelPosterior(object):
+    """
+    The grid posterior of one pixel, in the form chain_io writes: draws as
+    a flatchain and as a (1, ndraw, 2) chain of one walker (written as
+    sampler_chain), ln(posterior) of each draw and the percentiles of the
+    full grid.
+    """
+    def __init__(self, samples, lnpost, perc, nfine):
+        self.flatchain = samples
+        self.chain = samples[None]
+        self.lnprobability = lnpost[None]
+        self._perc = perc
+        self.attrs = {'engine': 'grid', 'nfine': nfine}
+
+    def percentiles(self, d, q=None):
+        """ The chain_io.PERCENTILES of parameter d, from the full grid. """
+        return self._perc[d]
+
+
+def fit_pixels(data, sigma, av, table=None, nfine=40, tol=1e-6,
+               att=attenuation.conroy, **kwargs):
+    """
+    Grid posteriors of a batch of pixels.
+
+    Parameters
+    ----------
+    data, sigma : (npix, nbands) arrays ; measured flux ratios and errors
+    av : (npix,) array ; A_V of each pixel
+    table : ModelTable, optional ; coarse model table. Default: one built for
+        the range of av
+    nfine : int, optional ; cells per side of each pixel's fine grid
+    tol : float, optional ; the fine grid covers the coarse cells whose
+        posterior is more than tol times the pixel's highest
+    att : sedpy.attenuation function, optional ; attenuation curve
+    kwargs : passed on to sed_model.flux_ratios
+
+    Returns
+    -------
+    post : GridPosterior
+    """
+    data = np.asarray(data, dtype=float)
+    sigma = np.asarray(sigma, dtype=float)
+    av = np.asarray(av, dtype=float)
+    if table is None:
+        table = default_table(av, att=att, **kwargs)
+
+    coarse = lnlike_grid(table(av), data, sigma)
+    keep = coarse > np.max(coarse, axis=(1, 2))[:, None, None] + np.log(tol)
+    rvlo, rvhi = _window(np.any(keep, axis=2), table.rv, RV_LIMITS)
+    fblo, fbhi = _window(np.any(keep, axis=1), table.fb, FBUMP_LIMITS)
+
+    cells = (np.arange(nfine) + 0.5) / nfine
+    rv = rvlo[:, None] + (rvhi - rvlo)[:, None] * cells
+    fb = fblo[:, None] + (fbhi - fblo)[:, None] * cells
+    rvs = np.broadcast_to(rv[:, :, None], (len(av), nfine, nfine))
+    fbs = np.broadcast_to(fb[:, None, :], (len(av), nfine, nfine))
+    avs = np.broadcast_to(av[:, None, None], (len(av), nfine, nfine))
+    model = sed_model.flux_ratios(rvs, avs, 0., fbs, att=att, **kwargs)
+    model = model.reshape((len(av), nfine, nfine, -1))
+    return GridPosterior(rv, fb, lnlike_grid(model, data, sigma))
+
+
+def default_table(av, dav=0.02, att=attenuation.conroy, **kwargs):
+    """ ModelTable covering the range of av in steps of dav. """
+    lo = max(np.nanmin(av) - dav, 0.)
+    hi = np.nanmax(av) + dav
+    return ModelTable(np.arange(lo, hi + dav, dav), att=att, **kwargs)
+
+
+def to_file(filename, inds, y_fuv, y_nuv, sigma_fuv, sigma_nuv, avdav,
+            batch=500, ndraw=1000, att=attenuation.conroy, random_state=np.random,
+            **kwargs):
+    """
+    Fit regions inds (numbered from 1, as in model_rv_fbump.to_file) in
+    batches and write each one's results as a group of filename. Regions
+    already in the file are skipped; each batch is flushed once written.
+    """
+    import h5py
+    data = np.column_stack([y_fuv, y_nuv])
+    sigma = np.column_stack([sigma_fuv, sigma_nuv])
+    table = default_table(np.asarray(avdav)[np.asarray(inds) - 1], att=att, **kwargs)
+    with h5py.File(filename, 'a') as hf:
+        z = len(str(len(y_fuv)))
+        todo = [i for i in inds if chain_io.region_name(i, z) not in hf]
+        for start in range(0, len(todo), batch):
+            regs = todo[start:start + batch]
+            idx = np.asarray(regs) - 1
+            t0 = time.time()
+            post = fit_pixels(data[idx], sigma[idx], np.asarray(avdav)[idx],
+                              table=table, att=att, **kwargs)
+            pixels = post.pixels(ndraw, random_state)
+            t1 = time.time()
+            for i, pix in zip(regs, pixels):
+                chain_io.write_region(hf, chain_io.region_name(i, z), pix, LABS,
+                                      (t1 - t0) / len(regs))
+            hf.flush()
+            print('regions %d - %d took %.2f s' % (regs[0], regs[-1], t1 - t0))
+
+
+def fit_shared(data, sigma, av, table):
+    """
+    Grid posteriors of a batch of pixels on the table's own (R_V, f_bump)
+    grid: the ln(likelihood) of every pixel at every grid point in one
+    broadcast, with no per-pixel refinement.
+    """
+    npix = len(av)
+    rv = np.broadcast_to(table.rv, (npix, len(table.rv)))
+    fb = np.broadcast_to(table.fb, (npix, len(table.fb)))
+    lnlike = lnlike_grid(table(av), np.asarray(data, dtype=float),
+                         np.asarray(sigma, dtype=float))
+    return GridPosterior(rv, fb, lnlike)
+
+
+def map_chunks(npix, table, max_bytes=2**28):
+    """
+    Slices of at most max_bytes worth of pixels for fit_shared, counting
+    the models interpolated at each pixel and the temporaries made from
+    them.
+    """
+    per_pixel = 4 * table.ratios[0].nbytes
+    size = max(1, int(max_bytes // per_pixel))
+    return [slice(start, start + size) for start in range(0, npix, size)]
+
+
+def fit_map(filename, data, sigma, av, index=None, table=None, nrv=200, nfb=150,
+            max_bytes=2**28, save_posterior=False, att=attenuation.conroy,
+            **kwargs):
+    """
+    Posteriors of every region on one shared grid, in chunks of pixels,
+    written to filename.
+
+    The file has, for each parameter lab in LABS:
+        lab : (nregions, 3) ; the chain_io.PERCENTILES
+        lab_mean, lab_std, lab_best : (nregions,) ; mean, standard deviation
+            and value at the highest posterior grid point
+        marginal_lab : (nregions, ngrid) ; marginal posterior on the grid
+        grid_lab : (ngrid,) ; the grid cell centers
+    the highest ln(likelihood) of each region (lnlike_max), optionally the
+    full posterior of each region on the grid (posterior, (nregions, nrv,
+    nfb)), and, if a regions.RegionIndex is given, a 'maps' group with the
+    same summaries as (ny, nx) maps (the percentiles as (3, ny, nx)).
+
+    Parameters
+    ----------
+    filename : str ; output HDF5 file, replaced if it exists
+    data, sigma : (nregions, nbands) arrays ; measured flux ratios and errors
+    av : (nregions,) array ; A_V of each region
+    index : regions.RegionIndex, optional ; to also write maps. Must have
+        the regions of data, in the same order
+    table : ModelTable, optional ; the shared grid. Default: nrv x nfb cells
+        over the box, tabulated every 0.02 mag over the range of av
+    max_bytes : int, optional ; memory to use for each chunk of pixels
+    save_posterior : bool, optional ; also write the full posteriors
+    att : sedpy.attenuation function, optional ; attenuation curve
+    kwargs : passed on to sed_model.flux_ratios
+    """
+    import os
+    import h5py
+    import compile_data
+    t0 = time.time()
+    av = np.asarray(av, dtype=float)
+    if index is not None and len(index) != len(av):
+        raise ValueError('index has %d regions but there are %d to fit'
+                         % (len(index), len(av)))
+    if table is None:
+        dav = 0.02
+        table = ModelTable(np.arange(max(np.nanmin(av) - dav, 0.),
+                                     np.nanmax(av) + 2 * dav, dav),
+                           nrv=nrv, nfb=nfb, att=att, **kwargs)
+    grids = [table.rv, table.fb]
+    nreg = len(av)
+
+    out = dict((lab, np.empty((nreg, len(chain_io.PERCENTILES)))) for lab in LABS)
+    for lab, grid in zip(LABS, grids):
+        for key in ['_mean', '_std', '_best']:
+            out[lab + key] = np.empty(nreg)
+        out['marginal_' + lab] = np.empty((nreg, len(grid)), dtype=compile_data.FLOAT)
+    out['lnlike_max'] = np.empty(nreg)
+
+    tmpfile = compile_data._temp_file(filename)
+    with h5py.File(tmpfile, 'w') as hf:
+        if save_posterior:
+            posterior = hf.create_dataset('posterior', (nreg, len(table.rv), len(table.fb)),
+                                          dtype=compile_data.FLOAT,
+                                          chunks=(1, len(table.rv), len(table.fb)))
+        for sl in map_chunks(nreg, table, max_bytes):
+            post = fit_shared(data[sl], sigma[sl], av[sl], table)
+            perc = post.percentiles()
+            mean, std = post.moments()
+            best = post.best()
+            axes = post._axes()
+            for d, lab in enumerate(LABS):
+                out[lab][sl] = perc[:, d]
+                out[lab + '_mean'][sl] = mean[:, d]
+                out[lab + '_std'][sl] = std[:, d]
+                out[lab + '_best'][sl] = best[:, d]
+                out['marginal_' + lab][sl] = axes[d][1]
+            out['lnlike_max'][sl] = np.max(post.lnpost, axis=(1, 2))
+            if save_posterior:
+                posterior[sl] = post.prob
+        for key, val in out.items():
+            hf.create_dataset(key, data=val)
+        for lab, grid in zip(LABS, grids):
+            hf.create_dataset('grid_' + lab, data=grid)
+        if index is not None:
+            g = hf.create_group('maps')
+            for key, val in out.items():
+                if key.startswith('marginal_'):
+                    continue
+                m = index.scatter(val)
+                # percentiles first, as (3, ny, nx)
+                g.create_dataset(key, data=np.rollaxis(m, -1) if m.ndim == 3 else m)
+        hf.attrs['run_time'] = np.around(time.time() - t0, 2)
+    os.rename(tmpfile, filename)
+    return out
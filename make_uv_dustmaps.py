@@ -1,4 +1,4 @@
-import astrogrid.flux
+import photometry
 import astropy.io.fits
 import m31maps
 import os
@@ -13,10 +13,10 @@ nuvred_map = astropy.io.fits.getdata(m31maps.config.path('mod_nuv_red.mosaic'))
 
 
 # A_FUV and A_NUV maps
-afuv_map = (astrogrid.flux.galex_flux2mag(fuvred_map, 'galex_fuv') -
-            astrogrid.flux.galex_flux2mag(fuvint_map, 'galex_fuv'))
-anuv_map = (astrogrid.flux.galex_flux2mag(nuvred_map, 'galex_nuv') -
-            astrogrid.flux.galex_flux2mag(nuvint_map, 'galex_nuv'))
+afuv_map = (photometry.galex_flux2mag(fuvred_map, 'galex_fuv') -
+            photometry.galex_flux2mag(fuvint_map, 'galex_fuv'))
+anuv_map = (photometry.galex_flux2mag(nuvred_map, 'galex_nuv') -
+            photometry.galex_flux2mag(nuvint_map, 'galex_nuv'))
 
 
 # Write
@@ -1,15 +1,13 @@
 import numpy as np
 import h5py
-import matplotlib.pyplot as plt
 import os
-import random
 from scipy.misc import logsumexp
 import time
 import emcee
 import compile_data
+import sampling
+import regions
 from pdb import set_trace
-import matplotlib.patches as patches
-from matplotlib.path import Path
 
 def evaluate_lneta(theta, grid):
     mean = theta[0] #+ theta[2] * np.log10(sfr / np.mean(sfr))
@@ -37,15 +35,15 @@ def lnprob(theta, grid, gridtype='rv'):
         return -np.inf
     return lp + lnlike(theta, grid)
 
-def initialize(init, ndim, nwalkers):
+def initialize(init, ndim, nwalkers, random_state=np.random):
     """
     Offset the initial guess slightly for each walker
     """
-    pos = [init + 1e-4 * np.random.randn(ndim) for i in range(nwalkers)]
+    pos = [init + 1e-4 * random_state.randn(ndim) for i in range(nwalkers)]
     return pos
 
 
-def run_emcee(sampler, run_steps, restart_steps, pos, ndim, nwalkers, n_restarts=4):
+def run_emcee(sampler, run_steps, restart_steps, pos, ndim, nwalkers, n_restarts=4, random_state=np.random):
     """
     Run an MCMC chain.
 
@@ -58,6 +56,8 @@ def run_emcee(sampler, run_steps, restart_steps, pos, ndim, nwalkers, n_restarts
     ndim : int ; number of parameters to fit for
     nwalkers : number of walkers
     n_restarts : int (optional) ; number of times to restart the burn-in
+    random_state : numpy.random.RandomState (optional) ; draws the walker
+        positions at the restarts. Default: numpy's global state
 
     Returns
     -------
@@ -75,14 +75,14 @@ def run_emcee(sampler, run_steps, restart_steps, pos, ndim, nwalkers, n_restarts
         sampler.reset()
         pos, lp, state = sampler.run_mcmc(pos, restart_steps)
         sel = np.where(sampler.flatlnprobability == np.max(sampler.flatlnprobability))
-        pos = initialize(np.mean(sampler.flatchain[sel], axis=0), ndim, nwalkers)
+        pos = initialize(np.mean(sampler.flatchain[sel], axis=0), ndim, nwalkers, random_state)
 
     # one last burn in run
     #print('Final burn in')
     sampler.reset()
     pos, lp, state = sampler.run_mcmc(pos, run_steps)
     sel = np.where(sampler.flatlnprobability == np.max(sampler.flatlnprobability))
-    pos = initialize(np.mean(sampler.flatchain[sel], axis=0), ndim, nwalkers)
+    pos = initialize(np.mean(sampler.flatchain[sel], axis=0), ndim, nwalkers, random_state)
     sampler.reset()
 
     # actual mcmc run
@@ -91,46 +91,28 @@ def run_emcee(sampler, run_steps, restart_steps, pos, ndim, nwalkers, n_restarts
 
     return sampler, lp, pos
 
-def plot_walkers(sampler, nwalkers, ndim, labels=None):
-    naxes = ndim + 1
-    fig, ax = plt.subplots(naxes, 1, figsize=(naxes*1.8,naxes*2.8),sharex=True)
-    pp = np.asarray([sampler.chain[:,:, d] for d in range(ndim)])
-    for aa in range(ndim):
-        for w in range(nwalkers):
-            ax[aa].plot(pp[aa, w, 100:])
-    for w in range(nwalkers):
-        ax[aa+1].plot(sampler.lnprobability[w,100:])
-
-    for i, a in enumerate(fig.axes):
-        if labels:
-            labels.append('$\ln f$')
-            a.set_ylabel(labels[i])
-        a.tick_params(labelsize=13)
-    ax[-1].set_xlabel('Steps')
-    plt.subplots_adjust(hspace=0.12, right=0.96, top=0.92, left=0.15,
-                        bottom=0.13)
-
-def plot_triangle(sampler, labels=None, truths=None, ndim=None):
-    import corner
-    corner.ScalarFormatter(useOffset=False)
-    #lim = [(0.9995 * np.nanmin(sampler.flatchain[:,i]), 1.0005 * np.nanmax(sampler.flatchain[:,i])) for i in range(sampler.flatchain.shape[1])]
-    fig = corner.corner(sampler.flatchain[100:,:], truths=truths, labels=labels)#,range=lim)
-
-
-def model(grid, nwalkers, first_init, run_steps, restart_steps, gridtype='rv', n_restarts=0, labels=['$\mu$', '$\sigma$']):
+def model(grid, nwalkers, first_init, run_steps, restart_steps, gridtype='rv', n_restarts=0, labels=['$\mu$', '$\sigma$'], seed=None, stream=0):
 
     ndim = len(first_init)
 
-    # initialize the first guess with a slight offset for each walker
-    pos = initialize(first_init, ndim, nwalkers)
+    # initialize the first guess with a slight offset for each walker; with
+    # a seed, every draw comes from the streams numbered stream
+    random_state = np.random
+    if seed is not None:
+        random_state, sampler_state = sampling.region_random_states(seed, stream)
+    pos = initialize(first_init, ndim, nwalkers, random_state)
 
 
     t0 = time.time()
     sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob, args=(grid, gridtype))
 
     # Run emcee
+    if seed is not None:
+        sampler.random_state = sampler_state.get_state()
+
     sampler, lp, pos = run_emcee(sampler, run_steps, restart_steps, pos,
-                             ndim, nwalkers, n_restarts=n_restarts)
+                             ndim, nwalkers, n_restarts=n_restarts,
+                             random_state=random_state)
 
     t1 = time.time()
 
@@ -143,8 +125,9 @@ def model(grid, nwalkers, first_init, run_steps, restart_steps, gridtype='rv', n
     return sampler, lp, pos, np.around(t1-t0, 2)
 
 
-
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    from model_plots import plot_walkers_stacked as plot_walkers, plot_triangle
 
     selection = True
     write = True
@@ -156,6 +139,8 @@ if __name__ == '__main__':
     grid = np.loadtxt(gridfile)
 
     nsamples = 50
+    # base seed of the subsampling and of the fits
+    seed = 200
 
     fuvdata, nuvdata, otherdata = compile_data.gather_map_data()
     sfr100 = otherdata['sfr100']
@@ -172,16 +157,9 @@ if __name__ == '__main__':
     #out = '_sigrvrvlt02.h5'
 
     ## model just the inner region
-    im = plt.imshow(sfr100)
-    ellipse = patches.Ellipse((70, 0), 182, 45, angle=103, ec='g', lw=2, fc='none') ## this was done by eye
-    plt.gca().add_patch(ellipse)
-    v = ellipse.get_verts()
-    inv = plt.gca().transData.inverted()
-    t = inv.transform((v))
-    x, y = np.arange(sfr100.shape[0]), np.arange(sfr100.shape[1])
-    xx, yy = np.meshgrid(x, y, indexing='ij')
-    inds = np.asarray(zip(yy.flatten(), xx.flatten()))
-    ss = Path(t).contains_points(inds)[goodsel]
+    ## ellipse in pixels, chosen by eye on imshow(sfr100)
+    index = regions.get_region_index()
+    ss = index.gather(regions.ellipse_mask(index.shape, (70, 0), 182, 45, angle=103))
     sel = np.where(~ss & allsfr)[0]#.reshape(sfr100.shape))
     set_trace()
     out = '_inner_reg_and_sfrgt1e-5'
@@ -205,8 +183,8 @@ if __name__ == '__main__':
 
         total_samples = (hf.get(hf.keys()[0]))['sampler_flatchain'].shape[0]
 
-        random.seed(200)
-        inds = sorted(random.sample(range(total_samples), nsamples))
+        subsample = sampling.random_state(seed, 0, sampling.SUBSAMPLE_STREAM)
+        inds = sorted(subsample.choice(total_samples, nsamples, replace=False))
 
         for i, reg in enumerate(reg_range):
             group = hf.get(hf.keys()[reg])
@@ -230,8 +208,8 @@ if __name__ == '__main__':
     labels_rv = ['$\mu_{R_V}$', '$\sigma_{R_V}$']
     labels_fb = ['$\mu_{f_{bump}}$', '$\sigma_{f_{bump}}$']
 
-    sampler_rv, lp_rv, pos_rv, t_rv = model(rvgrid, nwalkers, first_init_rv, run_steps, restart_steps, gridtype='rv', n_restarts=n_restarts, labels=labels_rv)
-    sampler_fb, lp_fb, pos_fb, t_fb = model(fbgrid, nwalkers, first_init_fb, run_steps, restart_steps, gridtype='fbump', n_restarts=n_restarts, labels=labels_fb)
+    sampler_rv, lp_rv, pos_rv, t_rv = model(rvgrid, nwalkers, first_init_rv, run_steps, restart_steps, gridtype='rv', n_restarts=n_restarts, labels=labels_rv, seed=seed, stream=0)
+    sampler_fb, lp_fb, pos_fb, t_fb = model(fbgrid, nwalkers, first_init_fb, run_steps, restart_steps, gridtype='fbump', n_restarts=n_restarts, labels=labels_fb, seed=seed, stream=1)
 
     if write:
         #outfile = os.path.join(data_loc, '/final_sampler_rv_fbump.h5')
@@ -264,11 +242,11 @@ if __name__ == '__main__':
     plotname_fbw = os.path.join(data_loc, 'plots', 'walkers_fb' + out + '.pdf')
     #plt.savefig(plotname_fbw)
 
-    plot_triangle(sampler_rv, labels=labels_rv, truths=None, ndim=None)
+    plot_triangle(sampler_rv, labels=labels_rv, truths=None, ndim=None, start=100)
     plotname_rvt = os.path.join(data_loc, 'plots', 'triangle_rv' + out +'.pdf')
     #plt.savefig(plotname_rvt)
 
-    plot_triangle(sampler_fb, labels=labels_fb, truths=None, ndim=None)
+    plot_triangle(sampler_fb, labels=labels_fb, truths=None, ndim=None, start=100)
     plotname_fbt = os.path.join(data_loc, 'plots', 'triangle_fb' + out +'.pdf')
     #plt.savefig(plotname_fbt)
     plt.show()
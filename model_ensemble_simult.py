@@ -1,12 +1,11 @@
 import numpy as np
 import h5py
-import matplotlib.pyplot as plt
 import os
-import random
 from scipy.misc import logsumexp
 import time
 import emcee
 import compile_data
+import sampling
 from pdb import set_trace
 
 
@@ -68,15 +67,15 @@ def lnprob(theta, grid, foo):
     return lp + lnlike(theta, grid)
 
 
-def initialize(init, ndim, nwalkers):
+def initialize(init, ndim, nwalkers, random_state=np.random):
     """
     Offset the initial guess slightly for each walker
     """
-    pos = [init + 1e-4 * np.random.randn(ndim) for i in range(nwalkers)]
+    pos = [init + 1e-4 * random_state.randn(ndim) for i in range(nwalkers)]
     return pos
 
 
-def run_emcee(sampler, run_steps, restart_steps, pos, ndim, nwalkers, n_restarts=4):
+def run_emcee(sampler, run_steps, restart_steps, pos, ndim, nwalkers, n_restarts=4, random_state=np.random):
     """
     Run an MCMC chain.
 
@@ -89,6 +88,8 @@ def run_emcee(sampler, run_steps, restart_steps, pos, ndim, nwalkers, n_restarts
     ndim : int ; number of parameters to fit for
     nwalkers : number of walkers
     n_restarts : int (optional) ; number of times to restart the burn-in
+    random_state : numpy.random.RandomState (optional) ; draws the walker
+        positions at the restarts. Default: numpy's global state
 
     Returns
     -------
@@ -108,7 +109,7 @@ def run_emcee(sampler, run_steps, restart_steps, pos, ndim, nwalkers, n_restarts
         #set_trace()
         pos, lp, state = sampler.run_mcmc(pos, restart_steps)
         sel = np.where(sampler.flatlnprobability == np.max(sampler.flatlnprobability))
-        pos = initialize(np.mean(sampler.flatchain[sel], axis=0), ndim, nwalkers)
+        pos = initialize(np.mean(sampler.flatchain[sel], axis=0), ndim, nwalkers, random_state)
 
     # one last burn in run
     #print('Final burn in')
@@ -116,7 +117,7 @@ def run_emcee(sampler, run_steps, restart_steps, pos, ndim, nwalkers, n_restarts
     #set_trace()
     pos, lp, state = sampler.run_mcmc(pos, run_steps)
     sel = np.where(sampler.flatlnprobability == np.max(sampler.flatlnprobability))
-    pos = initialize(np.mean(sampler.flatchain[sel], axis=0), ndim, nwalkers)
+    pos = initialize(np.mean(sampler.flatchain[sel], axis=0), ndim, nwalkers, random_state)
     sampler.reset()
 
     # actual mcmc run
@@ -127,21 +128,28 @@ def run_emcee(sampler, run_steps, restart_steps, pos, ndim, nwalkers, n_restarts
     return sampler, lp, pos
 
 
-
-def model(grid, nwalkers, first_init, run_steps, restart_steps, n_restarts=0, threads=1, labels=['$\mu$', '$\sigma$']):
+def model(grid, nwalkers, first_init, run_steps, restart_steps, n_restarts=0, threads=1, labels=['$\mu$', '$\sigma$'], seed=None, stream=0):
 
     ndim = len(first_init)
 
-    # initialize the first guess with a slight offset for each walker
-    pos = initialize(first_init, ndim, nwalkers)
+    # initialize the first guess with a slight offset for each walker; with
+    # a seed, every draw comes from the streams numbered stream
+    random_state = np.random
+    if seed is not None:
+        random_state, sampler_state = sampling.region_random_states(seed, stream)
+    pos = initialize(first_init, ndim, nwalkers, random_state)
 
     t0 = time.time()
     sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob, args=(grid, None),
                                     threads=threads)
 
     # Run emcee
+    if seed is not None:
+        sampler.random_state = sampler_state.get_state()
+
     sampler, lp, pos = run_emcee(sampler, run_steps, restart_steps, pos,
-                                 ndim, nwalkers, n_restarts=n_restarts)
+                                 ndim, nwalkers, n_restarts=n_restarts,
+                                 random_state=random_state)
 
     t1 = time.time()
 
@@ -157,32 +165,6 @@ def model(grid, nwalkers, first_init, run_steps, restart_steps, n_restarts=0, th
     return sampler, lp, pos, np.around(t1-t0, 2)
 
 
-def plot_walkers(sampler, nwalkers, ndim, labels=None):
-    naxes = ndim + 1
-    fig, ax = plt.subplots(naxes, 1, figsize=(8,9), sharex=True)
-    #pp = np.asarray([sampler.chain[:,:, d] for d in range(ndim)])
-    for aa in range(ndim):
-        for w in range(nwalkers):
-            ax[aa].plot(sampler.chain[w, :, aa])
-            #ax[aa].plot(pp[aa, w, 100:])
-    for w in range(nwalkers):
-        ax[aa+1].plot(sampler.lnprobability[w, :])
-
-    for i, a in enumerate(fig.axes):
-        if labels:
-            labels.append('$\ln f$')
-            a.set_ylabel(labels[i])
-        a.tick_params(labelsize=13)
-    ax[-1].set_xlabel('Steps')
-    plt.subplots_adjust(hspace=0.12, right=0.96, top=0.98, left=0.15,
-                        bottom=0.13)
-
-def plot_triangle(sampler, labels=None, truths=None, ndim=None):
-    import corner
-    corner.ScalarFormatter(useOffset=False)
-    #lim = [(0.9995 * np.nanmin(sampler.flatchain[:,i]), 1.0005 * np.nanmax(sampler.flatchain[:,i])) for i in range(sampler.flatchain.shape[1])]
-    fig = corner.corner(sampler.flatchain[100:,:], truths=truths, labels=labels)#,range=lim)
-
 def write_to_file(outfile, sampler, runtime):
     #outfile = os.path.join(data_loc, '/final_sampler_rv_fbump.h5')
     rf = h5py.File(outfile, 'w')
@@ -200,9 +182,9 @@ def write_to_file(outfile, sampler, runtime):
     rf.close()
 
 
-
-
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    from model_plots import plot_walkers_stacked, plot_triangle
     print time.ctime()
     selection = False
     write = False#True
@@ -223,6 +205,8 @@ if __name__ == '__main__':
         outfile = os.path.join(data_loc, 'final_sampler_rv_fbump_cov_newred.h5')
 
     nsamples = 50
+    # base seed of the subsampling and of the fits
+    seed = 200
 
     fuvdata, nuvdata, otherdata = compile_data.gather_map_data()
     sfr100 = otherdata['sfr100']
@@ -245,8 +229,8 @@ if __name__ == '__main__':
 
         total_samples = (hf.get(hf.keys()[0]))['sampler_flatchain'].shape[0]
 
-        random.seed(200)
-        inds = sorted(random.sample(range(total_samples), nsamples))
+        subsample = sampling.random_state(seed, 0, sampling.SUBSAMPLE_STREAM)
+        inds = sorted(subsample.choice(total_samples, nsamples, replace=False))
 
         for i, reg in enumerate(reg_range):
             group = hf.get(hf.keys()[reg])
@@ -269,15 +253,15 @@ if __name__ == '__main__':
     labels = ['$\mu_{R_V}$','$\mu_{f_{bump}}$','$\sigma_{R_V}$','$\sigma_{f_{bump}}$', '$\sigma_{R_V, f_{bump}}$']
 
     print "starting mcmc..."
-    sampler, lp, pos, t = model(grid, nwalkers, first_init, run_steps, restart_steps, n_restarts=n_restarts, labels=labels, threads=threads)
+    sampler, lp, pos, t = model(grid, nwalkers, first_init, run_steps, restart_steps, n_restarts=n_restarts, labels=labels, threads=threads, seed=seed)
 
     if write:
         write_to_file(outfile, sampler, t)
 
     plot_loc = data_loc + '/plots/'
-    plot_triangle(sampler, labels=labels, truths=None, ndim=None)
+    plot_triangle(sampler, labels=labels, truths=None, ndim=None, start=100)
     plt.savefig(plot_loc + 'simult_triangle_all.pdf')
-    plot_walkers(sampler, nwalkers, ndim, labels=labels)
+    plot_walkers_stacked(sampler, nwalkers, ndim, labels=labels, start=0, figsize=(8,9))
     plt.savefig(plot_loc + 'simult_walkers_all.pdf')
     #plt.show()
 
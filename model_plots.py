@@ -0,0 +1,109 @@
+"""
+Diagnostic plots for the emcee runs.
+
+These live apart from the model modules so that a fit worker (e.g. on a
+headless Condor node) never has to import matplotlib or corner.
+"""
+import numpy as np
+import matplotlib.pyplot as plt
+import matplotlib.colors as mcolors
+
+
+def plot_walkers(sampler, nwalkers, ndim, labels=None):
+    """
+    Walker traces for each parameter and ln(prob), side by side.
+    """
+    naxes = ndim + 1
+    fig, ax = plt.subplots(1, naxes, figsize=(naxes*3,naxes*1.5))
+
+    pp = np.asarray([sampler.chain[:,:, d] for d in range(ndim)])
+    for aa in range(ndim):
+        for w in range(nwalkers):
+            ax[aa].plot(pp[aa, w, :])
+    for w in range(nwalkers):
+        ax[aa+1].plot(sampler.lnprobability[w,:])
+
+    for i, ax in enumerate(fig.axes):
+        if labels:
+            labels.append('ln(prob)')
+            ax.set_ylabel(labels[i])
+            ax.set_xlabel('Steps')
+        ax.tick_params(labelsize=13)
+    plt.subplots_adjust(wspace=0.35, right=0.99, top=0.92, left=0.08,
+                        bottom=0.13)
+
+
+def plot_walkers_stacked(sampler, nwalkers, ndim, labels=None, start=100, figsize=None):
+    """
+    Walker traces for each parameter and ln f, stacked on a shared step axis.
+    Steps before `start` are not shown.
+    """
+    naxes = ndim + 1
+    if figsize is None:
+        figsize = (naxes*1.8, naxes*2.8)
+    fig, ax = plt.subplots(naxes, 1, figsize=figsize, sharex=True)
+    pp = np.asarray([sampler.chain[:,:, d] for d in range(ndim)])
+    for aa in range(ndim):
+        for w in range(nwalkers):
+            ax[aa].plot(pp[aa, w, start:])
+    for w in range(nwalkers):
+        ax[aa+1].plot(sampler.lnprobability[w,start:])
+
+    for i, a in enumerate(fig.axes):
+        if labels:
+            labels.append('$\ln f$')
+            a.set_ylabel(labels[i])
+        a.tick_params(labelsize=13)
+    ax[-1].set_xlabel('Steps')
+    plt.subplots_adjust(hspace=0.12, right=0.96, top=0.92, left=0.15,
+                        bottom=0.13)
+
+
+def plot_triangle(sampler, labels=None, truths=None, ndim=None, start=0, pad_range=False):
+    """
+    Corner plot of the flattened chain, skipping the first `start` samples.
+    If pad_range, the axes span the samples with a 0.05% margin.
+    """
+    import corner
+    corner.ScalarFormatter(useOffset=False)
+    flatchain = sampler.flatchain[start:,:]
+    kwargs = {}
+    if pad_range:
+        kwargs['range'] = [(0.9995 * np.nanmin(flatchain[:,i]), 1.0005 * np.nanmax(flatchain[:,i])) for i in range(flatchain.shape[1])]
+    fig = corner.corner(flatchain, truths=truths, labels=labels, **kwargs)
+    return fig
+
+
+def plot_data_dist(datax, datay, sampler, model):
+    """
+    2d histogram of the data with lines drawn from the fitted distribution.
+    `model` maps a drawn value to the slope of the relation.
+    """
+    from dustvar_paper_figs import make_2dhist_func
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+
+    # first plot the real data
+    zticks = [1, 2, 5, 10, 20, 50]
+    xlim = [-0.01, 1.55]
+    ylim = [-1.02, 1.42]
+    cnorm = mcolors.LogNorm(vmin=1, vmax=zticks[-1])
+    hist_kwargs = {'func': 'count', 'bins': 75, 'xlim': xlim,
+                   'ylim': ylim, 'cnorm': cnorm}
+    im, cnorm, bindata = make_2dhist_func(ax, datax, datay, datay, cmap=plt.cm.Greys_r, **hist_kwargs)
+    ax.grid()
+    #plt.plot(datax, datay, marker='o', ms=1.5, color='k', lw=0)
+
+    ## Now over plot draws from the model
+    modx = np.linspace(0, 2.5, 100)
+    mean = np.percentile(sampler.flatchain[:,0], 50)
+    sigma = np.percentile(sampler.flatchain[:,1], 50)
+    mu_draw = np.random.normal(mean, sigma, 500)
+    for mu in mu_draw:
+        mody = modx * model(mu)
+        ax.plot(modx, mody, lw=0.5, color='red', alpha=0.1)
+
+    ax.set_xlabel(r'$A_V$ + 1/2 $dA_V$')
+    ax.set_ylabel(r'$\Delta$ UV Color')
+    ax.set_xlim(xlim)
+    ax.set_ylim(ylim)
@@ -1,28 +1,35 @@
 import numpy as np
-import fsps
 import emcee
 import h5py
 import time
 import os
 import sys
 
-from astrogrid.flux import calc_mag, mag2flux
-
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
-
-from sedpy import attenuation, observate
+from sedpy import attenuation
 import compile_data
-
-from joblib import Parallel, delayed
+import sed_model
+import chain_io
+import sampling
+from sampling import initialize, run_emcee
 
 from pdb import set_trace
 
+M31_DM = 24.47
+ATT = attenuation.conroy
+# uniform priors: 0 < R_V < 10, 0 < f_bump < 1.5
+PRIOR_LO = np.array([0., 0.])
+PRIOR_HI = np.array([10., 1.5])
+
 
 def get_args():
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('reg', type=int, help='region number')
+    parser.add_argument('--seed', type=int, default=None, help='base seed of the per-region random streams, for reproducible runs')
+    parser.add_argument('--target_ess', type=float, default=None, help='adapt the walkers and steps to this effective sample size, after a pilot run')
+    parser.add_argument('--reinit', default='prune', choices=['prune', 'recenter'], help='restart the burn-in by moving the stuck walkers onto the others, or all of them to the best sample')
+    parser.add_argument('--thin', action='store_true', help='store only the chain thinned by its autocorrelation time, and summaries')
+    parser.add_argument('--precision', default='float64', choices=['float32', 'float64'], help='precision of the maps and stored chains')
     return parser.parse_args()
 
 
@@ -61,7 +68,8 @@ def get_data(res='90', dust_curve='cardelli'):
         sfh.append(x[np.isfinite(x)])
     sfh = np.asarray(sfh)
 
-    return data_fuv, data_nuv, data_color, av, dav, sfh
+    # the maps may be float32; the likelihood is always done in float64
+    return [x.astype(float) for x in (data_fuv, data_nuv, data_color, av, dav, sfh)]
 
 
 def redden(wave, spec, av=None, dav=None, rv=None, fbump=None, nsplit=9, dust_curve=None, wlo=1216., whi=2e4, **kwargs):
@@ -104,160 +112,43 @@ def ext_func(rv, av, dav, f_bump=1., att=attenuation.conroy):
     f_bump : float, optional; strength of the 2175 \AA bump in fraction of MW bump strength
     att : sedpy.attenuation funcion, optional; attenuation curve to use. Default: attenuation.conroy
     """
-    #specred, lir = redden(wave, spec, av=av, dav=dav, rv=rv, fbump=f_bump, dust_curve=att, nsplit=30)
-    specred, lir = redden(wave, spec, av=av, dav=dav, rv=rv, fbump=f_bump, dust_curve=att, nsplit=30)
-
-    mags_red = [calc_mag(wave, specred, band, dmod=24.47) for band in ['galex_fuv', 'galex_nuv']]
-    mags = [calc_mag(wave, spec, band, dmod=24.47) for band in ['galex_fuv', 'galex_nuv']]
-
-    fluxes_red = [mag2flux(mags_red[0], 'galex_fuv'), mag2flux(mags_red[1], 'galex_nuv')]
-    fluxes = [mag2flux(mags[0], 'galex_fuv'), mag2flux(mags[1], 'galex_nuv')]
-
-    val_fuv = fluxes_red[0] / fluxes[0]
-    val_nuv = fluxes_red[1] / fluxes[1]
+    # the zero points and distance modulus cancel in the ratios, so they
+    # come straight from the filter integrals; rv and f_bump can be arrays,
+    # e.g. one value per walker
+    shape = np.broadcast(rv, av, dav, f_bump).shape
+    ratios = sed_model.flux_ratios(rv, av, dav, f_bump, att=att, nsplit=30)
+    val_fuv, val_nuv = ratios.T.reshape((2,) + shape)
 
     return val_fuv, val_nuv
 
 
 def lnlike(data_fuv, data_nuv, sigma_fuv, sigma_nuv, theta, best_av, best_dav):
     """
-    data_fuv, etc are for a SINGLE pixel
+    data_fuv, etc are for a SINGLE pixel; theta is one [R_V, f_bump] or an
+    (nwalkers, 2) array of them
     """
-    model = ext_func(theta[0], best_av, best_dav, f_bump=theta[1], att=ATT)
+    theta = np.asarray(theta)
+    model = ext_func(theta[...,0], best_av, best_dav, f_bump=theta[...,1], att=ATT)
     val = ((model[0] - data_fuv)**2/sigma_fuv**2) + ((model[1] - data_nuv)**2/sigma_nuv**2)
     return -0.5 * val
 
 
 def lnprior(theta):
     """
-    Set the priors on the model parameters
+    Set the priors on the model parameters. theta is one [R_V, f_bump] or
+    an (nwalkers, 2) array of them.
     """
-    # theta = [Rv, av, f_bump] ## doing R_V only for now
-    if 0. < theta[0] < 10. and 0. < theta[1] < 1.5:
-        return 0.0
-    return -np.inf
+    return sampling.box_lnprior(theta, PRIOR_LO, PRIOR_HI)
 
 
 def lnprob(theta, data_fuv, data_nuv, sigma_fuv, sigma_nuv, best_av, best_dav):
-    lp = lnprior(theta)
-    if not np.isfinite(lp):
-        return -np.inf
-    return lp + lnlike(data_fuv, data_nuv, sigma_fuv, sigma_nuv, theta, best_av, best_dav)
-
-
-def initialize(init, ndim, nwalkers):
     """
-    Offset the initial guess slightly for each walker
+    ln(posterior) of one point, or of all the walkers at once (see
+    sampling.lnprob_batch); the model is only computed inside the prior.
     """
-    pos = [init + 1e-4 * np.random.randn(ndim) for i in range(nwalkers)]
-    return pos
-
-
-def run_emcee(sampler, run_steps, restart_steps, pos, ndim, nwalkers, n_restarts=4):
-    """
-    Run an MCMC chain.
-
-    Parameters
-    ----------
-    sampler : emcee.ensemble.EnsembleSampler
-    run_steps : int ; number of steps for each walker takes in the main runs
-    restart_steps : int; number of steps each walker takes in the restart runs
-    pos : list ; ndim elements specifying starting points of theta
-    ndim : int ; number of parameters to fit for
-    nwalkers : number of walkers
-
-    Returns
-    -------
-    sampler : emcee.ensemble.EnsembleSampler
-    pos : final position of each walker in theta space
-
-    """
-
-    #print('First burn in')
-    pos, lp, state = sampler.run_mcmc(pos, run_steps)
-
-    # continue to burn in, restarting at maximum likelihood position each time
-    for i in range(n_restarts):
-        #print('Burn in: Restart ' + str(i + 1) + '/' + str(n_restarts))
-        sampler.reset()
-        pos, lp, state = sampler.run_mcmc(pos, restart_steps)
-        sel = np.where(sampler.flatlnprobability == np.max(sampler.flatlnprobability))
-        pos = initialize(np.mean(sampler.flatchain[sel], axis=0), ndim, nwalkers)
-
-    # one last burn in run
-    #print('Final burn in')
-    sampler.reset()
-    pos, lp, state = sampler.run_mcmc(pos, run_steps)
-    sel = np.where(sampler.flatlnprobability == np.max(sampler.flatlnprobability))
-    pos = initialize(np.mean(sampler.flatchain[sel], axis=0), ndim, nwalkers)
-    sampler.reset()
-
-    # actual mcmc run
-    #print('Actual Run')
-    sampler.run_mcmc(pos, run_steps)
-
-    return sampler, pos
-
-
-def plot_walkers(sampler, nwalkers, ndim, labels=None):
-    naxes = ndim + 1
-    fig, ax = plt.subplots(1, naxes, figsize=(naxes*3,naxes*1.5))
-
-    pp = np.asarray([sampler.chain[:,:, d] for d in range(ndim)])
-    for aa in range(ndim):
-        for w in range(nwalkers):
-            ax[aa].plot(pp[aa, w, :])
-    for w in range(nwalkers):
-        ax[aa+1].plot(sampler.lnprobability[w,:])
-
-    for i, ax in enumerate(fig.axes):
-        if labels:
-            labels.append('ln(prob)')
-            ax.set_ylabel(labels[i])
-            ax.set_xlabel('Steps')
-        ax.tick_params(labelsize=13)
-    plt.subplots_adjust(wspace=0.35, right=0.99, top=0.92, left=0.08,
-                        bottom=0.13)
-
-
-def plot_triangle(sampler, labels=None, truths=None, ndim=None):
-    import corner
-    corner.ScalarFormatter(useOffset=False)
-    lim = [(0.9995 * np.nanmin(sampler.flatchain[:,i]), 1.0005 * np.nanmax(sampler.flatchain[:,i])) for i in range(sampler.flatchain.shape[1])]
-    fig = corner.corner(sampler.flatchain, truths=truths, labels=labels,
-                        range=lim)
-
-
-def plot_data_dist(datax, datay, sampler):
-    from dustvar_paper_figs import make_2dhist_func
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
-
-    # first plot the real data
-    zticks = [1, 2, 5, 10, 20, 50]
-    xlim = [-0.01, 1.55]
-    ylim = [-1.02, 1.42]
-    cnorm = mcolors.LogNorm(vmin=1, vmax=zticks[-1])
-    hist_kwargs = {'func': 'count', 'bins': 75, 'xlim': xlim,
-                   'ylim': ylim, 'cnorm': cnorm}
-    im, cnorm, bindata = make_2dhist_func(ax, datax, datay, datay, cmap=plt.cm.Greys_r, **hist_kwargs)
-    ax.grid()
-    #plt.plot(datax, datay, marker='o', ms=1.5, color='k', lw=0)
-
-    ## Now over plot draws from the model
-    modx = np.linspace(0, 2.5, 100)
-    mean = np.percentile(sampler.flatchain[:,0], 50)
-    sigma = np.percentile(sampler.flatchain[:,1], 50)
-    mu_draw = np.random.normal(mean, sigma, 500)
-    for mu in mu_draw:
-        mody = modx * ext_func(mu, ftype=FTYPE, band=BAND, att=ATT)
-        ax.plot(modx, mody, lw=0.5, color='red', alpha=0.1)
-
-    ax.set_xlabel(r'$A_V$ + 1/2 $dA_V$')
-    ax.set_ylabel(r'$\Delta$ UV Color')
-    ax.set_xlim(xlim)
-    ax.set_ylim(ylim)
-
+    def like(t):
+        return lnlike(data_fuv, data_nuv, sigma_fuv, sigma_nuv, t, best_av, best_dav)
+    return sampling.lnprob_batch(theta, lnprior, like)
 
 
 def main(i, **kwargs):
@@ -273,6 +164,11 @@ def main(i, **kwargs):
 
     sigma_fuv, sigma_nuv = 0.3 * y_fuv, 0.3 * y_nuv
 
+    region = chain_io.region_name(i+1, z)
+    filename = os.path.join(data_loc, 'newred_data_' + region + '.h5')
+    if chain_io.has_region(filename, region):
+        print region, 'done, skipping'
+        return
 
     # steps to take in the burn in runs, restarts, and final run
     restart_steps = 300#500
@@ -288,8 +184,13 @@ def main(i, **kwargs):
     ndim, nwalkers = len(first_init), 16
 
 
-    # initialize the first guess with a slight offset for each walker
-    pos = initialize(first_init, ndim, nwalkers)
+    # initialize the first guess with a slight offset for each walker, drawn
+    # from the region's own streams if there's a seed
+    random_state = np.random
+    seed = kwargs.get('seed')
+    if seed is not None:
+        random_state, sampler_state = sampling.region_random_states(seed, i+1)
+    pos = initialize(first_init, ndim, nwalkers, random_state)
 
     #z = len(str(len(y_fuv)))
     # note starting time
@@ -297,29 +198,38 @@ def main(i, **kwargs):
 
     # args is what is passed to lnprob in addiiton to theta
     # doing one pixel
-    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob,
-                                    args=(y_fuv[i], y_nuv[i],
-                                          sigma_fuv[i], sigma_nuv[i],
-                                          av[i], dav[i]))
-
-    # Run emcee
+    lnprob_args = (y_fuv[i], y_nuv[i],
+                   sigma_fuv[i], sigma_nuv[i],
+                   av[i], dav[i])
+    def make_sampler(n):
+        # all the walkers go to lnprob in one call
+        return emcee.EnsembleSampler(n, ndim, lnprob, args=lnprob_args,
+                                     pool=sampling.BatchPool(lnprob, lnprob_args))
+    sampler = make_sampler(nwalkers)
+
+    if seed is not None:
+        sampler.random_state = sampler_state.get_state()
+
+    # Run emcee, resuming from the checkpoint of an interrupted run
+    checkpoint = chain_io.Checkpoint(chain_io.checkpoint_file(filename), region)
+    run_info = {}
     sampler, pos = run_emcee(sampler, run_steps, restart_steps, pos,
-                             ndim, nwalkers, n_restarts=n_restarts)
+                             ndim, nwalkers, n_restarts=n_restarts,
+                             checkpoint=checkpoint,
+                             thinned=kwargs.get('thinned', False),
+                             random_state=random_state,
+                             target_ess=kwargs.get('target_ess'),
+                             make_sampler=make_sampler,
+                             reinit=kwargs.get('reinit', 'prune'),
+                             record=run_info)
 
     # note end time
     t1 = time.time()
 
     # create a file to store data and write results
-    region = 'region_' + str(i+1).zfill(z)
-    filename = os.path.join(data_loc, 'newred_data_' + region + '.h5')
     with h5py.File(filename, 'w') as hf:
-        g = hf.create_group(region)
-        g.create_dataset('sampler_chain', data=sampler.chain)
-        g.create_dataset('sampler_flatchain', data=sampler.flatchain)
-        g.create_dataset('sampler_lnprob', data=sampler.lnprobability)
-        g.create_dataset(labs[0], data=np.percentile(sampler.flatchain[:,0], [16, 50, 84]))
-        g.create_dataset(labs[1], data=np.percentile(sampler.flatchain[:,1], [16, 50, 84]))
-        g.create_dataset('run_time', data=np.around(t1-t0, 2))
+        chain_io.write_region(hf, region, sampler, labs, t1-t0, run_info)
+    checkpoint.clear()
 
 
     print t1 - t0
@@ -328,20 +238,11 @@ def main(i, **kwargs):
 
 
 if __name__ == '__main__':
-    sps = fsps.StellarPopulation()
-    sps.params['sfh'] = 4
-    sps.params['const'] = 1.0
-    sps.params['imf_type'] = 2
-    wave, spec = sps.get_spectrum(tage=1.0, peraa=True)
-
-    M31_DM = 24.47
-    ATT = attenuation.conroy
-
-    filters = ['galex_fuv', 'galex_nuv']
-    filters = observate.load_filters(filters)
-
-    reg_num = get_args().reg
-    kwargs = {'wave': wave, 'spec': spec, 'filters': filters, 'M31_DM': M31_DM,
-              'ATT': ATT}
+    args = get_args()
+    reg_num = args.reg
+    compile_data.set_precision(args.precision)
+    kwargs = {'M31_DM': M31_DM, 'ATT': ATT, 'thinned': args.thin,
+              'seed': args.seed, 'target_ess': args.target_ess,
+              'reinit': args.reinit}
 
     main(reg_num, **kwargs)
@@ -1,38 +1,46 @@
 import numpy as np
-import fsps
 import emcee
 import h5py
 import time
 import os
 
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
-
-from sedpy import attenuation, observate
+from sedpy import attenuation
 import compile_data
-
-from joblib import Parallel, delayed
+import sed_model
+import chain_io
+import grid_posterior
+import regions
+import sampling
+from sampling import initialize, run_emcee
 
 from pdb import set_trace
 
 
-
-sps = fsps.StellarPopulation()
-sps.params['sfh'] = 4
-sps.params['const'] = 1.0
-sps.params['imf_type'] = 2
-wave, s = sps.get_spectrum(tage=1.0, peraa=True)
-
 M31_DM = 24.47
 ATT = attenuation.conroy
+# uniform priors: 0 < R_V < 10, 0 < f_bump < 1.5
+PRIOR_LO = np.array([0., 0.])
+PRIOR_HI = np.array([10., 1.5])
 
-filters = ['galex_fuv', 'galex_nuv']
-filters = observate.load_filters(filters)
+# the spectrum and filters are built by sed_model on first use
+bands = sed_model.BANDS
 
 write_hdf5 = False
-
-global_kwargs = {'filters': filters, 'M31_DM': M31_DM, 'ATT': ATT,
-          'write_hdf5': write_hdf5}
+thinned = False
+# 'emcee', 'grid' for the grid posteriors of grid_posterior, or 'map' for
+# all the regions at once on one grid (grid_posterior.fit_map)
+engine = 'emcee'
+# base seed of the per-region random streams; None uses numpy's global state
+seed = None
+# independent samples to aim for with an adaptive schedule (see
+# sampling.allocate); None runs the fixed schedule of run_model
+target_ess = None
+# how the walkers are restarted in the burn-in, see sampling.run_emcee
+reinit = 'prune'
+
+global_kwargs = {'bands': bands, 'M31_DM': M31_DM, 'ATT': ATT,
+          'write_hdf5': write_hdf5, 'thinned': thinned, 'engine': engine,
+          'seed': seed, 'target_ess': target_ess, 'reinit': reinit}
 
 def get_args():
     import argparse
@@ -42,6 +50,12 @@ def get_args():
     parser.add_argument('--DM', default=24.47, help='distance modulus')
     parser.add_argument('--ATT', default=attenuation.cardelli, help='dust curve')
     parser.add_argument('--write_hdf5', action='store_true', help='write data to hdf5 file')
+    parser.add_argument('--engine', default='emcee', choices=['emcee', 'grid', 'map'], help='sample with emcee, evaluate the posterior on a grid, or do the whole map on one grid (grid and map are always written to file)')
+    parser.add_argument('--seed', type=int, default=None, help='base seed of the per-region random streams, for reproducible runs')
+    parser.add_argument('--target_ess', type=float, default=None, help='adapt the walkers and steps of each region to this effective sample size, after a pilot run')
+    parser.add_argument('--reinit', default='prune', choices=['prune', 'recenter'], help='restart the burn-in by moving the stuck walkers onto the others, or all of them to the best sample')
+    parser.add_argument('--thin', action='store_true', help='store only the chain thinned by its autocorrelation time, and summaries')
+    parser.add_argument('--precision', default='float64', choices=['float32', 'float64'], help='precision of the maps and stored chains')
     return parser.parse_args()
 
 
@@ -67,16 +81,26 @@ def get_data(res='90', dust_curve='cardelli'):
     sfr = sfr[np.isfinite(sfr)]
     sel = (sfr > 1e-5) & (data_color < 2.)
 
-    return data_fuv, data_nuv, data_color, av
+    # the maps may be float32; the likelihood is always done in float64
+    return [x.astype(float) for x in (data_fuv, data_nuv, data_color, av)]
+
+
+def get_map_data(res='90', dust_curve='cardelli'):
+    """
+    FUV and NUV flux ratios and optical Av+dAv of the pixels where all three
+    are finite, and the regions.RegionIndex of those pixels, so the results
+    of the whole-map fit go back to the pixels they came from.
+    """
+    fuvdata, nuvdata, otherdata = compile_data.gather_map_data(res, dust_curve)
+    maps = [fuvdata['fluxobs'] / fuvdata['fluxmodint'],
+            nuvdata['fluxobs'] / nuvdata['fluxmodint'], otherdata['avdav']]
+    index = regions.RegionIndex(np.all([np.isfinite(m) for m in maps], axis=0))
+    # the maps may be float32; the likelihood is always done in float64
+    return [index.gather(m).astype(float) for m in maps] + [index]
 
 
 def get_spectrum():
-    sps = fsps.StellarPopulation()
-    sps.params['sfh'] = 4
-    sps.params['const'] = 1.0
-    sps.params['imf_type'] = 2
-    wave, s = sps.get_spectrum(tage=1.0, peraa=True)
-    return wave, s
+    return sed_model.get_spectrum(tage=1.0)
 
 
 def ext_func(rv, av, f_bump=1., att=attenuation.conroy):
@@ -89,112 +113,58 @@ def ext_func(rv, av, f_bump=1., att=attenuation.conroy):
     av : float ; A_V for the given region
     f_bump : float, optional; strength of the 2175 \AA bump in fraction of MW bump strength
     att : sedpy.attenuation funcion, optional; attenuation curve to use. Default: attenuation.conroy
-    """
-    tau_v = av / 1.086
-    tau_lambda = att(wave, R_v=rv, f_bump=f_bump, tau_v=tau_v)
-    f2 = s * np.exp(-tau_lambda)
-    mags_red = observate.getSED(wave, f2, filters)
-    mags = observate.getSED(wave, s, filters)
 
-    fluxes_red = [3631*10**(-0.4 * (mag + M31_DM)) for mag in mags_red]
-    fluxes = [3631 * 10**(-0.4 * (mag + M31_DM)) for mag in mags]
-    val_fuv = fluxes_red[0] / fluxes[0]
-    val_nuv = fluxes_red[1] / fluxes[1]
+    rv and f_bump can also be arrays, e.g. one value per walker, and the
+    ratios then come back as arrays of their shape.
+    """
+    shape = np.broadcast(rv, av, f_bump).shape
+    ratios = sed_model.flux_ratios(rv, av, 0., f_bump, att=att, bands=bands)
+    val_fuv, val_nuv = ratios.T.reshape((2,) + shape)
 
     return val_fuv, val_nuv
 
 
 def lnlike(data_fuv, data_nuv, sigma_fuv, sigma_nuv, theta, best_av):
     """
-    data_fuv, etc are for a SINGLE pixel
+    data_fuv, etc are for a SINGLE pixel; theta is one [R_V, f_bump] or an
+    (nwalkers, 2) array of them
     """
-    model = ext_func(theta[0], best_av, f_bump=theta[1], att=ATT)
+    theta = np.asarray(theta)
+    model = ext_func(theta[...,0], best_av, f_bump=theta[...,1], att=ATT)
     val = ((model[0] - data_fuv)**2/sigma_fuv**2) + ((model[1] - data_nuv)**2/sigma_nuv**2)
     return -0.5 * val
 
 
 def lnprior(theta):
     """
-    Set the priors on the model parameters
+    Set the priors on the model parameters. theta is one [R_V, f_bump] or
+    an (nwalkers, 2) array of them.
     """
-    # theta = [Rv, av, f_bump] ## doing R_V only for now
-    if 0. < theta[0] < 10. and 0. < theta[1] < 1.5:
-        return 0.0
-    return -np.inf
+    return sampling.box_lnprior(theta, PRIOR_LO, PRIOR_HI)
 
 
 def lnprob(theta, data_fuv, data_nuv, sigma_fuv, sigma_nuv, best_av):
-    lp = lnprior(theta)
-    if not np.isfinite(lp):
-        return -np.inf
-    #print theta, lp + lnlike(data_fuv, data_nuv, sigma_fuv, sigma_nuv, theta, best_av)
-    return lp + lnlike(data_fuv, data_nuv, sigma_fuv, sigma_nuv, theta, best_av)
-
-
-def initialize(init, ndim, nwalkers):
     """
-    Offset the initial guess slightly for each walker
+    ln(posterior) of one point, or of all the walkers at once (see
+    sampling.lnprob_batch); the model is only computed inside the prior.
     """
-    pos = [init + 1e-4 * np.random.randn(ndim) for i in range(nwalkers)]
-    return pos
-
-
-def run_emcee(sampler, run_steps, restart_steps, pos, ndim, nwalkers, n_restarts=4):
-    """
-    Run an MCMC chain.
-
-    Parameters
-    ----------
-    sampler : emcee.ensemble.EnsembleSampler
-    run_steps : int ; number of steps for each walker takes in the main runs
-    restart_steps : int; number of steps each walker takes in the restart runs
-    pos : list ; ndim elements specifying starting points of theta
-    ndim : int ; number of parameters to fit for
-    nwalkers : number of walkers
-    n_restarts : int (optional) ; number of times to restart the burn-in
-
-    Returns
-    -------
-    sampler : emcee.ensemble.EnsembleSampler
-    pos : final position of each walker in theta space
-
-    """
-
-    #print('First burn in')
-    pos, lp, state = sampler.run_mcmc(pos, run_steps)
-
-    # continue to burn in, restarting at maximum likelihood position each time
-    for i in range(n_restarts):
-        #print('Burn in: Restart ' + str(i + 1) + '/' + str(n_restarts))
-        sampler.reset()
-        pos, lp, state = sampler.run_mcmc(pos, restart_steps)
-        sel = np.where(sampler.flatlnprobability == np.max(sampler.flatlnprobability))
-        pos = initialize(np.mean(sampler.flatchain[sel], axis=0), ndim, nwalkers)
-
-    # one last burn in run
-    #print('Final burn in')
-    sampler.reset()
-    pos, lp, state = sampler.run_mcmc(pos, run_steps)
-    sel = np.where(sampler.flatlnprobability == np.max(sampler.flatlnprobability))
-    pos = initialize(np.mean(sampler.flatchain[sel], axis=0), ndim, nwalkers)
-    sampler.reset()
-
-    # actual mcmc run
-    #print('Actual Run')
-    sampler.run_mcmc(pos, run_steps)
-
-    return sampler, pos
+    def like(t):
+        return lnlike(data_fuv, data_nuv, sigma_fuv, sigma_nuv, t, best_av)
+    return sampling.lnprob_batch(theta, lnprior, like)
 
 
 def to_screen(inds, nwalkers, ndim, n_restarts, run_steps, restart_steps, pos, y_fuv, y_nuv, sigma_fuv, sigma_nuv, avdav, labels=None):
     """
     Run emcee and print the results to the console.
     """
+    import matplotlib.pyplot as plt
+    from model_plots import plot_triangle
     for i in inds:
         print i
         t0 = time.time()
-        sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob,
-                                        args=(y_fuv[i-1], y_nuv[i-1], sigma_fuv[i-1], sigma_nuv[i-1], avdav[i-1]))
+        lnprob_args = (y_fuv[i-1], y_nuv[i-1], sigma_fuv[i-1], sigma_nuv[i-1], avdav[i-1])
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob, args=lnprob_args,
+                                        pool=sampling.BatchPool(lnprob, lnprob_args))
         # Run emcee
         sampler, pos = run_emcee(sampler, run_steps, restart_steps, pos,
                                  ndim, nwalkers, n_restarts=n_restarts)
@@ -204,39 +174,78 @@ def to_screen(inds, nwalkers, ndim, n_restarts, run_steps, restart_steps, pos, y
         print 'f_bump: ', np.percentile(sampler.flatchain[:,1], [16,50,84])
         print 'Run took ' + str(np.around(t1-t0, 2))+' seconds.'
         print(' ')
-        plot_triangle(sampler, labels=labels, truths=None, ndim=ndim)
+        plot_triangle(sampler, labels=labels, truths=None, ndim=ndim, start=200)
         plt.show()
         return sampler
 
-def to_file(inds, nwalkers, ndim, n_restarts, run_steps, restart_steps, pos, filename, labs, y_fuv, y_nuv, sigma_fuv, sigma_nuv, avdav):
+def to_file(inds, nwalkers, ndim, n_restarts, run_steps, restart_steps, pos, filename, labs, y_fuv, y_nuv, sigma_fuv, sigma_nuv, avdav, thinned=False, seed=None, init=None, target_ess=None, reinit='prune'):
     """
-    Run emcee and print the results to a file
+    Run emcee and print the results to a file.
+
+    Regions already in the file are skipped, and a region whose fit was
+    interrupted resumes from its last checkpoint, so a killed run can simply
+    be started again. If thinned, only the chain thinned by its
+    autocorrelation time and its summaries are written.
+
+    Without a seed each region starts where the last one's walkers were
+    restarted for production, and all draws come from numpy's global state.
+    With a seed every region starts from its own walkers around init, and
+    all its draws come from its own streams (sampling.region_random_states),
+    so its chain doesn't depend on which regions were run before it.
+
+    The interrupted region resumes exactly, but the ones after it only
+    match an uninterrupted run if seed is given: unseeded, a skipped region
+    neither moves pos nor advances numpy's global random state.
+
+    With target_ess, each region's walkers and steps are set after a pilot
+    run (see sampling.allocate) and the schedule is kept with its results.
+    The wall time and acceptance of each phase and the calls and timings of
+    the forward model (sampling.run_stats) are kept as well.
     """
-    with h5py.File(filename, 'w') as hf:
+    sampler = None
+    ckptfile = chain_io.checkpoint_file(filename)
+    with h5py.File(filename, 'a') as hf:
         z = len(str(len(y_fuv)))
         # args is what is passed to lnprob in addiiton to theta
         # this loops over one pixel at a time
         for i in inds:
+            region = chain_io.region_name(i, z)
+            if region in hf:
+                print region, 'done, skipping'
+                continue
             print i
             t0 = time.time()
-            sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob,
-                                            args=(y_fuv[i-1], y_nuv[i-1],
-                                                  sigma_fuv[i-1], sigma_nuv[i-1],
-                                                  avdav[i-1]))
+            lnprob_args = (y_fuv[i-1], y_nuv[i-1], sigma_fuv[i-1],
+                           sigma_nuv[i-1], avdav[i-1])
+            def make_sampler(n):
+                # all the walkers go to lnprob in one call
+                return emcee.EnsembleSampler(n, ndim, lnprob, args=lnprob_args,
+                                             pool=sampling.BatchPool(lnprob, lnprob_args))
+            sampler = make_sampler(nwalkers)
+            random_state = np.random
+            if seed is not None:
+                random_state, sampler_state = sampling.region_random_states(seed, i)
+                sampler.random_state = sampler_state.get_state()
+                pos = initialize(init, ndim, nwalkers, random_state)
+            elif target_ess is not None:
+                # the last region may have ended with more walkers
+                pos = sampling.resize(pos, nwalkers, random_state)
             # Run emcee
+            run_info = {}
+            checkpoint = chain_io.Checkpoint(ckptfile, region)
             sampler, pos = run_emcee(sampler, run_steps, restart_steps, pos,
-                                     ndim, nwalkers, n_restarts=n_restarts)
+                                     ndim, nwalkers, n_restarts=n_restarts,
+                                     checkpoint=checkpoint, thinned=thinned,
+                                     random_state=random_state,
+                                     target_ess=target_ess,
+                                     make_sampler=make_sampler, reinit=reinit,
+                                     record=run_info)
             t1 = time.time()
 
             # write the results to file
-            region = 'region_' + str(i).zfill(z)
-            g = hf.create_group(region)
-            g.create_dataset('sampler_chain', data=sampler.chain)
-            g.create_dataset('sampler_flatchain', data=sampler.flatchain)
-            g.create_dataset('sampler_lnprob', data=sampler.lnprobability)
-            g.create_dataset(labs[0], data=np.percentile(sampler.flatchain[:,0], [16, 50, 84]))
-            g.create_dataset(labs[1], data=np.percentile(sampler.flatchain[:,1], [16, 50, 84]))
-            g.create_dataset('run_time', data=np.around(t1-t0, 2))
+            chain_io.write_region(hf, region, sampler, labs, t1-t0, run_info)
+            hf.flush()
+            checkpoint.clear()
     return sampler
 
 
@@ -246,14 +255,28 @@ def run_model(regs=None, **kwargs):
     """
     M31_DM = kwargs.get('M31_DM', global_kwargs['M31_DM'])
     ATT = kwargs.get('ATT', global_kwargs['ATT'])
-    filters = kwargs.get('filters', global_kwargs['filters'])
+    bands = kwargs.get('bands', global_kwargs['bands'])
     write_hdf5 = kwargs.get('write_hdf5', global_kwargs['write_hdf5'])
+    thinned = kwargs.get('thinned', global_kwargs['thinned'])
+    engine = kwargs.get('engine', global_kwargs['engine'])
+    seed = kwargs.get('seed', global_kwargs['seed'])
+    target_ess = kwargs.get('target_ess', global_kwargs['target_ess'])
+    reinit = kwargs.get('reinit', global_kwargs['reinit'])
     reg_nums = kwargs.get('reg_nums', None)
 
     ## location to store data
     data_loc = '/Users/alexialewis/research/PHAT/dustvar/'
 
-    wave, s = get_spectrum()
+    if engine == 'map':
+        # the data come with the index of their own pixels, since get_data
+        # selects each vector separately
+        y_fuv, y_nuv, avdav, index = get_map_data()
+        filename = os.path.join(data_loc, 'rv_fbump_map.hdf5')
+        data = np.column_stack([y_fuv, y_nuv])
+        sigma = 0.3 * data
+        grid_posterior.fit_map(filename, data, sigma, avdav, index=index,
+                               att=ATT, bands=bands)
+        return None
 
     # gather the real data
     y_fuv, y_nuv, y_color, avdav = get_data()
@@ -267,7 +290,15 @@ def run_model(regs=None, **kwargs):
     else:
         inds = range(1, len(y_fuv)+1)  #range(len(y_fuv))
 
-    # steps to take in the burn in runs, restarts, and final run
+    if engine == 'grid':
+        filename = os.path.join(data_loc, 'rv_fbump_grid.hdf5')
+        grid_posterior.to_file(filename, inds, y_fuv, y_nuv, sigma_fuv,
+                               sigma_nuv, avdav, att=ATT, bands=bands)
+        return None
+
+    # steps to take in the burn in runs, restarts, and final run; with
+    # target_ess these are replaced by each region's own, apart from the
+    # restarts of the hard regions
     restart_steps = 500
     run_steps = 1000
     n_restarts = 8
@@ -290,75 +321,17 @@ def run_model(regs=None, **kwargs):
         filename = os.path.join(data_loc + 'rv_fbump.hdf5')
         args = args + (filename, labs, )
         args = args + lnprob_args
-        sampler = to_file(*args)
+        sampler = to_file(*args, thinned=thinned, seed=seed, init=first_init,
+                          target_ess=target_ess, reinit=reinit)
     else:
         args = args + lnprob_args
         sampler = to_screen(*args, labels=labels)
     return sampler
 
 
-def plot_walkers(sampler, nwalkers, ndim, labels=None):
-    naxes = ndim + 1
-    fig, ax = plt.subplots(1, naxes, figsize=(naxes*3,naxes*1.5))
-
-    pp = np.asarray([sampler.chain[:,:, d] for d in range(ndim)])
-    for aa in range(ndim):
-        for w in range(nwalkers):
-            ax[aa].plot(pp[aa, w, :])
-    for w in range(nwalkers):
-        ax[aa+1].plot(sampler.lnprobability[w,:])
-
-    for i, ax in enumerate(fig.axes):
-        if labels:
-            labels.append('ln(prob)')
-            ax.set_ylabel(labels[i])
-            ax.set_xlabel('Steps')
-        ax.tick_params(labelsize=13)
-    plt.subplots_adjust(wspace=0.35, right=0.99, top=0.92, left=0.08,
-                        bottom=0.13)
-
-def plot_triangle(sampler, labels=None, truths=None, ndim=None):
-    import corner
-    corner.ScalarFormatter(useOffset=False)
-    #lim = [(0.9995 * np.nanmin(sampler.flatchain[:,i]), 1.0005 * np.nanmax(sampler.flatchain[:,i])) for i in range(sampler.flatchain.shape[1])]
-    fig = corner.corner(sampler.flatchain[200:,:], truths=truths, labels=labels)#,range=lim)
-
-def plot_data_dist(datax, datay, sampler):
-    from dustvar_paper_figs import make_2dhist_func
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
-
-    # first plot the real data
-    zticks = [1, 2, 5, 10, 20, 50]
-    xlim = [-0.01, 1.55]
-    ylim = [-1.02, 1.42]
-    cnorm = mcolors.LogNorm(vmin=1, vmax=zticks[-1])
-    hist_kwargs = {'func': 'count', 'bins': 75, 'xlim': xlim,
-                   'ylim': ylim, 'cnorm': cnorm}
-    im, cnorm, bindata = make_2dhist_func(ax, datax, datay, datay, cmap=plt.cm.Greys_r, **hist_kwargs)
-    ax.grid()
-    #plt.plot(datax, datay, marker='o', ms=1.5, color='k', lw=0)
-
-    ## Now over plot draws from the model
-    modx = np.linspace(0, 2.5, 100)
-    mean = np.percentile(sampler.flatchain[:,0], 50)
-    sigma = np.percentile(sampler.flatchain[:,1], 50)
-    mu_draw = np.random.normal(mean, sigma, 500)
-    for mu in mu_draw:
-        mody = modx * ext_func(mu, ftype=FTYPE, band=BAND, att=ATT)
-        ax.plot(modx, mody, lw=0.5, color='red', alpha=0.1)
-
-    ax.set_xlabel(r'$A_V$ + 1/2 $dA_V$')
-    ax.set_ylabel(r'$\Delta$ UV Color')
-    ax.set_xlim(xlim)
-    ax.set_ylim(ylim)
-
-
-
-
-
 if __name__ == '__main__':
     args = get_args()
+    compile_data.set_precision(args.precision)
     if args.regs:
         global_kwargs['reg_nums'] = args.regs
     elif args.range:
@@ -367,6 +340,11 @@ if __name__ == '__main__':
         global_kwargs['reg_nums'] = None
     if args.write_hdf5:
         global_kwargs['write_hdf5'] = args.write_hdf5
+    global_kwargs['thinned'] = args.thin
+    global_kwargs['engine'] = args.engine
+    global_kwargs['seed'] = args.seed
+    global_kwargs['target_ess'] = args.target_ess
+    global_kwargs['reinit'] = args.reinit
 
     sampler = run_model(**global_kwargs)
 
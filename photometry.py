@@ -0,0 +1,97 @@
+"""
+GALEX and AB flux <-> magnitude conversions for whole maps and batches of
+model fluxes.
+
+The GALEX conversions are those of Morrissey et al. (2007):
+
+    m_FUV = -2.5 log10(f_lambda / 1.40e-15) + 18.82
+    m_NUV = -2.5 log10(f_lambda / 2.06e-16) + 20.08
+
+with f_lambda in erg s-1 cm-2 A-1. Each reduces to m = -2.5 log10(f) + zp,
+and the zp's are worked out once here.
+
+Every function takes `out`, as numpy ufuncs do, to convert an array in
+place, and `dtype`, e.g. np.float32 to halve the memory used by a map.
+`band` can be a single band name or a list of names, one per column (last
+axis) of the input.
+"""
+import numpy as np
+
+
+AB_JY = 3631.
+
+# f_lambda of a source of magnitude GALEX_MAG[band]
+GALEX_FLAM = {'galex_fuv': 1.40e-15, 'galex_nuv': 2.06e-16}
+GALEX_MAG = {'galex_fuv': 18.82, 'galex_nuv': 20.08}
+
+# m = -2.5 log10(f_lambda) + GALEX_ZP[band]
+GALEX_ZP = dict((band, GALEX_MAG[band] + 2.5 * np.log10(GALEX_FLAM[band]))
+                for band in GALEX_FLAM)
+
+
+def galex_zp(band):
+    """
+    Zero point(s) of one band name or a list of them. Band names are not
+    case sensitive ('galex_FUV' is sedpy's name for 'galex_fuv').
+    """
+    if isinstance(band, str):
+        return GALEX_ZP[band.lower()]
+    return np.asarray([GALEX_ZP[b.lower()] for b in band])
+
+
+def _prepare(x, out, dtype):
+    # copy into out (or a new array) with the requested type
+    if out is None:
+        return np.array(x, dtype=dtype if dtype is not None else float)
+    if out is not x:
+        out[...] = x
+    return out
+
+
+def galex_flux2mag(flux, band, out=None, dtype=None):
+    """
+    GALEX AB magnitude of a flux in erg s-1 cm-2 A-1. Non-positive fluxes
+    give NaN or -inf, without a warning.
+
+    Parameters
+    ----------
+    flux : array_like ; fluxes
+    band : str or list ; 'galex_fuv' or 'galex_nuv', or one per column of flux
+    out : array, optional ; where to put the result (may be flux itself)
+    dtype : numpy dtype, optional ; type of a new result array. Default: float
+
+    Returns
+    -------
+    mag : array ; magnitudes, same shape as flux
+    """
+    mag = _prepare(flux, out, dtype)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        np.log10(mag, out=mag)
+    mag *= -2.5
+    mag += galex_zp(band)
+    return mag
+
+
+def galex_mag2flux(mag, band, out=None, dtype=None):
+    """
+    Flux in erg s-1 cm-2 A-1 of a GALEX AB magnitude. Arguments as in
+    galex_flux2mag.
+    """
+    flux = _prepare(mag, out, dtype)
+    flux -= galex_zp(band)
+    flux *= -0.4
+    np.power(10., flux, out=flux)
+    return flux
+
+
+def ab_mag2jy(mag, dmod=0., out=None, dtype=None):
+    """
+    f_nu in Jy of an AB magnitude, after moving the source by a distance
+    modulus dmod (i.e. from absolute to apparent magnitude).
+    """
+    flux = _prepare(mag, out, dtype)
+    flux += dmod
+    flux *= -0.4
+    np.power(10., flux, out=flux)
+    flux *= AB_JY
+    return flux
@@ -5,7 +5,7 @@ import os
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
 import sys
-import astrogrid
+import photometry
 from matplotlib.ticker import ScalarFormatter, LogFormatter
 from pdb import set_trace
 import plot_extcurves
@@ -188,12 +188,12 @@ avdav = pyfits.getdata(avdavfile)
 av = pyfits.getdata(avfile)
 dav = pyfits.getdata(davfile)
 
-fuvmagobs = astrogrid.flux.galex_flux2mag(fuvfluxobs, 'galex_fuv')
-fuvmagmodint = astrogrid.flux.galex_flux2mag(fuvfluxmodint, 'galex_fuv')
-fuvmagmodred = astrogrid.flux.galex_flux2mag(fuvfluxmodred, 'galex_fuv')
-nuvmagobs = astrogrid.flux.galex_flux2mag(nuvfluxobs, 'galex_nuv')
-nuvmagmodint = astrogrid.flux.galex_flux2mag(nuvfluxmodint, 'galex_nuv')
-nuvmagmodred = astrogrid.flux.galex_flux2mag(nuvfluxmodred, 'galex_nuv')
+fuvmagobs = photometry.galex_flux2mag(fuvfluxobs, 'galex_fuv')
+fuvmagmodint = photometry.galex_flux2mag(fuvfluxmodint, 'galex_fuv')
+fuvmagmodred = photometry.galex_flux2mag(fuvfluxmodred, 'galex_fuv')
+nuvmagobs = photometry.galex_flux2mag(nuvfluxobs, 'galex_nuv')
+nuvmagmodint = photometry.galex_flux2mag(nuvfluxmodint, 'galex_nuv')
+nuvmagmodred = photometry.galex_flux2mag(nuvfluxmodred, 'galex_nuv')
 
 cmap2 = plt.cm.Blues
 cmap2.set_under('0.65')
@@ -0,0 +1,55 @@
+"""
+Running totals of the calls and wall time of the parts of the forward
+models, to find the slow regions and catch regressions.
+
+The models wrap their parts in `timed` blocks: 'attenuation' (evaluating
+the attenuation curve), 'reddening' (applying it to the spectrum) and
+'filters' (integrating through the filters), and sampling.lnprob_batch
+counts the 'lnprob' evaluations and the 'lnlike' ones, which run the
+forward model. The totals are kept per process; sampling.run_emcee takes
+the difference between snapshots to get a region's share.
+"""
+import time
+
+
+_CALLS = {}
+_TIMES = {}
+
+
+class timed(object):
+    """
+    Context manager adding the wall time of its block to part, and n to
+    the calls of part (e.g. the number of models computed in the block).
+    """
+    def __init__(self, part, n=1):
+        self.part = part
+        self.n = n
+
+    def __enter__(self):
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        add(self.part, self.n, time.time() - self.t0)
+        return False
+
+
+def add(part, n=1, seconds=0.):
+    """ Count n calls of part that took seconds in all. """
+    _CALLS[part] = _CALLS.get(part, 0) + n
+    _TIMES[part] = _TIMES.get(part, 0.) + seconds
+
+
+def snapshot():
+    """ The current totals, as {part: (calls, seconds)}. """
+    return dict((part, (_CALLS[part], _TIMES[part])) for part in _CALLS)
+
+
+def since(snap):
+    """ {part: (calls, seconds)} added since snapshot snap was taken. """
+    out = {}
+    for part, (n, t) in snapshot().items():
+        n0, t0 = snap.get(part, (0, 0.))
+        if n > n0:
+            out[part] = (n - n0, t - t0)
+    return out
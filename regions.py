@@ -0,0 +1,244 @@
+"""
+Mapping between region numbers and map pixels.
+
+A region is a pixel that is inside the weight mask and has a finite SFR.
+Regions are numbered 0, 1, 2, ... in the order of the flattened map, which
+is the order of the per-region fits ('region_00000', ...) and of the grids
+of median R_V and f_bump. The index is built once per resolution, saved
+next to the maps, and rebuilt only when the weights or SFR map change.
+"""
+import os
+import numpy as np
+
+import compile_data
+
+
+INDEX_FILE = 'region_index.npz'
+
+_INDEXES = {}
+_MASKS = {}
+
+
+class RegionIndex(object):
+    """
+    Region <-> pixel lookups, and scatter/gather between per-region vectors
+    and 2-d maps.
+
+    Parameters
+    ----------
+    mask : (ny, nx) bool array ; True for pixels that are regions
+    """
+    def __init__(self, mask):
+        self.mask = np.asarray(mask, dtype=bool)
+        self.shape = self.mask.shape
+        self.flat = np.flatnonzero(self.mask)
+        self.y, self.x = np.unravel_index(self.flat, self.shape)
+        # region number of every pixel, -1 outside the mask
+        self.regmap = np.full(self.shape, -1, dtype=int)
+        self.regmap.flat[self.flat] = np.arange(len(self.flat))
+
+    def __len__(self):
+        return len(self.flat)
+
+    @property
+    def nregions(self):
+        return len(self.flat)
+
+    def region(self, y, x):
+        """ Region number(s) of pixel(s) (y, x); -1 where there is none. """
+        return self.regmap[y, x]
+
+    def pixel(self, reg):
+        """ (y, x) of region number(s) reg. """
+        return self.y[reg], self.x[reg]
+
+    def gather(self, data):
+        """
+        Per-region values of a map. data can have extra leading axes, e.g.
+        a stack of maps (nmaps, ny, nx) gives (nmaps, nregions).
+        """
+        data = np.asarray(data)
+        return data.reshape(data.shape[:-2] + (-1,))[..., self.flat]
+
+    def scatter(self, values, fill=np.nan):
+        """
+        Map of per-region values, with `fill` outside the regions. values
+        can have extra trailing axes, e.g. (nregions, 2) gives (ny, nx, 2).
+        """
+        values = np.asarray(values)
+        out = np.full(self.shape + values.shape[1:], fill,
+                      dtype=np.result_type(values, fill))
+        out[self.mask] = values
+        return out
+
+    def select(self, mask):
+        """ Numbers of the regions whose pixels are True in a 2-d mask. """
+        return np.flatnonzero(self.gather(mask))
+
+    def in_ellipse(self, center, width, height, angle=0.):
+        """ Regions inside an ellipse in pixel coordinates, see ellipse_mask. """
+        return self.select(ellipse_mask(self.shape, center, width, height, angle))
+
+    def in_annulus(self, center, inner, outer, axis_ratio=1., angle=0.):
+        """ Regions inside an elliptical annulus, see annulus_mask. """
+        return self.select(annulus_mask(self.shape, center, inner, outer,
+                                        axis_ratio, angle))
+
+    def in_polygon(self, vertices):
+        """ Regions inside a polygon in pixel coordinates, see polygon_mask. """
+        return self.select(polygon_mask(self.shape, vertices))
+
+    def in_sky_ellipse(self, h, ra, dec, width, height, pa=0.):
+        """ Regions inside an ellipse on the sky, see sky_ellipse. """
+        center, width, height, angle = sky_ellipse(h, ra, dec, width, height, pa)
+        return self.in_ellipse(center, width, height, angle)
+
+    def save(self, filename):
+        np.savez(filename, mask=self.mask)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as f:
+            return cls(f['mask'])
+
+
+def _index_sources(res):
+    _DATA_DIR, _WORK_DIR, _MOD_DIR = compile_data.define_dir_structure(res)
+    return _DATA_DIR, [os.path.join(_DATA_DIR, 'weights_orig.fits'),
+                       os.path.join(_DATA_DIR, 'sfr100.fits')]
+
+
+def build_region_index(res='90'):
+    """
+    Make the region index for a resolution from the weights and SFR map,
+    and save it in the res_<res>pc directory.
+    """
+    data_dir, sources = _index_sources(res)
+    w, h, sel = compile_data.read_weights(data_dir)
+    sfr100 = compile_data.read_map(sources[1], w, sel)
+    index = RegionIndex(np.isfinite(sfr100))
+    index.save(os.path.join(data_dir, INDEX_FILE))
+    return index
+
+
+def get_region_index(res='90'):
+    """
+    Region index for a resolution: from memory if already loaded in this
+    process, else from its saved file, else built from the maps.
+    """
+    if res in _INDEXES:
+        return _INDEXES[res]
+    data_dir, sources = _index_sources(res)
+    indexfile = os.path.join(data_dir, INDEX_FILE)
+    if (os.path.exists(indexfile) and
+        all(os.path.getmtime(f) <= os.path.getmtime(indexfile) for f in sources)):
+        index = RegionIndex.load(indexfile)
+    else:
+        index = build_region_index(res)
+    _INDEXES[res] = index
+    return index
+
+
+def _cached_mask(key, make):
+    # masks are kept by their parameters and shared, so they're read-only
+    if key not in _MASKS:
+        mask = make()
+        mask.setflags(write=False)
+        _MASKS[key] = mask
+    return _MASKS[key]
+
+
+def _pixel_coords(shape):
+    # x (column) and y (row) of every pixel center
+    y, x = np.indices(shape)
+    return x, y
+
+
+def _ellipse_radius(shape, center, axis_ratio, angle):
+    # elliptical radius of every pixel, along the major axis
+    x, y = _pixel_coords(shape)
+    dx, dy = x - center[0], y - center[1]
+    theta = np.radians(angle)
+    u = dx * np.cos(theta) + dy * np.sin(theta)
+    v = -dx * np.sin(theta) + dy * np.cos(theta)
+    return np.hypot(u, v / axis_ratio)
+
+
+def ellipse_mask(shape, center, width, height, angle=0.):
+    """
+    Pixels inside an ellipse, with the same parameters as a matplotlib
+    patches.Ellipse drawn over imshow(map): center is (x, y) = (column, row),
+    width and height are full axis lengths in pixels and angle rotates the
+    width axis counter-clockwise from x, in degrees.
+    """
+    key = ('ellipse', shape, tuple(center), width, height, angle)
+    def make():
+        return _ellipse_radius(shape, center, float(height) / width, angle) <= width / 2.
+    return _cached_mask(key, make)
+
+
+def annulus_mask(shape, center, inner, outer, axis_ratio=1., angle=0.):
+    """
+    Pixels between two concentric ellipses of the same shape, with
+    semi-major axes inner and outer (in pixels). axis_ratio is minor/major
+    and angle is as in ellipse_mask. With axis_ratio = cos(inclination) this
+    is a ring of deprojected galactocentric radius.
+    """
+    key = ('annulus', shape, tuple(center), inner, outer, axis_ratio, angle)
+    def make():
+        r = _ellipse_radius(shape, center, axis_ratio, angle)
+        return (r >= inner) & (r < outer)
+    return _cached_mask(key, make)
+
+
+def polygon_mask(shape, vertices):
+    """
+    Pixels inside a polygon with vertices [(x0, y0), (x1, y1), ...] in
+    pixel coordinates (even-odd rule, as in matplotlib's Path).
+    """
+    vertices = tuple(map(tuple, np.asarray(vertices, dtype=float)))
+    key = ('polygon', shape, vertices)
+    def make():
+        x, y = _pixel_coords(shape)
+        inside = np.zeros(shape, dtype=bool)
+        vx, vy = np.asarray(vertices).T
+        # cast a ray in +x from every pixel and count the edges it crosses
+        for x0, y0, x1, y1 in zip(vx, vy, np.roll(vx, -1), np.roll(vy, -1)):
+            if y0 == y1:
+                continue
+            crosses = (y0 > y) != (y1 > y)
+            xcross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+            inside ^= crosses & (x < xcross)
+        return inside
+    return _cached_mask(key, make)
+
+
+def sky_ellipse(h, ra, dec, width, height, pa=0.):
+    """
+    Convert an ellipse on the sky to the pixel parameters of ellipse_mask.
+
+    Parameters
+    ----------
+    h : FITS header of the maps
+    ra, dec : float ; center in degrees
+    width, height : float ; major and minor axis lengths in arcsec
+    pa : float, optional ; position angle of the major axis, degrees east of
+        north
+
+    Returns
+    -------
+    center, width, height, angle : as for ellipse_mask
+    """
+    from astropy.wcs import WCS
+    wcs = WCS(h)
+    eps = 1. / 3600.
+    (x, y), (xn, yn), (xe, ye) = wcs.wcs_world2pix(
+        [[ra, dec], [ra, dec + eps], [ra + eps / np.cos(np.radians(dec)), dec]], 0)
+    north = np.array([xn - x, yn - y])
+    east = np.array([xe - x, ye - y])
+    # pixels per arcsec along the sky axes
+    scale = np.hypot(*north)
+    pa = np.radians(pa)
+    major = np.cos(pa) * north + np.sin(pa) * east
+    angle = np.degrees(np.arctan2(major[1], major[0]))
+    return (x, y), width * scale, height * scale, angle
@@ -1,26 +1,18 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from sedpy import attenuation, observate
+from sedpy import attenuation
 from scipy.stats import binned_statistic_2d
 import matplotlib.colors as mcolors
-import fsps
 import compile_data
+import regions
+import sed_model
 import os
 from matplotlib.ticker import ScalarFormatter, LogFormatter
 from pdb import set_trace
 
-sps = fsps.StellarPopulation()
-sps.params['sfh'] = 4
-sps.params['const'] = 1.0
-sps.params['imf_type'] = 2
-wave, s = sps.get_spectrum(tage=1.0, peraa=True)
-
 M31_DM = 24.47
 ATT = attenuation.conroy
 
-filters = ['galex_fuv', 'galex_nuv']
-filters = observate.load_filters(filters)
-
 
 def ext_func(rv, av=1.0, f_bump=1., att=attenuation.conroy):
     """
@@ -28,22 +20,16 @@ def ext_func(rv, av=1.0, f_bump=1., att=attenuation.conroy):
 
     Parameters
     ----------
-    rv : float ; an R_V value
+    rv : float or array ; R_V value(s)
     av : float ; A_V for the given region
-    f_bump : float, optional; strength of the 2175 \AA bump in fraction of MW bump strength
+    f_bump : float or array, optional; strength of the 2175 \AA bump in fraction of MW bump strength
     att : sedpy.attenuation funcion, optional; attenuation curve to use. Default: attenuation.conroy
     """
-    tau_v = av / 1.086
-    tau_lambda = att(wave, R_v=rv, f_bump=f_bump, tau_v=tau_v)
-    f2 = s * np.exp(-tau_lambda)
-    mags_red = observate.getSED(wave, f2, filters)
-    mags = observate.getSED(wave, s, filters)
-
-    fluxes_red = [3631*10**(-0.4 * (mag + M31_DM)) for mag in mags_red]
-    fluxes = [3631 * 10**(-0.4 * (mag + M31_DM)) for mag in mags]
-    val_fuv = fluxes_red[0] / fluxes[0]
-    val_nuv = fluxes_red[1] / fluxes[1]
-    color = (mags_red[0] - mags_red[1]) - (mags[0] - mags[1])
+    ratios = sed_model.flux_ratios(rv, av, 0., f_bump, att=att)
+    val_fuv, val_nuv = ratios.T
+    color = -2.5 * np.log10(val_fuv / val_nuv)
+    if np.ndim(rv) == 0 and np.ndim(f_bump) == 0:
+        val_fuv, val_nuv, color = val_fuv[0], val_nuv[0], color[0]
 
     return val_fuv, val_nuv, color
 
@@ -108,16 +94,8 @@ def theoretical_predictions():
 
     rvg, fbg = np.meshgrid(rvgrid, fbgrid, indexing='ij')
 
-    ebv = np.zeros(rvg.shape)
-    fuvf = np.zeros(rvg.shape)
-    nuvf = np.zeros(rvg.shape)
-    for i in range(rvg.shape[0]):
-        for j in range(rvg.shape[1]):
-            rv, fb = rvg[i,j], fbg[i,j]
-            model = ext_func(rv, av=1.4, f_bump=fb)
-            ebv[i,j] = model[-1]
-            fuvf[i,j] = model[0]
-            nuvf[i,j] = model[1]
+    fuvf, nuvf, ebv = ext_func(rvg.ravel(), av=1.4, f_bump=fbg.ravel())
+    fuvf, nuvf, ebv = [x.reshape(rvg.shape) for x in (fuvf, nuvf, ebv)]
 
     ebv_cmin, ebv_cmax = np.nanmin(ebv), 3#np.nanmax(ebv)
     ebv_cmap = plt.cm.inferno
@@ -166,26 +144,10 @@ def get_grid_data(create_file=False, newred=True):
     return grid
 
 
-def grid_to_arrays(grid, otherdata):
-    sfr100 = otherdata['sfr100']
-    shape = sfr100.shape
-    sfr100flat = sfr100.flatten()
-    sel = np.isfinite(sfr100flat)
-    sel2 = np.isfinite(sfr100)
-
-    #create empty arrays
-    rv_array = np.zeros(shape).flatten()
-    sig_rv_array = np.zeros(shape).flatten()
-    fb_array = np.zeros(shape).flatten()
-    sig_fb_array = np.zeros(shape).flatten()
-
-    # fill arrays and reshape
-    rv_array[sel] = grid[:,0]
-    fb_array[sel] = grid[:,1]
-    rv_array[~sel] = np.nan
-    fb_array[~sel] = np.nan
-    rv = rv_array.reshape(shape)
-    fb = fb_array.reshape(shape)
+def grid_to_arrays(grid, otherdata, res='90'):
+    index = regions.get_region_index(res)
+    rv = index.scatter(grid[:,0])
+    fb = index.scatter(grid[:,1])
 
     return rv, fb
 
@@ -217,7 +179,7 @@ if __name__ == '__main__':
 
     grid = get_grid_data(create_file=False, newred=True)
 
-    rv, fb = grid_to_arrays(grid, otherdata)
+    rv, fb = grid_to_arrays(grid, otherdata, res=res)
 
     fuvf = np.log10(fuvdata['fluxobs'] / fuvdata['fluxmodred'])
     nuvf = np.log10(nuvdata['fluxobs'] / nuvdata['fluxmodred'])
@@ -2,6 +2,7 @@ import numpy as np
 import h5py
 import matplotlib.pyplot as plt
 import compile_data
+import regions
 import os
 import matplotlib.colors as mcolors
 from mpl_toolkits.axes_grid1 import make_axes_locatable
@@ -235,27 +236,11 @@ def main():
 
     # gather the CMD and flux data
     fuvdata, nuvdata, otherdata = compile_data.gather_map_data()
-    sfr100 = otherdata['sfr100']
 
-    # save the shape for future use
-    shape = sfr100.shape
-
-    # flatten the data
-    sfr100flat = sfr100.flatten()
-
-    # get the location of the finite values
-    sel = np.isfinite(sfr100flat)
-
-    rv_array = np.zeros(shape).flatten()
-    fb_array = np.zeros(shape).flatten()
-
-    rv_array[sel] = grid[:,0]
-    fb_array[sel] = grid[:,1]
-    rv_array[~sel] = np.nan
-    fb_array[~sel] = np.nan
-
-    rv = rv_array.reshape(shape)
-    fb = fb_array.reshape(shape)
+    # put the per-region values back on the map
+    index = regions.get_region_index()
+    rv = index.scatter(grid[:,0])
+    fb = index.scatter(grid[:,1])
 
     #map1(rv, fb, otherdata, data_loc=data_loc1)
     #map2(rv, fb, otherdata, data_loc=data_loc1)
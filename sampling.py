@@ -0,0 +1,589 @@
+"""
+The burn-in and production schedule shared by the per-region emcee fits.
+
+run_emcee runs a first burn-in, a number of restarts, a final burn-in and
+the production run. After each restart and the final burn-in the walkers
+that got stuck (far below the others in ln(prob)) are moved onto the good
+ones (prune), and the restarts stop early once none are stuck. The spread
+of the good walkers is kept, so walkers in every mode carry on and the
+production run doesn't start from a point. reinit='recenter' restarts all
+the walkers around the highest ln(prob) sample instead. With a chain_io.Checkpoint the state
+is saved after every phase, so a killed fit picks up at the phase it was in.
+
+Every random draw of a fit can come from streams derived from (seed,
+region) alone (region_random_states), so a region gives the same chain
+whether it's run alone, in a pool or resumed, and in any order.
+
+With target_ess set the schedule isn't fixed in advance. A short pilot run
+replaces the first burn-in, and from its acceptance fraction and
+autocorrelation time (allocate) the fit gets the walkers and steps it needs
+for target_ess independent samples: a well-constrained region finishes with
+a short run and no restarts, while a slow-mixing one (multimodal, or pushed
+against the prior bounds) gets more walkers and the restarts.
+
+The per-region lnprob functions take all the walkers as one (nwalkers,
+ndim) array: the prior bounds are checked for all of them at once
+(box_lnprior) and the forward model is run only for those inside
+(lnprob_batch). A BatchPool makes emcee pass them that way.
+
+With thinned=True the production run isn't kept in the sampler. It goes
+into a ChainSummary instead, which keeps only every thin-th step (thin is
+the autocorrelation time measured in the final burn-in) and histograms of
+every sample for the percentiles.
+"""
+import time
+import numpy as np
+import emcee
+
+import profiling
+
+
+# keyword of EnsembleSampler.sample that turns off keeping the chain, which
+# emcee 3 renamed
+_STORE_KW = 'storechain' if int(emcee.__version__.split('.')[0]) < 3 else 'store'
+
+
+# a walker is stuck if its mean ln(prob) is more than PRUNE_IQR interquartile
+# ranges below the lower quartile of the walkers' and more than ndim below
+# the median, or more than PRUNE_GAP + ndim below the upper quartile (see prune)
+PRUNE_IQR = 2.
+PRUNE_GAP = 10.
+
+# adaptive schedule, see allocate
+PILOT_STEPS = 400
+MIN_ACCEPTANCE = 0.2
+# a tau is only trusted if the chain it's measured on is this many taus long
+TAU_FACTOR = 5
+# a region is hard if its pilot is shorter than this many taus. An easy
+# 2-d posterior has tau of 25-45, more than a 400-step pilot can trust, so
+# an untrusted tau only makes the steps longer (see allocate)
+HARD_TAU_FACTOR = 2
+
+# streams of a region, see random_state
+INIT_STREAM = 0
+SAMPLER_STREAM = 1
+SUBSAMPLE_STREAM = 2
+
+
+def random_state(seed, region, stream):
+    """
+    A RandomState for one stream of one region. Streams of different
+    (region, stream) pairs with the same seed are independent: they are
+    spawned from seed with numpy's SeedSequence (numpy >= 1.17; older
+    versions seed the state with [seed, region, stream]).
+
+    A RandomState rather than a Generator, since that's what emcee's
+    sampler keeps its state in.
+    """
+    try:
+        seedseq = np.random.SeedSequence(seed, spawn_key=(region, stream))
+    except AttributeError:
+        return np.random.RandomState([seed, region, stream])
+    return np.random.RandomState(np.random.MT19937(seedseq))
+
+
+def region_random_states(seed, region):
+    """
+    The RandomStates of a region's fit: one for the walker positions drawn
+    by initialize and at the restarts, and one for the sampler, to be set
+    with sampler.random_state = state.get_state().
+    """
+    return (random_state(seed, region, INIT_STREAM),
+            random_state(seed, region, SAMPLER_STREAM))
+
+
+def box_lnprior(theta, lo, hi):
+    """
+    ln(prior) of a uniform prior on the box lo < theta < hi: 0 inside and
+    -inf outside. theta is one point (ndim,), giving a float, or the walkers
+    (nwalkers, ndim), giving an (nwalkers,) array from one comparison.
+    """
+    theta = np.asarray(theta, dtype=float)
+    inside = np.all((theta > lo) & (theta < hi), axis=-1)
+    lp = np.where(inside, 0., -np.inf)
+    return float(lp) if theta.ndim == 1 else lp
+
+
+def lnprob_batch(theta, lnprior, lnlike):
+    """
+    ln(prior) + ln(likelihood) of one point (ndim,) or of every walker of an
+    (nwalkers, ndim) array.
+
+    lnprior(theta) takes the whole array. lnlike(theta) is called once, on
+    the walkers inside the prior only, so the forward model is never run
+    for a walker that would be rejected anyway; those get -inf.
+    """
+    theta = np.asarray(theta, dtype=float)
+    with profiling.timed('lnprob', 1 if theta.ndim == 1 else len(theta)):
+        lp = lnprior(theta)
+        if theta.ndim == 1:
+            if not np.isfinite(lp):
+                return -np.inf
+            with profiling.timed('lnlike'):
+                return lp + lnlike(theta)
+        out = np.full(len(theta), -np.inf)
+        ok = np.isfinite(lp)
+        if np.any(ok):
+            with profiling.timed('lnlike', int(np.sum(ok))):
+                out[ok] = lp[ok] + lnlike(theta[ok])
+        return out
+
+
+class BatchPool(object):
+    """
+    Stand-in for a pool of processes that has emcee evaluate all of its
+    walkers with one call of a vectorized lnprob.
+
+    emcee gets the ln(prob) of its walkers with pool.map(lnprobfn,
+    positions). This map ignores lnprobfn and returns
+    lnprob(positions, *args), with positions as one (nwalkers, ndim) array.
+
+    Parameters
+    ----------
+    lnprob : callable ; lnprob(theta, *args) for theta of shape
+        (nwalkers, ndim), see lnprob_batch
+    args : tuple, optional ; the rest of lnprob's arguments, as given to
+        the sampler
+    """
+    def __init__(self, lnprob, args=()):
+        self.lnprob = lnprob
+        self.args = tuple(args)
+
+    def map(self, func, positions):
+        return list(self.lnprob(np.asarray(list(positions), dtype=float), *self.args))
+
+
+def initialize(init, ndim, nwalkers, random_state=np.random):
+    """
+    Offset the initial guess slightly for each walker
+    """
+    pos = [init + 1e-4 * random_state.randn(ndim) for i in range(nwalkers)]
+    return pos
+
+
+def schedule(run_steps, restart_steps, n_restarts):
+    """
+    Phases of run_emcee, in order, as (name, nsteps, restart). After a
+    phase with restart set the walkers are restarted, see prune and
+    recenter.
+    """
+    phases = [('burnin', run_steps, False)]
+    phases += [('restart_' + str(i + 1), restart_steps, True) for i in range(n_restarts)]
+    phases += [('final_burnin', run_steps, True), ('production', run_steps, False)]
+    return phases
+
+
+def recenter(sampler, ndim, nwalkers, random_state=np.random):
+    """
+    New walker positions around the highest ln(prob) sample in the sampler.
+    """
+    sel = np.where(sampler.flatlnprobability == np.max(sampler.flatlnprobability))
+    return initialize(np.mean(sampler.flatchain[sel], axis=0), ndim, nwalkers,
+                      random_state)
+
+
+def prune(sampler, ndim, nwalkers, random_state=np.random, factor=PRUNE_IQR,
+          gap=PRUNE_GAP):
+    """
+    New walker positions after a burn-in: the last positions of the good
+    walkers, and the stuck ones moved next to good walkers picked at random.
+
+    A walker's ln(prob) is averaged over the second half of the run. It's
+    stuck if that's below the lower quartile by more than factor times the
+    interquartile range (an outlier rejection as in Hou et al. 2012) and
+    below the median by more than ndim, so that walkers in a broader mode
+    with a lower peak aren't taken as stuck. As that misses a trap holding
+    over a quarter of the walkers, a walker more than gap + ndim below the
+    upper quartile, where the posterior is e^-gap times smaller, is stuck
+    too, and so are walkers at -inf. With fewer than two good walkers, this
+    is recenter.
+
+    Returns
+    -------
+    pos : (nwalkers, ndim) array
+    nstuck : int ; number of walkers moved
+    """
+    lnprob = np.asarray(sampler.lnprobability)
+    mean = np.mean(lnprob[:, lnprob.shape[1] // 2:], axis=1)
+    finite = np.isfinite(mean)
+    stuck = ~finite
+    if np.sum(finite) >= 2:
+        q25, q50, q75 = np.percentile(mean[finite], [25, 50, 75])
+        m = mean[finite]
+        stuck[finite] = (((m < q25 - factor * (q75 - q25)) & (m < q50 - ndim)) |
+                         (m < q75 - gap - ndim))
+    good = np.flatnonzero(~stuck)
+    if len(good) < 2:
+        return np.asarray(recenter(sampler, ndim, nwalkers, random_state)), nwalkers
+    pos = np.array(sampler.chain[:, -1], dtype=float)
+    nstuck = int(np.sum(stuck))
+    picks = good[random_state.randint(len(good), size=nstuck)]
+    pos[stuck] = pos[picks] + 1e-4 * random_state.randn(nstuck, ndim)
+    return pos, nstuck
+
+
+def autocorr_time(chain, c=5., ensemble=False):
+    """
+    Integrated autocorrelation time of each parameter, in steps, from the
+    autocorrelation function averaged over walkers (Goodman & Weare 2010),
+    summed out to the first lag m >= c tau (Sokal 1989).
+
+    Each walker's chain is centered on its own mean, or with ensemble on the
+    mean of all the walkers. The walkers' own means take out the slowest
+    variations, so on a chain only a few taus long tau comes out several
+    times too short; the ensemble mean doesn't, but counts walkers that
+    haven't mixed yet (e.g. still spreading out from initialize) as slow.
+
+    Parameters
+    ----------
+    chain : (nwalkers, nsteps, ndim) array
+    c : float, optional ; size of the summing window in units of tau
+    ensemble : bool, optional ; center on the mean of all the walkers
+
+    Returns
+    -------
+    tau : (ndim,) array ; NaN for a parameter that never moved
+    """
+    chain = np.asarray(chain, dtype=float)
+    nsteps = chain.shape[1]
+    if ensemble:
+        x = chain - chain.mean(axis=(0, 1))
+    else:
+        x = chain - chain.mean(axis=1)[:, None, :]
+    nfft = 2 ** int(np.ceil(np.log2(2 * nsteps)))
+    f = np.fft.rfft(x, n=nfft, axis=1)
+    acf = np.fft.irfft(f * np.conj(f), n=nfft, axis=1)[:, :nsteps].mean(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        acf /= acf[0]
+    taus = 2. * np.cumsum(acf, axis=0) - 1.
+    lags = np.arange(nsteps)[:, None]
+    inwindow = lags >= c * taus
+    window = np.where(np.any(inwindow, axis=0), np.argmax(inwindow, axis=0), nsteps - 1)
+    return taus[window, np.arange(chain.shape[2])]
+
+
+class ChainSummary(object):
+    """
+    Bounded-memory record of a production run, filled one step at a time:
+    every thin-th step of the chain and ln(prob), and a histogram of every
+    sample of each parameter from which the percentiles are read.
+
+    The histograms span [lo, hi]; samples outside are counted in the end
+    bins (and in `clipped`), which only matters if a percentile falls there.
+
+    Parameters
+    ----------
+    nwalkers, ndim, nsteps : int ; shape of the run
+    thin : int ; keep one step in thin
+    lo, hi : (ndim,) arrays ; range of the histograms
+    nbins : int, optional ; number of histogram bins per parameter
+    start : (nwalkers, ndim) array, optional ; positions the run starts
+        from, so the moves of the first step count in acceptance_fraction
+    """
+    def __init__(self, nwalkers, ndim, nsteps, thin, lo, hi, nbins=2048, start=None):
+        self.thin = int(thin)
+        self.lo = np.asarray(lo, dtype=float)
+        self.hi = np.asarray(hi, dtype=float)
+        self.nbins = nbins
+        nkeep = (nsteps + self.thin - 1) // self.thin
+        self.chain = np.empty((nwalkers, nkeep, ndim))
+        self.lnprobability = np.empty((nwalkers, nkeep))
+        self.counts = np.zeros((ndim, nbins), dtype=np.int64)
+        self.clipped = np.zeros(ndim, dtype=np.int64)
+        self.iterations = 0
+        self._offsets = nbins * np.arange(ndim)
+        # the sampler doesn't count accepted moves when it doesn't keep the
+        # chain (emcee 3), so they're counted here
+        self.naccepted = np.zeros(nwalkers, dtype=np.int64)
+        self._nmoves = 0
+        self._last = None if start is None else np.array(start, dtype=float)
+
+    @classmethod
+    def from_burnin(cls, chain, nsteps, pad=0.5, **kwargs):
+        """
+        Summary of an nsteps production run, with thin and the histogram
+        range taken from the chain of the burn-in before it.
+        """
+        nwalkers, n, ndim = np.shape(chain)
+        tau = autocorr_time(chain)
+        thin = int(np.ceil(np.nanmax(tau))) if np.any(np.isfinite(tau)) else 1
+        # keep at least 10 steps, even if the chain is far from converged
+        thin = max(1, min(thin, nsteps // 10))
+        lo, hi = np.min(chain, axis=(0, 1)), np.max(chain, axis=(0, 1))
+        width = np.maximum(hi - lo, 1e-3 * np.abs(hi) + 1e-8)
+        return cls(nwalkers, ndim, nsteps, thin, lo - pad * width,
+                   hi + pad * width, **kwargs)
+
+    def add(self, pos, lnprob):
+        """ Record one step: the walker positions and their ln(prob). """
+        # copied, as emcee may update its positions in place
+        pos = np.array(pos, dtype=float)
+        if self._last is not None:
+            self.naccepted += np.any(pos != self._last, axis=1)
+            self._nmoves += 1
+        self._last = pos
+        if self.iterations % self.thin == 0:
+            k = self.iterations // self.thin
+            self.chain[:, k] = pos
+            self.lnprobability[:, k] = lnprob
+        scaled = (pos - self.lo) / (self.hi - self.lo) * self.nbins
+        inside = (scaled >= 0) & (scaled < self.nbins)
+        self.clipped += np.sum(~inside, axis=0)
+        ibin = np.clip(scaled, 0, self.nbins - 1).astype(int)
+        self.counts += np.bincount((ibin + self._offsets).ravel(),
+                                   minlength=self.counts.size).reshape(self.counts.shape)
+        self.iterations += 1
+
+    @property
+    def acceptance_fraction(self):
+        return self.naccepted / float(max(self._nmoves, 1))
+
+    @property
+    def attrs(self):
+        # kept with the written results
+        return {'thin': self.thin, 'nsteps': self.iterations, 'clipped': self.clipped}
+
+    @property
+    def flatchain(self):
+        # walker by walker, as emcee flattens its chain
+        return self.chain.reshape(-1, self.chain.shape[-1])
+
+    def percentiles(self, d, q):
+        """ Percentiles q (0-100) of parameter d, over every sample. """
+        edges = np.linspace(self.lo[d], self.hi[d], self.nbins + 1)
+        cdf = np.concatenate([[0.], np.cumsum(self.counts[d])]) / self.counts[d].sum()
+        return np.interp(np.asarray(q) / 100., cdf, edges)
+
+
+def allocate(chain, acceptance, target_ess, nwalkers, n_restarts, max_walkers=None,
+             min_steps=100, max_steps=5000):
+    """
+    Walkers and steps for the rest of a fit, from its pilot run.
+
+    tau is measured on the second half of the pilot, centered on the
+    ensemble mean since the pilot is short (see autocorr_time). If the pilot
+    is shorter than TAU_FACTOR taus the tau isn't trusted, and is taken to
+    be at least that fraction of the pilot. A region is hard if the walkers
+    didn't move, if the pilot is shorter than HARD_TAU_FACTOR taus, or if
+    fewer than MIN_ACCEPTANCE of the proposals were accepted. A hard region
+    gets twice the walkers and the n_restarts restarts; an easy one keeps
+    its walkers and has no restarts. The walkers are then increased further
+    if target_ess * tau / nwalkers steps would be more than max_steps.
+
+    Parameters
+    ----------
+    chain : (nwalkers, nsteps, ndim) array ; chain of the pilot run
+    acceptance : float ; mean acceptance fraction of the pilot run
+    target_ess : float ; number of independent samples wanted from production
+    nwalkers : int ; walkers of the pilot, the fewest the fit will use
+    n_restarts : int ; restarts of a hard region
+    max_walkers : int, optional ; most walkers to use. Default: nwalkers
+    min_steps, max_steps : int, optional ; range of the burn-in and
+        production lengths
+
+    Returns
+    -------
+    plan : dict ; nwalkers, run_steps, restart_steps and n_restarts for
+        schedule, and the tau and acceptance they're based on
+    """
+    half = chain.shape[1] // 2
+    tau = np.asarray(autocorr_time(chain[:, half:], ensemble=True))
+    tau = np.nanmax(tau) if np.any(np.isfinite(tau)) else np.nan
+    reliable = np.isfinite(tau) and half >= TAU_FACTOR * tau
+    hard = (not np.isfinite(tau) or half < HARD_TAU_FACTOR * tau or
+            acceptance < MIN_ACCEPTANCE)
+    if not np.isfinite(tau):
+        tau = float(half)
+    elif not reliable:
+        tau = max(tau, float(half) / TAU_FACTOR)
+
+    max_walkers = max_walkers or nwalkers
+    n = 2 * nwalkers if hard else nwalkers
+    n = max(n, int(np.ceil(target_ess * tau / max_steps)))
+    n = max(nwalkers, min(n + n % 2, max_walkers))
+    run_steps = int(np.clip(np.ceil(target_ess * tau / n), min_steps, max_steps))
+    restart_steps = int(np.clip(np.ceil(10 * tau), min_steps, run_steps))
+    return {'nwalkers': n, 'run_steps': run_steps, 'restart_steps': restart_steps,
+            'n_restarts': n_restarts if hard else 0, 'tau': tau,
+            'acceptance': acceptance}
+
+
+def resize(pos, nwalkers, random_state=np.random):
+    """
+    Walker positions for a run with nwalkers walkers: the walkers of pos,
+    and new ones started next to walkers of pos picked at random.
+    """
+    pos = np.asarray(pos, dtype=float)
+    n, ndim = pos.shape
+    if nwalkers <= n:
+        return pos[:nwalkers]
+    picks = random_state.randint(n, size=nwalkers - n)
+    new = pos[picks] + 1e-4 * random_state.randn(nwalkers - n, ndim)
+    return np.concatenate([pos, new])
+
+
+def _add_phase_stats(info, name, sampler, seconds, snap):
+    # wall time and acceptance of a phase, and the calls of each part of the
+    # model during it, added to the info that's checkpointed with the run
+    info['time_' + name] = seconds
+    info['acceptance_' + name] = np.mean(sampler.acceptance_fraction)
+    for part, (n, t) in profiling.since(snap).items():
+        info['ncalls_' + part] = info.get('ncalls_' + part, 0) + n
+        info['seconds_' + part] = info.get('seconds_' + part, 0.) + t
+    return profiling.snapshot()
+
+
+def run_stats(info):
+    """
+    Performance of a run_emcee run, from its info: the wall time
+    ('time_<phase>') and mean acceptance fraction ('acceptance_<phase>') of
+    each phase, and for each part of the model (see profiling) the number
+    of calls ('ncalls_<part>') and the mean seconds per call
+    ('mean_time_<part>').
+    """
+    stats = {}
+    for key, val in info.items():
+        if key.startswith('time_') or key.startswith('acceptance_') or key.startswith('ncalls_'):
+            stats[key] = val
+        elif key.startswith('seconds_'):
+            part = key[len('seconds_'):]
+            stats['mean_time_' + part] = val / max(info['ncalls_' + part], 1)
+    return stats
+
+
+def _adapted(pilot, plan):
+    # the pilot stands in for the first burn-in, and the final burn-in is
+    # as long as a restart rather than as the production run
+    run_steps, restart_steps = int(plan['run_steps']), int(plan['restart_steps'])
+    phases = schedule(run_steps, restart_steps, int(plan['n_restarts']))
+    return [pilot] + phases[1:-2] + [('final_burnin', restart_steps, True),
+                                     phases[-1]]
+
+
+def run_emcee(sampler, run_steps, restart_steps, pos, ndim, nwalkers, n_restarts=4,
+              checkpoint=None, thinned=False, random_state=np.random,
+              target_ess=None, make_sampler=None, max_walkers=None,
+              pilot_steps=PILOT_STEPS, reinit='prune', record=None):
+    """
+    Run an MCMC chain.
+
+    Parameters
+    ----------
+    sampler : emcee.ensemble.EnsembleSampler
+    run_steps : int ; number of steps for each walker takes in the main runs
+    restart_steps : int; number of steps each walker takes in the restart runs
+    pos : list ; ndim elements specifying starting points of theta
+    ndim : int ; number of parameters to fit for
+    nwalkers : number of walkers
+    n_restarts : int (optional) ; number of times to restart the burn-in
+    checkpoint : chain_io.Checkpoint (optional) ; where to save the state
+        after each phase. If it holds a saved state, the run resumes from it.
+    thinned : bool (optional) ; keep the production run in a ChainSummary
+        rather than in the sampler
+    random_state : numpy.random.RandomState (optional) ; draws the walker
+        positions at the restarts. Default: numpy's global state
+    target_ess : float (optional) ; adapt the schedule to this many
+        independent production samples after a pilot run (see allocate).
+        run_steps, restart_steps and n_restarts are then ignored, apart from
+        n_restarts being the restarts of a hard region.
+    make_sampler : callable (optional) ; make_sampler(nwalkers) gives a new
+        sampler like sampler with nwalkers walkers. Without it an adaptive
+        run keeps nwalkers walkers.
+    max_walkers : int (optional) ; most walkers of an adaptive run.
+        Default: 4 * nwalkers
+    pilot_steps : int (optional) ; length of the pilot run
+    reinit : str (optional) ; how the walkers are restarted: 'prune' moves
+        the stuck ones onto the others, and ends the restarts once none are
+        stuck; 'recenter' restarts all of them around the highest ln(prob)
+        sample
+    record : dict (optional) ; filled with the schedule of an adaptive run,
+        the number of walkers pruned and the performance of the run (see
+        run_stats), to be kept with the results
+
+    Returns
+    -------
+    sampler : emcee.ensemble.EnsembleSampler, or ChainSummary if thinned
+    pos : position of each walker at the start of the production run
+
+    """
+    adaptive = target_ess is not None
+    if adaptive:
+        if make_sampler is None:
+            max_walkers = nwalkers
+        elif max_walkers is None:
+            max_walkers = 4 * nwalkers
+        # the given schedule stands until the pilot has been run
+        pilot = ('pilot', pilot_steps, False)
+        phases = _adapted(pilot, {'run_steps': run_steps, 'restart_steps': restart_steps,
+                                  'n_restarts': n_restarts})
+    else:
+        phases = schedule(run_steps, restart_steps, n_restarts)
+
+    start, info = 0, {}
+    saved = checkpoint.load() if checkpoint is not None else None
+    if saved is not None:
+        start, pos, sampler_state, restart_state, info = saved
+        if adaptive and start > 0:
+            phases = _adapted(pilot, info)
+            if int(info['nwalkers']) != nwalkers:
+                nwalkers = int(info['nwalkers'])
+                sampler = make_sampler(nwalkers)
+        sampler.random_state = sampler_state
+        random_state.set_state(restart_state)
+
+    k = start
+    snap = profiling.snapshot()
+    while k < len(phases):
+        last = len(phases) - 1
+        name, nsteps, restart = phases[k]
+        sampler.reset()
+        t0 = time.time()
+        if k == last and thinned:
+            summary = ChainSummary(nwalkers, ndim, nsteps, thin=info['thin'],
+                                   lo=info['lo'], hi=info['hi'], start=pos)
+            for result in sampler.sample(pos, iterations=nsteps, **{_STORE_KW: False}):
+                summary.add(result[0], result[1])
+            snap = _add_phase_stats(info, name, summary, time.time() - t0, snap)
+            sampler = summary
+            break
+        end, lp, state = sampler.run_mcmc(pos, nsteps)
+        snap = _add_phase_stats(info, name, sampler, time.time() - t0, snap)
+        if k == last:
+            # pos stays where the production run started
+            break
+        if k == last - 1 and thinned:
+            summary = ChainSummary.from_burnin(sampler.chain, phases[last][1])
+            info.update({'thin': summary.thin, 'lo': summary.lo, 'hi': summary.hi})
+        following = k + 1
+        if not restart:
+            pos = end
+        elif reinit == 'recenter':
+            pos = recenter(sampler, ndim, nwalkers, random_state)
+        else:
+            pos, nstuck = prune(sampler, ndim, nwalkers, random_state)
+            info['pruned'] = info.get('pruned', 0) + nstuck
+            if nstuck == 0 and name.startswith('restart_'):
+                # nothing left to fix, go on to the final burn-in
+                following = len(phases) - 2
+        if adaptive and k == 0:
+            plan = allocate(sampler.chain, np.mean(sampler.acceptance_fraction),
+                            target_ess, nwalkers, n_restarts, max_walkers)
+            info.update(plan)
+            phases = _adapted(pilot, plan)
+            if plan['nwalkers'] != nwalkers:
+                nwalkers = plan['nwalkers']
+                pos = resize(pos, nwalkers, random_state)
+                state = sampler.random_state
+                sampler = make_sampler(nwalkers)
+                sampler.random_state = state
+        if checkpoint is not None:
+            checkpoint.save(following, pos, sampler.random_state,
+                            random_state.get_state(), info)
+        k = following
+
+    if record is not None:
+        record.update((key, info[key]) for key in
+                      ('nwalkers', 'run_steps', 'restart_steps', 'n_restarts',
+                       'tau', 'acceptance', 'pruned') if key in info)
+        record.update(run_stats(info))
+    return sampler, pos
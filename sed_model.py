@@ -0,0 +1,215 @@
+"""
+Lazily built spectra and filters for the forward models, and a batched
+evaluation of the dust-reddened UV flux ratios.
+
+Building an fsps.StellarPopulation and calling get_spectrum takes several
+seconds, so nothing here touches FSPS until a spectrum is actually asked for.
+Every spectrum and filter set is memoized, so all of the model modules in a
+process share one StellarPopulation and one copy of each spectrum.
+"""
+import numpy as np
+from sedpy import attenuation, observate
+
+import profiling
+
+
+BANDS = ['galex_fuv', 'galex_nuv']
+
+_SPS = []
+_SPECTRA = {}
+_FILTERS = {}
+_RATIO_TERMS = {}
+
+# (R_V, f_bump) points used to decompose an attenuation curve, and one more
+# to check the decomposition
+_BASIS_POINTS = [(2., 0.), (2., 1.), (4., 0.), (4., 1.)]
+_CHECK_POINT = (3.1, 0.6)
+
+
+def get_sps():
+    """
+    Return the StellarPopulation for this process, creating it on first use.
+    """
+    try:
+        return _SPS[0]
+    except IndexError:
+        import fsps
+        sps = fsps.StellarPopulation()
+        _SPS.append(sps)
+        return sps
+
+
+def get_spectrum(tage=1.0, sfh=4, const=1.0, imf_type=2):
+    """
+    Spectrum of a stellar population, in L_sun/AA. The defaults are the
+    constant-SFH, 1 Gyr spectrum used by the per-region models.
+
+    Parameters
+    ----------
+    tage : float, optional ; age of the population in Gyr
+    sfh : int, optional ; FSPS sfh type
+    const : float, optional ; mass fraction formed in a constant mode
+    imf_type : int, optional ; FSPS IMF type
+
+    Returns
+    -------
+    wave : (nwave,) array ; wavelengths in AA
+    s : (nwave,) array ; spectrum in L_sun/AA
+    """
+    key = (tage, sfh, const, imf_type)
+    try:
+        return _SPECTRA[key]
+    except KeyError:
+        pass
+    sps = get_sps()
+    sps.params['sfh'] = sfh
+    sps.params['const'] = const
+    sps.params['imf_type'] = imf_type
+    wave, s = sps.get_spectrum(tage=tage, peraa=True)
+    _SPECTRA[key] = wave, s
+    return wave, s
+
+
+def get_filters(bands=BANDS):
+    """
+    sedpy filter objects for a list of band names, loaded once per list.
+    """
+    key = tuple(bands)
+    try:
+        return _FILTERS[key]
+    except KeyError:
+        filters = observate.load_filters(list(bands))
+        _FILTERS[key] = filters
+        return filters
+
+
+def _basis_design(rv, f_bump):
+    rv, f_bump = np.broadcast_arrays(np.atleast_1d(rv).astype(float),
+                                     np.atleast_1d(f_bump).astype(float))
+    return np.column_stack([np.ones_like(rv), f_bump, 1. / rv, f_bump / rv])
+
+
+def attenuation_basis(wave, att=attenuation.conroy):
+    """
+    Decompose an attenuation curve into four fixed curves.
+
+    The sedpy curves used here (conroy, cardelli) are linear in f_bump and
+    1/R_V, so tau_lambda / tau_V = c0 + c1 f_bump + c2 / R_V + c3 f_bump / R_V.
+    The curve is evaluated at a few (R_V, f_bump) points to solve for the
+    c's, and the fit is checked at one more point.
+
+    Returns
+    -------
+    basis : (4, nwave) array ; multiply by _basis_design(rv, f_bump) to get
+        tau_lambda / tau_V for any number of (R_V, f_bump) pairs at once
+    """
+    rv, fb = np.asarray(_BASIS_POINTS).T
+    curves = np.asarray([att(wave, R_v=r, f_bump=f, tau_v=1.) for r, f in _BASIS_POINTS])
+    basis = np.linalg.solve(_basis_design(rv, fb), curves)
+
+    rv, fb = _CHECK_POINT
+    expected = att(wave, R_v=rv, f_bump=fb, tau_v=1.)
+    if not np.allclose(np.dot(_basis_design(rv, fb), basis)[0], expected,
+                       rtol=1e-8, atol=1e-10):
+        raise ValueError(att.__name__ + ' is not linear in f_bump and 1/R_V')
+    return basis
+
+
+def band_weights(wave, filters):
+    """
+    Weights that integrate a spectrum through each filter, so that
+    np.dot(spec, weights) gives the detector signal in each band.
+
+    This is the same lambda * f_lambda * R trapezoid integral sedpy's
+    Filter.obj_counts does, written as a matrix so that many spectra can be
+    projected at once.
+
+    Returns
+    -------
+    weights : (nwave, nbands) array
+    """
+    dw = np.zeros_like(wave, dtype=float)
+    dw[1:] += 0.5 * np.diff(wave)
+    dw[:-1] += 0.5 * np.diff(wave)
+    weights = np.zeros((len(wave), len(filters)))
+    for i, f in enumerate(filters):
+        trans = np.interp(wave, f.wavelength, f.transmission, left=0., right=0.)
+        weights[:, i] = dw * wave * trans
+    return weights
+
+
+def _ratio_terms(wave, spec, att, bands):
+    """
+    Everything flux_ratios needs that doesn't depend on the dust parameters,
+    restricted to the wavelengths the filters actually see.
+    """
+    weights = band_weights(wave, get_filters(bands))
+    inband = np.any(weights > 0, axis=1)
+    # intrinsic spectrum times the filter weights; its column sums are the
+    # dust-free signal in each band
+    spec_weights = spec[inband, None] * weights[inband]
+    basis = attenuation_basis(wave[inband], att)
+    return basis, spec_weights, spec_weights.sum(axis=0)
+
+
+def flux_ratios(rv, av, dav=0., f_bump=1., att=attenuation.conroy, nsplit=30,
+                wave=None, spec=None, bands=BANDS, chunksize=4096):
+    """
+    Reddened-to-intrinsic flux ratios in each band for many sets of dust
+    parameters at once.
+
+    The attenuation is applied the same way as redden(): A_V is spread
+    uniformly from av to av + dav in nsplit + 1 pieces, or is a single
+    piece when dav is 0 for a whole chunk. The intrinsic fluxes
+    are shared by every set of parameters, and the attenuation curve is
+    evaluated for all of them as one 2-D array.
+
+    Parameters
+    ----------
+    rv, av, dav, f_bump : float or array_like ; dust parameters, broadcast
+        against each other
+    att : sedpy.attenuation function, optional ; attenuation curve. Must be
+        linear in f_bump and 1/R_V. Default: attenuation.conroy
+    nsplit : int, optional ; number of pieces the dA_V distribution is split into
+    wave, spec : (nwave,) arrays, optional ; spectrum to redden. Default:
+        the 1 Gyr constant-SFH spectrum from get_spectrum()
+    bands : list, optional ; filter names. Default: GALEX FUV and NUV
+    chunksize : int, optional ; number of parameter sets done at a time,
+        to cap memory
+
+    Returns
+    -------
+    ratios : (N, nbands) array ; f_red / f_int in each band
+    """
+    if spec is None:
+        key = (att, tuple(bands))
+        if key not in _RATIO_TERMS:
+            wave, spec = get_spectrum()
+            _RATIO_TERMS[key] = _ratio_terms(wave, spec, att, bands)
+        basis, spec_weights, intrinsic = _RATIO_TERMS[key]
+    else:
+        basis, spec_weights, intrinsic = _ratio_terms(wave, spec, att, bands)
+
+    rv, av, dav, f_bump = np.broadcast_arrays(*[np.atleast_1d(x).astype(float) for x in (rv, av, dav, f_bump)])
+    rv, av, dav, f_bump = [x.ravel() for x in (rv, av, dav, f_bump)]
+
+    # optical depths of the pieces of the A_V distribution
+    frac = (np.arange(nsplit + 1) + 0.5) / (nsplit + 1)
+
+    ratios = np.empty((len(rv), spec_weights.shape[-1]))
+    for start in range(0, len(rv), chunksize):
+        sl = slice(start, start + chunksize)
+        n = len(rv[sl])
+        with profiling.timed('attenuation', n):
+            tau = np.dot(_basis_design(rv[sl], f_bump[sl]), basis)
+        with profiling.timed('reddening', n):
+            # with no spread in A_V every piece is the same, so one will do
+            pieces = frac if np.any(dav[sl]) else frac[:1]
+            tau_v = (av[sl, None] + dav[sl, None] * pieces[None, :]) / 1.086
+            trans = np.zeros_like(tau)
+            for k in range(len(pieces)):
+                trans += np.exp(-tau * tau_v[:, k, None])
+            trans /= len(pieces)
+        with profiling.timed('filters', n):
+            ratios[sl] = np.dot(trans, spec_weights) / intrinsic
+    return ratios
@@ -1,106 +1,155 @@
 import numpy as np
-import fsps
 import emcee
 import h5py
 import time
 import os
 import sys
+import functools
 import astrogrid
-
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
 
 import bursty_sfh
 import astropy.coordinates
 from sedpy import attenuation, observate
 import compile_data
-
-from joblib import Parallel, delayed
+import photometry
+import profiling
+import chain_io
+import sampling
+from sampling import initialize, run_emcee
 
 from pdb import set_trace
 
 CURRENT_SP = []
+SSP_BASIS = {}
+REGION_CACHE = {}
 DIST = astropy.coordinates.Distance(distmod=24.47)
+M31_DM = 24.47
+ATT = attenuation.conroy
+bands = ['galex_fuv', 'galex_nuv']
+# uniform priors: 0 < R_V < 10, 0 < f_bump < 1.5
+PRIOR_LO = np.array([0., 0.])
+PRIOR_HI = np.array([10., 1.5])
 
 def get_args():
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('reg', type=int, help='region number')
+    parser.add_argument('reg', nargs='+', type=int, help='region number(s)')
+    parser.add_argument('--nproc', type=int, default=1, help='number of worker processes sharing one SSP basis')
+    parser.add_argument('--seed', type=int, default=None, help='base seed of the per-region random streams, for reproducible runs')
+    parser.add_argument('--target_ess', type=float, default=None, help='adapt the walkers and steps to this effective sample size, after a pilot run')
+    parser.add_argument('--reinit', default='prune', choices=['prune', 'recenter'], help='restart the burn-in by moving the stuck walkers onto the others, or all of them to the best sample')
+    parser.add_argument('--thin', action='store_true', help='store only the chain thinned by its autocorrelation time, and summaries')
+    parser.add_argument('--precision', default='float64', choices=['float32', 'float64'], help='precision of the maps and stored chains')
     return parser.parse_args()
 
 
-def get_data(ind, res='90', dust_curve='cardelli'):
+def get_region_table(res='90', dust_curve='cardelli'):
     """
-    Gather the GALEX and synthetic UV data. Also get SFR and optical dust.
-    Returns FUV flux ratio, NUV flux ratio, delta UV color, and optical Av+dAv from the SFHs.
+    Gather the GALEX and synthetic UV data for every finite region once and
+    cache it, so that repeated calls (one per region) don't re-read the maps.
     """
+    key = ('table', res, dust_curve)
+    if key in REGION_CACHE:
+        return REGION_CACHE[key]
+
     fuvdata, nuvdata, otherdata = compile_data.gather_map_data(res, dust_curve)
 
     data_fuv = fuvdata['fluxobs'] / fuvdata['fluxmodint']
     selgood = np.isfinite(data_fuv)
-    data_fuv = data_fuv[np.isfinite(data_fuv)]
 
     data_nuv = nuvdata['fluxobs'] / nuvdata['fluxmodint']
-    data_nuv = data_nuv[np.isfinite(data_nuv)]
-
     data_color = (fuvdata['magobs'] - nuvdata['magobs']) - (fuvdata['magmodint'] - nuvdata['magmodint'])
-    data_color = data_color[np.isfinite(data_color)]
 
-    av = otherdata['av']
-    av = av[np.isfinite(av)]
+    # the maps may be float32; the likelihood is always done in float64
+    table = {'selgood': selgood,
+             'data_fuv': data_fuv[selgood].astype(float),
+             'data_nuv': data_nuv[np.isfinite(data_nuv)].astype(float),
+             'data_color': data_color[np.isfinite(data_color)].astype(float),
+             'av': otherdata['av'][np.isfinite(otherdata['av'])].astype(float),
+             'dav': otherdata['dav'][np.isfinite(otherdata['dav'])].astype(float),
+             'sfr': otherdata['sfr100'][np.isfinite(otherdata['sfr100'])].astype(float)}
+    REGION_CACHE[key] = table
+    return table
 
-    dav = otherdata['dav']
-    dav = dav[np.isfinite(dav)]
 
-    sfr = otherdata['sfr100']
-    sfr = sfr[np.isfinite(sfr)]
-    sel = (sfr > 1e-5) & (data_color < 2.)
+def get_data(ind, res='90', dust_curve='cardelli'):
+    """
+    Gather the GALEX and synthetic UV data. Also get SFR and optical dust.
+    Returns FUV flux ratio, NUV flux ratio, delta UV color, and optical Av+dAv from the SFHs.
+    """
+    table = get_region_table(res, dust_curve)
+    dav = table['dav']
 
-    return data_fuv[ind], data_nuv[ind], data_color[ind], av[ind], dav[ind], len(str(len(dav)))
+    return table['data_fuv'][ind], table['data_nuv'][ind], table['data_color'][ind], table['av'][ind], dav[ind], len(str(len(dav)))
 
 
-def get_sfh_metals(ind, res='90', dust_curve='cardelli'):
-    fsps_kwargs = {'imf_type': astrogrid.flux.IMF_TYPE['Kroupa']}
+def get_sfh_metals_all(res='90', dust_curve='cardelli', sfrtime=8):
+    """
+    Vectorized version of get_sfh_metals for every finite region at once.
 
-    fuvdata, nuvdata, otherdata = compile_data.gather_map_data(res, dust_curve)
-    sfhcube, sfhcube_upper, sfhcube_lower, sfhhdr, metalcube = compile_data.gather_sfh(res, sfhcube='sfr_evo_cube_alltimes.fits',metalcube='metal_evo_cube.fits')
+    Parameters
+    ----------
+    res : str, optional ; map resolution in pc
+    dust_curve : str, optional ; dust curve directory of the model maps
+    sfrtime : float, optional ; log age (yr) over which the mean metallicity is taken
 
-    data_fuv = fuvdata['fluxobs'] / fuvdata['fluxmodint']
-    selgood = np.isfinite(data_fuv)
+    Returns
+    -------
+    age : tuple ; young and old edges (yr) of the age bins, first bin starting at 0
+    sfh : (nregions, nbins) array ; SFRs with the first bin rescaled
+    metals : (nregions, nbins) array ; log metallicity in each bin
+    zmet : (nregions,) int array ; FSPS zmet index for each region
+    """
+    key = ('sfh', res, dust_curve, sfrtime)
+    if key in REGION_CACHE:
+        return REGION_CACHE[key]
+
+    selgood = get_region_table(res, dust_curve)['selgood']
+    sfhcube, sfhcube_upper, sfhcube_lower, sfhhdr, metalcube = compile_data.gather_sfh(res, sfhcube='sfr_evo_cube_alltimes.fits',metalcube='metal_evo_cube.fits')
 
-    sfh, metals = [], []
-    for i in range(sfhcube.shape[0]):
-        x = sfhcube[i,:,:]
-        sfh.append(x[selgood])
-        y = metalcube[i,:,:]
-        metals.append(y[selgood])
-    sfh = np.asarray(sfh)[:,ind]
-    metals = np.asarray(metals)[:,ind]
+    # cubes are nbins x ny x nx; pull out every finite region in one go
+    sfh = sfhcube[:, selgood].T.astype(float)
+    metals = metalcube[:, selgood].T
 
     t1 = np.arange(6.6, 9.9, 0.1)
     t2 = t1 + 0.1
     t2[-1] = 10.15
 
     i = sfh > 0
-    sfrtime = 8
     j = t1 < sfrtime
+    ij = i & j[None, :]
 
-    if not np.any(i & j):
-        # Use most recent metallicity available, or else assume solar
-        logZ = metals[i][0] if np.any(i) else 0
-    else:
-        # 100 Myr mean value
-        logZ = np.log10(np.mean(10**metals[i & j]))
-    fsps_kwargs['zmet'] = astrogrid.flux.get_zmet(logZ)
+    # 100 Myr mean value where available
+    n_recent = ij.sum(axis=1)
+    mean_recent = np.where(ij, 10**metals, 0.).sum(axis=1) / np.maximum(n_recent, 1)
+    with np.errstate(divide='ignore'):
+        logZ = np.log10(mean_recent)
+
+    # otherwise use the most recent metallicity available, or else assume solar
+    first = metals[np.arange(len(metals)), np.argmax(i, axis=1)]
+    older = np.where(np.any(i, axis=1), first, 0.)
+    logZ = np.where(n_recent > 0, logZ, older)
+
+    # get_zmet is a nearest-grid-point lookup, so only evaluate it once per
+    # distinct metallicity
+    uniq, inverse = np.unique(logZ, return_inverse=True)
+    zmet = np.asarray([astrogrid.flux.get_zmet(z) for z in uniq])[inverse]
 
     t1, t2 = 10**t1, 10**t2
     # Rescale 1st age bin
-    sfh[0] *= 1. - t1[0]/t2[0]
+    sfh[:, 0] *= 1. - t1[0]/t2[0]
     t1[0] = 0
 
-    age, sfr = (t1, t2), sfh
+    output = (t1, t2), sfh, metals, zmet
+    REGION_CACHE[key] = output
+    return output
+
 
-    return age, sfr
+def get_sfh_metals(ind, res='90', dust_curve='cardelli'):
+    age, sfh, metals, zmet = get_sfh_metals_all(res, dust_curve)
+    return age, sfh[ind]
 
 
 def redden(wave, spec, rv=3.1, f_bump=1.0, av=None, dav=None, nsplit=9, dust_curve=attenuation.conroy, wlo=1216., whi=2e4, **kwargs):
@@ -124,8 +173,11 @@ def redden(wave, spec, rv=3.1, f_bump=1.0, av=None, dav=None, nsplit=9, dust_cur
     #uniform distribution from Av to Av + dAv
     avdist = av[None, :] + dav[None,:] * ((np.arange(nsplit) + 0.5)/nsplit)[:,None]
     #apply it
-    ee = (np.exp(-dust_curve(wave, R_v=rv, f_bump=f_bump)[None,None,:] * avdist[:,:,None]))
-    spec_red = (ee * lisplit[None,:,:]).sum(axis = 0)
+    with profiling.timed('attenuation'):
+        curve = dust_curve(wave, R_v=rv, f_bump=f_bump)
+    with profiling.timed('reddening'):
+        ee = (np.exp(-curve[None,None,:] * avdist[:,:,None]))
+        spec_red = (ee * lisplit[None,:,:]).sum(axis = 0)
     #get the integral of the attenuated light in the optical-
     # NIR region of the spectrum
     opt = (wave >= wlo) & (wave <= whi)
@@ -133,6 +185,137 @@ def redden(wave, spec, rv=3.1, f_bump=1.0, av=None, dav=None, nsplit=9, dust_cur
     return np.squeeze(spec_red), lir
 
 
+def get_sps(fsps_kwargs=None):
+    """
+    Return this process's StellarPopulation, set up for SSPs with the given
+    parameters. FSPS is only initialized the first time it's needed.
+    """
+    # To save time, create StellarPopulation only when necessary
+    try:
+        sps = CURRENT_SP[0]
+    except IndexError:
+        import fsps
+        sps = fsps.StellarPopulation()
+        CURRENT_SP.append(sps)
+    fsps_kwargs = dict(fsps_kwargs or {})
+    fsps_kwargs['sfh'] = 0  # make sure SSPs
+    for key, val in fsps_kwargs.items():
+        sps.params[key] = val
+    return sps
+
+
+def _basis_key(fsps_kwargs):
+    fsps_kwargs = dict(fsps_kwargs or {})
+    fsps_kwargs['sfh'] = 0
+    return tuple(sorted(fsps_kwargs.items()))
+
+
+def get_ssp_basis(fsps_kwargs=None):
+    """
+    Get the SSP spectra, masses and ages for a set of FSPS parameters.
+
+    The basis doesn't depend on the SFH, so it is computed once per set of
+    parameters and memoized in SSP_BASIS. If share_ssp_basis has been called
+    (or this is a pool worker) the spectra are a read-only view into shared
+    memory.
+
+    Returns
+    -------
+    wave : (nwave,) array
+    spec : (nssp, nwave) array ; SSP spectra in L_sun/AA
+    mass : (nssp,) array ; surviving stellar mass of each SSP
+    ssp_ages : (nssp,) array ; SSP ages in yr
+    """
+    key = _basis_key(fsps_kwargs)
+    try:
+        return SSP_BASIS[key]
+    except KeyError:
+        pass
+    sps = get_sps(fsps_kwargs)
+    wave, spec = sps.get_spectrum(peraa=True, tage=0)
+    basis = wave, spec, sps.stellar_mass.copy(), 10**sps.ssp_ages
+    SSP_BASIS[key] = basis
+    return basis
+
+
+def share_ssp_basis(fsps_kwargs_list=None):
+    """
+    Compute the SSP basis for each set of FSPS parameters and move the spectra
+    into one block of shared memory.
+
+    The spectra are by far the largest part of the basis (nssp x nwave per
+    parameter set), so forked workers should read them from the shared block
+    rather than each holding a copy. The small arrays (wavelengths, masses,
+    ages) are passed along with the layout.
+
+    Returns
+    -------
+    shared : multiprocessing.sharedctypes.RawArray ; all spectra, flattened
+    layout : list of (key, offset, shape, wave, mass, ssp_ages)
+    """
+    if fsps_kwargs_list is None:
+        fsps_kwargs_list = [{}]
+    bases = [(_basis_key(kw), get_ssp_basis(kw)) for kw in fsps_kwargs_list]
+
+    size = sum(basis[1].size for key, basis in bases)
+    shared = RawArray('d', int(size))
+    block = np.frombuffer(shared, dtype=np.float64)
+
+    layout, offset = [], 0
+    for key, (wave, spec, mass, ssp_ages) in bases:
+        block[offset:offset + spec.size] = spec.ravel()
+        layout.append((key, offset, spec.shape, wave, mass, ssp_ages))
+        offset += spec.size
+
+    _attach_ssp_basis(shared, layout)
+    return shared, layout
+
+
+def _attach_ssp_basis(shared, layout):
+    """
+    Point SSP_BASIS at the spectra held in shared memory. Used as the pool
+    initializer so every worker sees the same block without copying it.
+    """
+    block = np.frombuffer(shared, dtype=np.float64)
+    for key, offset, shape, wave, mass, ssp_ages in layout:
+        n = int(np.prod(shape))
+        spec = block[offset:offset + n].reshape(shape)
+        spec.flags.writeable = False
+        SSP_BASIS[key] = wave, spec, mass, ssp_ages
+
+
+def run_pool(regs, processes=None, fsps_kwargs_list=None, **kwargs):
+    """
+    Fit a list of regions with a pool of worker processes.
+
+    FSPS is initialized once, in the parent, to build the SSP basis; the
+    spectra are placed in shared memory and handed to every worker through
+    the pool initializer. A worker only builds its own StellarPopulation if
+    it is asked for parameters that aren't in the shared basis.
+
+    Parameters
+    ----------
+    regs : list ; region numbers to pass to main
+    processes : int, optional ; number of workers. Default: number of CPUs
+    fsps_kwargs_list : list of dict, optional ; FSPS parameters to precompute.
+        Default: the parameters main uses.
+    kwargs : passed on to main
+    """
+    shared, layout = share_ssp_basis(fsps_kwargs_list)
+
+    # make sure the (cached) region tables are built before forking
+    get_region_table()
+    get_sfh_metals_all()
+
+    pool = multiprocessing.Pool(processes, initializer=_attach_ssp_basis,
+                                initargs=(shared, layout))
+    try:
+        pool.map(functools.partial(main, **kwargs), regs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def spectrum(sfr, age, **kwargs):
     if len(age) == 2:
         try:
@@ -157,15 +340,6 @@ def spectrum(sfr, age, **kwargs):
     logzsol = kwargs.get('logzsol', None)
 
     dust_curve = attenuation.conroy
-    # To save time, create StellarPopulation only when necessary
-    try:
-        sps = CURRENT_SP[0]
-    except IndexError:
-        sps = fsps.StellarPopulation()
-        CURRENT_SP.append(sps)
-    fsps_kwargs['sfh'] = 0
-    for key, val in fsps_kwargs.items():
-        sps.params[key] = val
 
     names = ['t1', 't2', 'sfr']
     names = [name.encode('utf-8') for name in names]# unicode names not allowed
@@ -178,12 +352,11 @@ def spectrum(sfr, age, **kwargs):
     lt = age
     lookback_time=age_list
 
-    sps.params['sfh'] = 0  # make sure SSPs
-    ssp_ages = 10**sps.ssp_ages  # in yrs
     if logzsol is None:
-        wave, spec = sps.get_spectrum(peraa=True, tage=0)
-        mass = sps.stellar_mass.copy()
+        wave, spec, mass, ssp_ages = get_ssp_basis(fsps_kwargs)
     else:
+        sps = get_sps(fsps_kwargs)
+        ssp_ages = 10**sps.ssp_ages  # in yrs
         assert(sps._zcontinuous > 0)
         spec, mass = [], []
         for tage, logz in zip(ssp_ages/1e9, logzsol):
@@ -220,7 +393,6 @@ def weight_output(lt, sfr, ssp_ages, lookback_time, wave, spec, mass, lir=None,
     return wave, spec, lum_ir
 
 
-
 def ext_func(spec_data, intrinsic_data, rv, av, dav, f_bump=1., att=attenuation.conroy, nsplit=30):
     """
     Given an R_V and f_bump value, returns the flux ratio or delta color from a specific attenuation curve.
@@ -242,9 +414,10 @@ def ext_func(spec_data, intrinsic_data, rv, av, dav, f_bump=1., att=attenuation.
 
     wave_red, spec_red, lum_ir = weight_output(lt, sfr, ssp_ages, lookback_time, wave, spec, mass, lir=lir, len_age_list=len_age_list)
 
-    mags_red = astrogrid.flux.calc_mag(
-            wave_red, spec_red, bands, dmod=DIST.distmod)
-    fluxes_red= [astrogrid.flux.mag2flux(mags_red[0], bands[0]), astrogrid.flux.mag2flux(mags_red[1], bands[1])]
+    with profiling.timed('filters'):
+        mags_red = astrogrid.flux.calc_mag(
+                wave_red, spec_red, bands, dmod=DIST.distmod)
+        fluxes_red = photometry.galex_mag2flux(mags_red, bands)
 
     val_fuv = fluxes_red[0] / fluxes[0]
     val_nuv = fluxes_red[1] / fluxes[1]
@@ -252,12 +425,15 @@ def ext_func(spec_data, intrinsic_data, rv, av, dav, f_bump=1., att=attenuation.
     return val_fuv, val_nuv
 
 
-
-
 def lnlike(data_fuv, data_nuv, sigma_fuv, sigma_nuv, theta, best_av, best_dav, spec_data, intrinsic_data):
     """
-    data_fuv, etc are for a SINGLE pixel
+    data_fuv, etc are for a SINGLE pixel; theta is one [R_V, f_bump] or an
+    (nwalkers, 2) array of them, done one at a time since redden takes a
+    single R_V
     """
+    if np.ndim(theta) == 2:
+        return np.array([lnlike(data_fuv, data_nuv, sigma_fuv, sigma_nuv, t, best_av,
+                                best_dav, spec_data, intrinsic_data) for t in theta])
     model = ext_func(spec_data, intrinsic_data, theta[0], best_av, best_dav, f_bump=theta[1], att=ATT)
     val = ((model[0] - data_fuv)**2/sigma_fuv**2) + ((model[1] - data_nuv)**2/sigma_nuv**2)
 
@@ -266,145 +442,32 @@ def lnlike(data_fuv, data_nuv, sigma_fuv, sigma_nuv, theta, best_av, best_dav, s
 
 def lnprior(theta):
     """
-    Set the priors on the model parameters
+    Set the priors on the model parameters. theta is one [R_V, f_bump] or
+    an (nwalkers, 2) array of them.
     """
-    # theta = [Rv, av, f_bump] ## doing R_V only for now
-    if 0. < theta[0] < 10. and 0. < theta[1] < 1.5:
-        return 0.0
-    return -np.inf
+    return sampling.box_lnprior(theta, PRIOR_LO, PRIOR_HI)
 
 
 def lnprob(theta, data_fuv, data_nuv, sigma_fuv, sigma_nuv, best_av, best_dav, spec_data, intrinsic_data):
-    lp = lnprior(theta)
-    if not np.isfinite(lp):
-        return -np.inf
-    return lp + lnlike(data_fuv, data_nuv, sigma_fuv, sigma_nuv, theta, best_av, best_dav, spec_data, intrinsic_data)
-
-
-def initialize(init, ndim, nwalkers):
     """
-    Offset the initial guess slightly for each walker
+    ln(posterior) of one point, or of all the walkers at once (see
+    sampling.lnprob_batch); the model is only computed inside the prior.
     """
-    pos = [init + 1e-4 * np.random.randn(ndim) for i in range(nwalkers)]
-    return pos
-
-
-def run_emcee(sampler, run_steps, restart_steps, pos, ndim, nwalkers, n_restarts=4):
-    """
-    Run an MCMC chain.
-
-    Parameters
-    ----------
-    sampler : emcee.ensemble.EnsembleSampler
-    run_steps : int ; number of steps for each walker takes in the main runs
-    restart_steps : int; number of steps each walker takes in the restart runs
-    pos : list ; ndim elements specifying starting points of theta
-    ndim : int ; number of parameters to fit for
-    nwalkers : number of walkers
-
-    Returns
-    -------
-    sampler : emcee.ensemble.EnsembleSampler
-    pos : final position of each walker in theta space
-
-    """
-
-    #print('First burn in')
-    pos, lp, state = sampler.run_mcmc(pos, run_steps)
-
-    # continue to burn in, restarting at maximum likelihood position each time
-    for i in range(n_restarts):
-        #print('Burn in: Restart ' + str(i + 1) + '/' + str(n_restarts))
-        sampler.reset()
-        pos, lp, state = sampler.run_mcmc(pos, restart_steps)
-        sel = np.where(sampler.flatlnprobability == np.max(sampler.flatlnprobability))
-        pos = initialize(np.mean(sampler.flatchain[sel], axis=0), ndim, nwalkers)
-
-    # one last burn in run
-    #print('Final burn in')
-    sampler.reset()
-    pos, lp, state = sampler.run_mcmc(pos, run_steps)
-    sel = np.where(sampler.flatlnprobability == np.max(sampler.flatlnprobability))
-    pos = initialize(np.mean(sampler.flatchain[sel], axis=0), ndim, nwalkers)
-    sampler.reset()
-
-    # actual mcmc run
-    #print('Actual Run')
-    sampler.run_mcmc(pos, run_steps)
-
-    return sampler, pos
-
-
-def plot_walkers(sampler, nwalkers, ndim, labels=None):
-    naxes = ndim + 1
-    fig, ax = plt.subplots(1, naxes, figsize=(naxes*3,naxes*1.5))
-
-    pp = np.asarray([sampler.chain[:,:, d] for d in range(ndim)])
-    for aa in range(ndim):
-        for w in range(nwalkers):
-            ax[aa].plot(pp[aa, w, :])
-    for w in range(nwalkers):
-        ax[aa+1].plot(sampler.lnprobability[w,:])
-
-    for i, ax in enumerate(fig.axes):
-        if labels:
-            labels.append('ln(prob)')
-            ax.set_ylabel(labels[i])
-            ax.set_xlabel('Steps')
-        ax.tick_params(labelsize=13)
-    plt.subplots_adjust(wspace=0.35, right=0.99, top=0.92, left=0.08,
-                        bottom=0.13)
-
-
-def plot_triangle(sampler, labels=None, truths=None, ndim=None):
-    import corner
-    corner.ScalarFormatter(useOffset=False)
-    lim = [(0.9995 * np.nanmin(sampler.flatchain[:,i]), 1.0005 * np.nanmax(sampler.flatchain[:,i])) for i in range(sampler.flatchain.shape[1])]
-    fig = corner.corner(sampler.flatchain, truths=truths, labels=labels,
-                        range=lim)
-
-
-def plot_data_dist(datax, datay, sampler):
-    from dustvar_paper_figs import make_2dhist_func
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
-
-    # first plot the real data
-    zticks = [1, 2, 5, 10, 20, 50]
-    xlim = [-0.01, 1.55]
-    ylim = [-1.02, 1.42]
-    cnorm = mcolors.LogNorm(vmin=1, vmax=zticks[-1])
-    hist_kwargs = {'func': 'count', 'bins': 75, 'xlim': xlim,
-                   'ylim': ylim, 'cnorm': cnorm}
-    im, cnorm, bindata = make_2dhist_func(ax, datax, datay, datay, cmap=plt.cm.Greys_r, **hist_kwargs)
-    ax.grid()
-    #plt.plot(datax, datay, marker='o', ms=1.5, color='k', lw=0)
-
-    ## Now over plot draws from the model
-    modx = np.linspace(0, 2.5, 100)
-    mean = np.percentile(sampler.flatchain[:,0], 50)
-    sigma = np.percentile(sampler.flatchain[:,1], 50)
-    mu_draw = np.random.normal(mean, sigma, 500)
-    for mu in mu_draw:
-        mody = modx * ext_func(mu, ftype=FTYPE, band=BAND, att=ATT)
-        ax.plot(modx, mody, lw=0.5, color='red', alpha=0.1)
-
-    ax.set_xlabel(r'$A_V$ + 1/2 $dA_V$')
-    ax.set_ylabel(r'$\Delta$ UV Color')
-    ax.set_xlim(xlim)
-    ax.set_ylim(ylim)
+    def like(t):
+        return lnlike(data_fuv, data_nuv, sigma_fuv, sigma_nuv, t, best_av,
+                      best_dav, spec_data, intrinsic_data)
+    return sampling.lnprob_batch(theta, lnprior, like)
 
 
 def no_dust(spec_data, age, sfr):
     waveint, specint, massint, lookback_timeint, ssp_agesint, ltint, sfrint, len_age_listint = spec_data
     waveint, specint, lum_irint = weight_output(ltint, sfrint, ssp_agesint, lookback_timeint, waveint, specint, massint, len_age_list=len_age_listint)
-    mags_int = astrogrid.flux.calc_mag(wave, spec, bands, dmod=DIST.distmod)
-    fluxes_int = [astrogrid.flux.mag2flux(mags_int[0], bands[0]), astrogrid.flux.mag2flux(mags_int[1], bands[1])]
+    mags_int = astrogrid.flux.calc_mag(waveint, specint, bands, dmod=DIST.distmod)
+    fluxes_int = photometry.galex_mag2flux(mags_int, bands)
 
     return mags_int, fluxes_int
 
 
-
 def main(i, **kwargs):
 
     ## location to store data
@@ -415,6 +478,12 @@ def main(i, **kwargs):
     y_fuv, y_nuv, y_color, av, dav, z = get_data(i)
     sigma_fuv, sigma_nuv = 0.3 * y_fuv, 0.3 * y_nuv
 
+    region = chain_io.region_name(i+1, z)
+    filename = os.path.join(data_loc, 'newred_sfh_data_' + region + '.h5')
+    if chain_io.has_region(filename, region):
+        print(region, 'done, skipping')
+        return
+
     # get the sfh info
     age, sfr = get_sfh_metals(i)
     #wave, spec, mass, lookback_time, ssp_ages = spectrum(sfr, age)
@@ -437,8 +506,13 @@ def main(i, **kwargs):
     # number of dimensions and number of walkers
     ndim, nwalkers = len(first_init), 16
 
-    # initialize the first guess with a slight offset for each walker
-    pos = initialize(first_init, ndim, nwalkers)
+    # initialize the first guess with a slight offset for each walker, drawn
+    # from the region's own streams if there's a seed
+    random_state = np.random
+    seed = kwargs.get('seed')
+    if seed is not None:
+        random_state, sampler_state = sampling.region_random_states(seed, i+1)
+    pos = initialize(first_init, ndim, nwalkers, random_state)
 
     #z = len(str(len(y_fuv)))
     # note starting time
@@ -446,45 +520,48 @@ def main(i, **kwargs):
 
     # args is what is passed to lnprob in addiiton to theta
     # doing one pixel
-    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob,
-                                    args=(y_fuv, y_nuv, sigma_fuv, sigma_nuv,
-                                          av, dav, spec_data, intrinsic_data))
-
-    # Run emcee
+    lnprob_args = (y_fuv, y_nuv, sigma_fuv, sigma_nuv,
+                   av, dav, spec_data, intrinsic_data)
+    def make_sampler(n):
+        # all the walkers go to lnprob in one call
+        return emcee.EnsembleSampler(n, ndim, lnprob, args=lnprob_args,
+                                     pool=sampling.BatchPool(lnprob, lnprob_args))
+    sampler = make_sampler(nwalkers)
+
+    if seed is not None:
+        sampler.random_state = sampler_state.get_state()
+
+    # Run emcee, resuming from the checkpoint of an interrupted run
+    checkpoint = chain_io.Checkpoint(chain_io.checkpoint_file(filename), region)
+    run_info = {}
     sampler, pos = run_emcee(sampler, run_steps, restart_steps, pos,
-                             ndim, nwalkers, n_restarts=n_restarts)
+                             ndim, nwalkers, n_restarts=n_restarts,
+                             checkpoint=checkpoint,
+                             thinned=kwargs.get('thinned', False),
+                             random_state=random_state,
+                             target_ess=kwargs.get('target_ess'),
+                             make_sampler=make_sampler,
+                             reinit=kwargs.get('reinit', 'prune'),
+                             record=run_info)
 
     # note end time
     t1 = time.time()
 
     # create a file to store data and write results
-    region = 'region_' + str(i+1).zfill(z)
-    filename = os.path.join(data_loc, 'newred_sfh_data_' + region + '.h5')
     with h5py.File(filename, 'w') as hf:
-        g = hf.create_group(region)
-        g.create_dataset('sampler_chain', data=sampler.chain)
-        g.create_dataset('sampler_flatchain', data=sampler.flatchain)
-        g.create_dataset('sampler_lnprob', data=sampler.lnprobability)
-        g.create_dataset(labs[0], data=np.percentile(sampler.flatchain[:,0], [16, 50, 84]))
-        g.create_dataset(labs[1], data=np.percentile(sampler.flatchain[:,1], [16, 50, 84]))
-        g.create_dataset('run_time', data=np.around(t1-t0, 2))
+        chain_io.write_region(hf, region, sampler, labs, t1-t0, run_info)
+    checkpoint.clear()
 
 
 if __name__ == '__main__':
-    sps = fsps.StellarPopulation()
-    sps.params['sfh'] = 4
-    sps.params['const'] = 1.0
-    sps.params['imf_type'] = 2
-    wave, spec = sps.get_spectrum(tage=1.0, peraa=True)
-
-    M31_DM = 24.47
-    ATT = attenuation.conroy
-
-    bands = ['galex_fuv', 'galex_nuv']
-    filters = observate.load_filters(bands)
-
-    reg_num = get_args().reg
-    kwargs = {'wave': wave, 'spec': spec, 'filters': filters, 'M31_DM': M31_DM,
-              'ATT': ATT}
-
-    main(reg_num, **kwargs)
+    args = get_args()
+    compile_data.set_precision(args.precision)
+    kwargs = {'M31_DM': M31_DM, 'ATT': ATT, 'thinned': args.thin,
+              'seed': args.seed, 'target_ess': args.target_ess,
+              'reinit': args.reinit}
+
+    if args.nproc > 1:
+        run_pool(args.reg, processes=args.nproc, **kwargs)
+    else:
+        for reg_num in args.reg:
+            main(reg_num, **kwargs)
@@ -11,11 +11,17 @@ import matplotlib.colors as mcolors
 
 from sedpy import attenuation, observate
 import compile_data
+import sampling
+import photometry
 
 from joblib import Parallel, delayed
 
 from pdb import set_trace
 
+# uniform priors: 0 < R_V < 10, 0 < f_bump < 1.5
+PRIOR_LO = np.array([0., 0.])
+PRIOR_HI = np.array([10., 1.5])
+
 
 def get_args():
     import argparse
@@ -65,8 +71,8 @@ def ext_func(rv, av, f_bump=1., att=attenuation.conroy):
     mags_red = observate.getSED(wave, f2, filters)
     mags = observate.getSED(wave, s, filters)
 
-    fluxes_red = [3631*10**(-0.4 * (mag + M31_DM)) for mag in mags_red]
-    fluxes = [3631 * 10**(-0.4 * (mag + M31_DM)) for mag in mags]
+    fluxes_red = photometry.ab_mag2jy(mags_red, dmod=M31_DM)
+    fluxes = photometry.ab_mag2jy(mags, dmod=M31_DM)
     val_fuv = fluxes_red[0] / fluxes[0]
     val_nuv = fluxes_red[1] / fluxes[1]
 
@@ -75,8 +81,13 @@ def ext_func(rv, av, f_bump=1., att=attenuation.conroy):
 
 def lnlike(data_fuv, data_nuv, sigma_fuv, sigma_nuv, theta, best_av):
     """
-    data_fuv, etc are for a SINGLE pixel
+    data_fuv, etc are for a SINGLE pixel; theta is one [R_V, f_bump] or an
+    (nwalkers, 2) array of them, done one at a time since ext_func takes a
+    single R_V
     """
+    if np.ndim(theta) == 2:
+        return np.array([lnlike(data_fuv, data_nuv, sigma_fuv, sigma_nuv, t, best_av)
+                         for t in theta])
     model = ext_func(theta[0], best_av, f_bump=theta[1], att=ATT)
     val = ((model[0] - data_fuv)**2/sigma_fuv**2) + ((model[1] - data_nuv)**2/sigma_nuv**2)
     return -0.5 * val
@@ -84,19 +95,20 @@ def lnlike(data_fuv, data_nuv, sigma_fuv, sigma_nuv, theta, best_av):
 
 def lnprior(theta):
     """
-    Set the priors on the model parameters
+    Set the priors on the model parameters. theta is one [R_V, f_bump] or
+    an (nwalkers, 2) array of them.
     """
-    # theta = [Rv, av, f_bump] ## doing R_V only for now
-    if 0. < theta[0] < 10. and 0. < theta[1] < 1.5:
-        return 0.0
-    return -np.inf
+    return sampling.box_lnprior(theta, PRIOR_LO, PRIOR_HI)
 
 
 def lnprob(theta, data_fuv, data_nuv, sigma_fuv, sigma_nuv, best_av):
-    lp = lnprior(theta)
-    if not np.isfinite(lp):
-        return -np.inf
-    return lp + lnlike(data_fuv, data_nuv, sigma_fuv, sigma_nuv, theta, best_av)
+    """
+    ln(posterior) of one point, or of all the walkers at once (see
+    sampling.lnprob_batch); the model is only computed inside the prior.
+    """
+    def like(t):
+        return lnlike(data_fuv, data_nuv, sigma_fuv, sigma_nuv, t, best_av)
+    return sampling.lnprob_batch(theta, lnprior, like)
 
 
 def initialize(init, ndim, nwalkers):
@@ -251,10 +263,12 @@ def main(i, **kwargs):
 
     # args is what is passed to lnprob in addiiton to theta
     # doing one pixel
-    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob,
-                                    args=(y_fuv[i], y_nuv[i],
-                                          sigma_fuv[i], sigma_nuv[i],
-                                          avdav[i]))
+    lnprob_args = (y_fuv[i], y_nuv[i],
+                   sigma_fuv[i], sigma_nuv[i],
+                   avdav[i])
+    # all the walkers go to lnprob in one call
+    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob, args=lnprob_args,
+                                    pool=sampling.BatchPool(lnprob, lnprob_args))
 
     # Run emcee
     sampler, pos = run_emcee(sampler, run_steps, restart_steps, pos,
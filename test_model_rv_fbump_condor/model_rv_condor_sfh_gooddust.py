@@ -14,11 +14,17 @@ import bursty_sfh
 import astropy.coordinates
 from sedpy import attenuation, observate
 import compile_data
+import sampling
+import photometry
 
 from joblib import Parallel, delayed
 
 from pdb import set_trace
 
+# uniform priors: 0 < R_V < 10, 0 < f_bump < 1.5
+PRIOR_LO = np.array([0., 0.])
+PRIOR_HI = np.array([10., 1.5])
+
 CURRENT_SP = []
 DIST = astropy.coordinates.Distance(distmod=24.47)
 
@@ -283,8 +289,8 @@ def ext_func(sfr, age, rv, av, dav, f_bump=1., att=attenuation.conroy):
             wave_red, spec_red, bands, dmod=DIST.distmod)
     mags = astrogrid.flux.calc_mag(wave, spec, bands, dmod=DIST.distmod)
 
-    fluxes_red = [astrogrid.flux.mag2flux(mags_red[0], bands[0]), astrogrid.flux.mag2flux(mags_red[1], bands[1])]
-    fluxes = [astrogrid.flux.mag2flux(mags[0], bands[0]), astrogrid.flux.mag2flux(mags[1], bands[1])]
+    fluxes_red = photometry.galex_mag2flux(mags_red, bands)
+    fluxes = photometry.galex_mag2flux(mags, bands)
 
     val_fuv = fluxes_red[0] / fluxes[0]
     val_nuv = fluxes_red[1] / fluxes[1]
@@ -294,8 +300,13 @@ def ext_func(sfr, age, rv, av, dav, f_bump=1., att=attenuation.conroy):
 
 def lnlike(data_fuv, data_nuv, sigma_fuv, sigma_nuv, theta, best_av, best_dav, age, sfr):
     """
-    data_fuv, etc are for a SINGLE pixel
+    data_fuv, etc are for a SINGLE pixel; theta is one [R_V, f_bump] or an
+    (nwalkers, 2) array of them, done one at a time since ext_func takes a
+    single R_V
     """
+    if np.ndim(theta) == 2:
+        return np.array([lnlike(data_fuv, data_nuv, sigma_fuv, sigma_nuv, t, best_av, best_dav, age, sfr)
+                         for t in theta])
     model = ext_func(sfr, age, theta[0], best_av, best_dav, f_bump=theta[1], att=ATT)
     val = ((model[0] - data_fuv)**2/sigma_fuv**2) + ((model[1] - data_nuv)**2/sigma_nuv**2)
 
@@ -304,19 +315,20 @@ def lnlike(data_fuv, data_nuv, sigma_fuv, sigma_nuv, theta, best_av, best_dav, a
 
 def lnprior(theta):
     """
-    Set the priors on the model parameters
+    Set the priors on the model parameters. theta is one [R_V, f_bump] or
+    an (nwalkers, 2) array of them.
     """
-    # theta = [Rv, av, f_bump] ## doing R_V only for now
-    if 0. < theta[0] < 10. and 0. < theta[1] < 1.5:
-        return 0.0
-    return -np.inf
+    return sampling.box_lnprior(theta, PRIOR_LO, PRIOR_HI)
 
 
 def lnprob(theta, data_fuv, data_nuv, sigma_fuv, sigma_nuv, best_av, best_dav, age, sfr):
-    lp = lnprior(theta)
-    if not np.isfinite(lp):
-        return -np.inf
-    return lp + lnlike(data_fuv, data_nuv, sigma_fuv, sigma_nuv, theta, best_av, best_dav, age, sfr)
+    """
+    ln(posterior) of one point, or of all the walkers at once (see
+    sampling.lnprob_batch); the model is only computed inside the prior.
+    """
+    def like(t):
+        return lnlike(data_fuv, data_nuv, sigma_fuv, sigma_nuv, t, best_av, best_dav, age, sfr)
+    return sampling.lnprob_batch(theta, lnprior, like)
 
 
 def initialize(init, ndim, nwalkers):
@@ -469,9 +481,11 @@ def main(i, **kwargs):
 
     # args is what is passed to lnprob in addiiton to theta
     # doing one pixel
-    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob,
-                                    args=(y_fuv, y_nuv, sigma_fuv, sigma_nuv,
-                                          av, dav, age, sfr))
+    lnprob_args = (y_fuv, y_nuv, sigma_fuv, sigma_nuv,
+                   av, dav, age, sfr)
+    # all the walkers go to lnprob in one call
+    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob, args=lnprob_args,
+                                    pool=sampling.BatchPool(lnprob, lnprob_args))
 
     # Run emcee
     sampler, pos = run_emcee(sampler, run_steps, restart_steps, pos,